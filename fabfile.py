@@ -30,8 +30,14 @@ rsync_exclusions = [
 PYTHON = "/usr/bin/python3.9"
 
 
+def write_revision():
+    """Record the revision being deployed, to version cache keys."""
+    local('git rev-parse --short HEAD > REVISION')
+
+
 def publish():
     """Redeploy the site."""
+    write_revision()
     run('mkdir -p www logs')
     rsync_project(local_dir='./', remote_dir='www/', exclude=rsync_exclusions)
     rsync_project(local_dir='./deploy/', remote_dir='www/')
@@ -55,6 +61,7 @@ def publish():
 
 def quick_publish():
     """Redeploy very minor code/template changes."""
+    write_revision()
     rsync_project(local_dir='./', remote_dir='www/', exclude=rsync_exclusions)
     with cd('/home/pyweek/www/'):
         path = run('echo "${PATH}"', quiet=True)
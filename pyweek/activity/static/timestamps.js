@@ -0,0 +1,66 @@
+// Show times in <time datetime="..."> elements (in UTC) as how long ago
+// they were, such as "5 minutes ago".
+//
+// Times more than maxDays ago are left as they are, if maxDays is given.
+function updateTimestamps(selector, maxDays)
+{
+    var now = new Date().getTime();
+    $(selector).each(function() {
+        const tstr = $(this).attr('datetime');
+        const dt = new Date(tstr + 'Z').getTime();
+
+        let age = (now - dt) / 1000;
+        age |= 0;
+        if (age < 60) {
+            $(this).text('A few seconds ago');
+            return;
+        }
+
+        age = (age + 30) / 60;
+        age |= 0;
+
+        if (age == 1) {
+            $(this).text('A minute ago');
+            return;
+        }
+        else if (age < 60) {
+            $(this).text(age + ' minutes ago');
+            return;
+        }
+
+        age = (age + 30) / 60;
+        age |= 0;
+
+        if (age == 1) {
+            $(this).text('An hour ago');
+            return;
+        } else if (age < 24) {
+            $(this).text(age + ' hours ago');
+            return;
+        }
+
+        age = (age + 12) / 24;
+        age |= 0;
+
+        if (maxDays !== undefined && age > maxDays) {
+            return;
+        }
+        if (age == 1) {
+            $(this).text('Yesterday');
+        } else {
+            $(this).text(age + ' days ago');
+        }
+    });
+}
+
+// Keep <time data-relative="maxDays"> elements up to date on any page that
+// includes this script.
+jQuery(function ($) {
+    function updateRelative() {
+        $('time[data-relative]').each(function() {
+            updateTimestamps(this, parseInt($(this).attr('data-relative')));
+        });
+    }
+    updateRelative();
+    setInterval(updateRelative, 60000);
+});
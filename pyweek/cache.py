@@ -0,0 +1,94 @@
+"""Cache backends that count their hits and misses.
+
+These wrap Django's own backends. Counts are kept per process and every so
+often added to totals kept in the cache itself, so that with a shared
+backend (such as the file-based one) any process can read the totals for
+all workers with cache_stats().
+
+Totals are stored under the deploy's key prefix, so they count from the
+most recent deploy.
+"""
+import threading
+
+from django.core.cache import caches
+from django.core.cache.backends import filebased, locmem
+
+
+# Number of lookups counted locally before adding them to the totals
+FLUSH_EVERY = 100
+
+STATS_KEY = 'cache-stats-{}'
+
+_MISSING = object()
+
+
+class CountingMixin:
+    """Count cache hits and misses in get()."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        params = args[-1] if args else kwargs['params']
+        self.flush_every = params.get('OPTIONS', {}).get(
+            'STATS_FLUSH_EVERY', FLUSH_EVERY
+        )
+        self._counts = {'hits': 0, 'misses': 0}
+        self._counts_lock = threading.Lock()
+
+    def get(self, key, default=None, version=None):
+        value = super().get(key, _MISSING, version=version)
+        if value is _MISSING:
+            self._count('misses')
+            return default
+        self._count('hits')
+        return value
+
+    def _count(self, name):
+        with self._counts_lock:
+            self._counts[name] += 1
+            if sum(self._counts.values()) < self.flush_every:
+                return
+            counts = self._counts
+            self._counts = {'hits': 0, 'misses': 0}
+        self._add_to_totals(counts)
+
+    def flush_stats(self):
+        """Add the counts for this process to the totals now."""
+        with self._counts_lock:
+            counts = self._counts
+            self._counts = {'hits': 0, 'misses': 0}
+        self._add_to_totals(counts)
+
+    def _add_to_totals(self, counts):
+        # Bypass our own get() so that reading the totals isn't counted.
+        # Concurrent flushes may lose counts; the totals are approximate.
+        for name, n in counts.items():
+            key = STATS_KEY.format(name)
+            total = super().get(key, 0)
+            super().set(key, total + n, None)
+
+    def stats(self):
+        """Get the totals of hits and misses in all processes."""
+        return {
+            name: super(CountingMixin, self).get(STATS_KEY.format(name), 0)
+            for name in ('hits', 'misses')
+        }
+
+
+class FileBasedCache(CountingMixin, filebased.FileBasedCache):
+    """A cache on disk, shared by all processes on a host."""
+
+
+class LocMemCache(CountingMixin, locmem.LocMemCache):
+    """A cache in process memory, for development and tests."""
+
+
+def cache_stats(alias='default'):
+    """Get the hit and miss totals for the given cache.
+
+    Return None if the cache doesn't count its hits and misses.
+
+    """
+    cache = caches[alias]
+    if not isinstance(cache, CountingMixin):
+        return None
+    return cache.stats()
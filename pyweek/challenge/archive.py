@@ -0,0 +1,223 @@
+"""Archives of all the final downloads of a challenge, for mirrors.
+
+stream_tar() generates a tar of a challenge's final, non-screenshot files a
+block at a time, so it can be served without holding any file in memory.
+Once judging has ended the archive is written to storage by the
+"build_archives" command along with a .torrent, which web-seeds from the
+stored archive and is linked as the challenge's torrent_url.
+
+Archives are named after the ETag of the challenge's download manifest,
+so a stored archive is known to match the current downloads.
+"""
+import hashlib
+import os
+import posixpath
+import tarfile
+import time
+from urllib.parse import urljoin
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+
+from .models import DownloadManifest, File
+
+
+BLOCK_SIZE = 1 << 16
+
+# Pieces of a torrent are at least this size, doubled until there are no
+# more than MAX_PIECES of them
+MIN_PIECE_LENGTH = 1 << 18
+MAX_PIECES = 2000
+
+
+def archive_members(challenge):
+    """Get the tar headers and files to put in the challenge's archive.
+
+    Files missing from storage are left out, so that the headers can all
+    be worked out before any of the archive is sent.
+
+    """
+    files = File.objects.filter(
+        challenge=challenge,
+        entry__has_final=True,
+        is_final=True,
+        is_screenshot=False,
+    ).select_related('entry').order_by('entry__name', 'pk')
+
+    members = []
+    for f in files:
+        if not f.content.storage.exists(f.content.name):
+            continue
+        info = tarfile.TarInfo(posixpath.join(
+            f'pyweek{challenge.number}',
+            f.entry.name,
+            posixpath.basename(f.content.name),
+        ))
+        info.size = f.get_size()
+        info.mtime = int(f.created.timestamp())
+        info.mode = 0o644
+        members.append((info, f))
+    return members
+
+
+def _header(info):
+    return info.tobuf(tarfile.GNU_FORMAT, 'utf-8', 'surrogateescape')
+
+
+def _padding(size):
+    return b'\0' * (-size % tarfile.BLOCKSIZE)
+
+
+def archive_length(members):
+    """Get the size in bytes of the tar of the given members."""
+    return sum(
+        len(_header(info)) + info.size + len(_padding(info.size))
+        for info, _ in members
+    ) + 2 * tarfile.BLOCKSIZE
+
+
+def stream_tar(members):
+    """Generate the tar of the given members in chunks.
+
+    Each file is read exactly as far as the size in its header, and padded
+    with zeros if it is shorter or has gone missing since the headers were
+    made, so the archive is always well-formed.
+
+    """
+    for info, f in members:
+        yield _header(info)
+        remaining = info.size
+        try:
+            content = f.content.open('rb')
+        except FileNotFoundError:
+            pass
+        else:
+            with content:
+                while remaining:
+                    chunk = content.read(min(BLOCK_SIZE, remaining))
+                    if not chunk:
+                        break
+                    remaining -= len(chunk)
+                    yield chunk
+        while remaining:
+            chunk = b'\0' * min(BLOCK_SIZE, remaining)
+            remaining -= len(chunk)
+            yield chunk
+        yield _padding(info.size)
+    yield b'\0' * (2 * tarfile.BLOCKSIZE)
+
+
+def archive_name(challenge, manifest):
+    """Get the storage name of the challenge's archive, without extension."""
+    n = challenge.number
+    return f'{n}/pyweek{n}-{manifest.etag[:16]}'
+
+
+def bencode(value):
+    """Encode a value for a .torrent file."""
+    if isinstance(value, int):
+        return b'i%de' % value
+    if isinstance(value, str):
+        value = value.encode('utf-8')
+    if isinstance(value, bytes):
+        return b'%d:%s' % (len(value), value)
+    if isinstance(value, list):
+        return b'l' + b''.join(bencode(v) for v in value) + b'e'
+    if isinstance(value, dict):
+        items = sorted(
+            (k.encode('utf-8') if isinstance(k, str) else k, v)
+            for k, v in value.items()
+        )
+        return b'd' + b''.join(bencode(k) + bencode(v) for k, v in items) + b'e'
+    raise TypeError(f"Can't bencode {type(value).__name__}")
+
+
+def piece_length(length):
+    """Choose the piece length for a torrent of the given size."""
+    piece = MIN_PIECE_LENGTH
+    while length > piece * MAX_PIECES:
+        piece *= 2
+    return piece
+
+
+def make_torrent(name, length, pieces, url):
+    """Make a single-file torrent, web-seeded from the given URL."""
+    torrent = {
+        'info': {
+            'name': name,
+            'length': length,
+            'piece length': piece_length(length),
+            'pieces': pieces,
+        },
+        'url-list': [url],
+        'created by': 'pyweek.org',
+        'creation date': int(time.time()),
+    }
+    trackers = getattr(settings, 'TORRENT_TRACKERS', [])
+    if trackers:
+        torrent['announce'] = trackers[0]
+        torrent['announce-list'] = [[t] for t in trackers]
+    return bencode(torrent)
+
+
+def build_archive(challenge):
+    """Write the challenge's archive and its torrent to storage.
+
+    Archives for earlier versions of the downloads are deleted, and the
+    challenge's torrent_url is pointed at the new torrent. Return the
+    storage name of the archive.
+
+    """
+    manifest = DownloadManifest.objects.for_challenge(challenge)
+    name = archive_name(challenge, manifest)
+    members = archive_members(challenge)
+    length = archive_length(members)
+    piece = piece_length(length)
+
+    path = default_storage.path(name + '.tar')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    pieces = []
+    digest = hashlib.sha1()
+    filled = 0
+    try:
+        with open(path + '.tmp', 'wb') as f:
+            for chunk in stream_tar(members):
+                f.write(chunk)
+                view = memoryview(chunk)
+                while view:
+                    n = min(piece - filled, len(view))
+                    digest.update(view[:n])
+                    view = view[n:]
+                    filled += n
+                    if filled == piece:
+                        pieces.append(digest.digest())
+                        digest = hashlib.sha1()
+                        filled = 0
+        if filled:
+            pieces.append(digest.digest())
+        os.replace(path + '.tmp', path)
+    except BaseException:
+        if os.path.exists(path + '.tmp'):
+            os.remove(path + '.tmp')
+        raise
+
+    url = urljoin(settings.SITE_URL, default_storage.url(name + '.tar'))
+    torrent = make_torrent(
+        f'pyweek{challenge.number}.tar',
+        length,
+        b''.join(pieces),
+        url,
+    )
+    with open(default_storage.path(name + '.torrent'), 'wb') as f:
+        f.write(torrent)
+
+    prefix = posixpath.basename(name).rsplit('-', 1)[0] + '-'
+    current = {posixpath.basename(name) + ext for ext in ('.tar', '.torrent')}
+    _, filenames = default_storage.listdir(str(challenge.number))
+    for filename in filenames:
+        if filename.startswith(prefix) and filename not in current:
+            default_storage.delete(f'{challenge.number}/{filename}')
+
+    challenge.torrent_url = default_storage.url(name + '.torrent')
+    challenge.save(update_fields=['torrent_url'])
+    return name + '.tar'
@@ -0,0 +1,242 @@
+"""Benchmarks for the busiest challenge pages.
+
+generate() fills the database with a synthetic challenge in its judging
+period, and run() times a set of pages against it, reporting the number of
+queries made and the median and 95th percentile response times. See the
+"benchmark" management command.
+"""
+import datetime
+import json
+import random
+import time
+
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+
+from pyweek.activity.models import Event
+from pyweek.instrumentation import percentile
+
+from .models import (
+    Challenge, DiaryComment, DiaryEntry, Entry, File, GameListing, Rating
+)
+
+
+# The pages to time, with their URLs
+PAGES = [
+    ('entry_list', '/{challenge}/entries/'),
+    ('rating_dashboard', '/{challenge}/rating-dashboard'),
+    ('entry_display', '/e/{entry}/'),
+    ('challenge_display', '/{challenge}/'),
+    ('list_messages', '/messages/'),
+    ('timeline', '/latest/'),
+    ('all_games', '/all_games/'),
+]
+
+
+def generate(num_entries=200, ratings_per_entry=20, diaries_per_entry=3,
+             comments_per_diary=4, seed=0):
+    """Create a challenge that is being judged, full of entries.
+
+    Return the new challenge.
+
+    """
+    rand = random.Random(seed)
+    today = datetime.date.today()
+    challenge = Challenge.objects.create(
+        title='Benchmark',
+        start=today - datetime.timedelta(days=10),
+        end=today - datetime.timedelta(days=3),
+        motd='',
+        theme='Benchmarking',
+    )
+    n = challenge.number
+    created = datetime.datetime.utcnow() - datetime.timedelta(days=5)
+
+    # Teams of one to three
+    team_sizes = [rand.choice((1, 1, 2, 3)) for _ in range(num_entries)]
+    User.objects.bulk_create(
+        User(username=f'bench{n}-{i}', email=f'bench{n}-{i}@example.com')
+        for i in range(sum(team_sizes))
+    )
+    users = list(
+        User.objects.filter(username__startswith=f'bench{n}-').order_by('pk')
+    )
+
+    entries = []
+    members = []
+    teams = iter(users)
+    for i, size in enumerate(team_sizes):
+        team = [next(teams) for _ in range(size)]
+        entry = Entry(
+            name=f'b{n}-{i}',
+            title=f'Team {i}',
+            game=f'Game {i}',
+            description=f'<p>Game number {i} of the benchmark.</p>',
+            challenge=challenge,
+            user=team[0],
+            has_final=rand.random() < 0.8,
+        )
+        entries.append(entry)
+        members.append(team)
+    Entry.objects.bulk_create(entries)
+    Entry.users.through.objects.bulk_create(
+        Entry.users.through(entry_id=entry.pk, user_id=u.pk)
+        for entry, team in zip(entries, members)
+        for u in team
+    )
+    entry_pks = [e.pk for e in entries]
+    Entry.objects.update_member_counts(entry_pks)
+
+    files = []
+    for entry, team in zip(entries, members):
+        for j in range(rand.randint(1, 3)):
+            files.append(File(
+                challenge=challenge,
+                entry=entry,
+                user=team[0],
+                content=f'{n}/{entry.name}/screenshot-{j}.png',
+                description=f'Screenshot {j}',
+                is_screenshot=True,
+                thumb_width=150,
+                created=created,
+            ))
+        if entry.has_final:
+            files.append(File(
+                challenge=challenge,
+                entry=entry,
+                user=team[0],
+                content=f'{n}/{entry.name}/game.zip',
+                description='Final',
+                is_final=True,
+                created=created,
+            ))
+    File.objects.bulk_create(files)
+
+    ratings = []
+    for entry, team in zip(entries, members):
+        if not entry.has_final:
+            continue
+        judges = [u for u in rand.sample(users, ratings_per_entry + 3)
+                  if u not in team][:ratings_per_entry]
+        for judge in judges:
+            ratings.append(Rating(
+                entry=entry,
+                user=judge,
+                fun=rand.randint(1, 5),
+                innovation=rand.randint(1, 5),
+                production=rand.randint(1, 5),
+                nonworking=rand.random() < 0.05,
+                disqualify=rand.random() < 0.01,
+                comment='A fine game.',
+                created=created,
+            ))
+    Rating.objects.bulk_create(ratings)
+    challenge.rebuild_tallies()
+
+    diaries = []
+    for entry, team in zip(entries, members):
+        for j in range(diaries_per_entry):
+            diaries.append(DiaryEntry(
+                challenge=challenge,
+                entry=entry,
+                user=rand.choice(team),
+                title=f'{entry.game} progress, day {j + 1}',
+                content='<p>Today we made some progress.</p>' * 5,
+                created=created + datetime.timedelta(hours=j),
+                activity=created + datetime.timedelta(hours=j),
+            ))
+    DiaryEntry.objects.bulk_create(diaries)
+    diaries = list(
+        DiaryEntry.objects.filter(challenge=challenge).order_by('pk')
+    )
+
+    DiaryComment.objects.bulk_create(
+        DiaryComment(
+            challenge=challenge,
+            diary_entry=diary,
+            user=rand.choice(users),
+            content='<p>Looks great!</p>',
+            created=diary.created + datetime.timedelta(minutes=k + 1),
+        )
+        for diary in diaries
+        for k in range(rand.randint(0, comments_per_diary))
+    )
+    DiaryEntry.objects.update_activity([d.pk for d in diaries])
+
+    diary_type = ContentType.objects.get_for_model(DiaryEntry)
+    titles = {entry.pk: entry.title for entry in entries}
+    Event.objects.bulk_create(
+        [
+            Event(
+                type='new-entry',
+                data=json.dumps(dict(
+                    challenge=n,
+                    team=entry.title,
+                    members=[u.username for u in team],
+                    name=entry.name,
+                    description=entry.description,
+                    description_truncated=False,
+                )),
+            )
+            for entry, team in zip(entries, members)
+        ] + [
+            Event(
+                type='new-diary',
+                user_id=diary.user_id,
+                target_content_type=diary_type,
+                target_id=diary.pk,
+                data=json.dumps(dict(
+                    title=diary.title,
+                    entry={
+                        'title': titles[diary.entry_id],
+                        'name': diary.entry_id,
+                    },
+                    description=diary.content,
+                    description_truncated=False,
+                )),
+            )
+            for diary in diaries
+        ]
+    )
+    GameListing.objects.refresh(entry_pks)
+    return challenge
+
+
+def run(challenge, repeat=10, pages=PAGES):
+    """Time each page, viewed by an entrant who is judging.
+
+    Return a list of (page, queries, p50, p95) tuples, with times in
+    seconds.
+
+    """
+    entry = challenge.entries.filter(has_final=True).order_by('pk')[0]
+    judge = entry.users.all()[0]
+    other = challenge.entries.filter(has_final=True).exclude(pk=entry.pk)
+    other = other.order_by('pk')[0]
+
+    client = Client()
+    client.force_login(judge)
+
+    results = []
+    for name, url in pages:
+        url = url.format(challenge=challenge.number, entry=other.name)
+        # The first request warms up caches and is not counted
+        client.get(url)
+        times = []
+        for _ in range(repeat):
+            with CaptureQueriesContext(connection) as ctx:
+                start = time.perf_counter()
+                resp = client.get(url)
+                times.append(time.perf_counter() - start)
+            if resp.status_code != 200:
+                raise ValueError(f'{url} returned {resp.status_code}')
+        results.append((
+            name,
+            len(ctx.captured_queries),
+            percentile(times, 50),
+            percentile(times, 95),
+        ))
+    return results
@@ -0,0 +1,65 @@
+from django.db import transaction
+from django.test.utils import override_settings
+from django.core.management.base import BaseCommand
+
+from pyweek.challenge import benchmark
+
+
+class Rollback(Exception):
+    """Raised to discard the generated challenge."""
+
+
+# The generated challenge takes the next challenge number, so anything it
+# cached in the shared cache would be read by the real challenge of that
+# number; it uses a cache of its own instead
+BENCHMARK_CACHES = {
+    'default': {
+        'BACKEND': 'pyweek.cache.LocMemCache',
+        'LOCATION': 'pyweek-benchmark',
+    }
+}
+
+
+class Command(BaseCommand):
+    help = (
+        'Time the busiest challenge pages against a generated challenge. '
+        'The challenge is discarded afterwards unless --keep is given.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--entries', type=int, default=200)
+        parser.add_argument('--ratings', type=int, default=20,
+                            help='Ratings per entry with a final upload.')
+        parser.add_argument('--diaries', type=int, default=3,
+                            help='Diary entries per entry.')
+        parser.add_argument('--comments', type=int, default=4,
+                            help='Most comments per diary entry.')
+        parser.add_argument('--repeat', type=int, default=20,
+                            help='Requests per page.')
+        parser.add_argument('--keep', action='store_true',
+                            help='Keep the generated challenge.')
+
+    def handle(self, *args, **options):
+        try:
+            with override_settings(CACHES=BENCHMARK_CACHES), \
+                    transaction.atomic():
+                challenge = benchmark.generate(
+                    num_entries=options['entries'],
+                    ratings_per_entry=options['ratings'],
+                    diaries_per_entry=options['diaries'],
+                    comments_per_diary=options['comments'],
+                )
+                print(f"Generated {challenge}")
+                with override_settings(ALLOWED_HOSTS=['testserver']):
+                    results = benchmark.run(
+                        challenge,
+                        repeat=options['repeat']
+                    )
+                if not options['keep']:
+                    raise Rollback()
+        except Rollback:
+            pass
+
+        print(f"{'Page':20} {'Queries':>8} {'p50 ms':>8} {'p95 ms':>8}")
+        for name, queries, p50, p95 in results:
+            print(f"{name:20} {queries:8d} {p50 * 1000:8.1f} {p95 * 1000:8.1f}")
@@ -0,0 +1,43 @@
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+
+from pyweek.challenge.archive import archive_name, build_archive
+from pyweek.challenge.models import Challenge, DownloadManifest
+
+
+class Command(BaseCommand):
+    help = (
+        'Store archives and torrents of the final downloads of challenges '
+        'whose judging has ended.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'challenges',
+            nargs='*',
+            type=int,
+            help='Build archives for these challenges, even if still judging.'
+        )
+
+    def handle(self, *args, **options):
+        if options['challenges']:
+            challenges = Challenge.objects.filter(
+                number__in=options['challenges']
+            )
+        else:
+            challenges = [
+                c for c in Challenge.objects.pyweek_challenges()
+                if c.isAllDone()
+            ]
+
+        for challenge in challenges:
+            manifest = DownloadManifest.objects.for_challenge(challenge)
+            name = archive_name(challenge, manifest) + '.tar'
+            if default_storage.exists(name) and not options['challenges']:
+                continue
+            try:
+                name = build_archive(challenge)
+            except OSError as e:
+                print(f"Can't build the archive for {challenge.number}: {e}")
+            else:
+                print(f"Built {name} ({default_storage.size(name)} bytes)")
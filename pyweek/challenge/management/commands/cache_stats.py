@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from pyweek.cache import cache_stats
+
+
+class Command(BaseCommand):
+    help = 'Show cache hits and misses since the last deploy.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--cache',
+            default='default',
+            help='The alias of the cache to report on.'
+        )
+
+    def handle(self, *args, **options):
+        stats = cache_stats(options['cache'])
+        if stats is None:
+            raise CommandError("This cache doesn't count hits and misses")
+
+        hits = stats['hits']
+        misses = stats['misses']
+        lookups = hits + misses
+        print(f"Hits: {hits}")
+        print(f"Misses: {misses}")
+        if lookups:
+            print(f"Hit rate: {hits * 100.0 / lookups:.1f}%")
@@ -0,0 +1,31 @@
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+
+from pyweek.challenge.models import Blob, File
+
+
+class Command(BaseCommand):
+    help = (
+        'Move uploads from before content-addressed storage into blobs, '
+        'sharing the disk space of identical files and recording their '
+        'sizes and hashes.'
+    )
+
+    def handle(self, *args, **options):
+        files = File.objects.filter(blob__isnull=True).exclude(content='')
+        done = missing = 0
+        for file in files.iterator():
+            try:
+                sha256, size = default_storage.adopt(file.content.name)
+            except FileNotFoundError:
+                missing += 1
+                continue
+            file.blob, created = Blob.objects.get_or_create(
+                sha256=sha256,
+                defaults={'size': size},
+            )
+            file.size = size
+            file.save(update_fields=['blob', 'size'])
+            done += 1
+        print(f"Stored {done} files as blobs ({missing} missing)")
+        print(f"{Blob.objects.count()} distinct blobs")
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from pyweek.challenge.models import UploadSession
+
+
+class Command(BaseCommand):
+    help = 'Discard chunked uploads that were never finished.'
+
+    def handle(self, *args, **options):
+        expired = list(UploadSession.objects.expired())
+        for session in expired:
+            session.discard()
+        if expired:
+            print(f"Discarded {len(expired)} unfinished uploads")
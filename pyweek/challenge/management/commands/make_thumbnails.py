@@ -0,0 +1,48 @@
+from django.core.management.base import BaseCommand
+
+from pyweek.challenge.models import File, ThumbnailJob
+
+
+class Command(BaseCommand):
+    help = 'Make thumbnails for newly uploaded screenshots.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--limit',
+            type=int,
+            default=None,
+            help='The most screenshots to process.'
+        )
+        parser.add_argument(
+            '--backfill',
+            action='store_true',
+            help=(
+                'Instead of the queue, make the thumbnail variants for '
+                'existing screenshots that lack them.'
+            )
+        )
+
+    def handle(self, *args, **options):
+        if options['backfill']:
+            self.backfill(options['limit'])
+            return
+        done = ThumbnailJob.objects.process(limit=options['limit'])
+        if done:
+            print(f"Made {done} thumbnails")
+
+    def backfill(self, limit):
+        files = File.objects.filter(
+            is_screenshot=True,
+            thumb_width__gt=0,
+            thumb_variants='',
+        ).order_by('-created')[:limit]
+        done = 0
+        for file in files:
+            # Any error from PIL is confined to the one screenshot
+            try:
+                file.make_thumbnail()
+            except Exception as e:
+                print(f"Can't make thumbnails for {file.content.name}: {e!r}")
+            else:
+                done += 1
+        print(f"Made thumbnail variants for {done} screenshots")
@@ -0,0 +1,103 @@
+import csv
+import json
+import sys
+import time
+
+from django.core.management.base import BaseCommand
+
+from pyweek.challenge.models import Challenge
+from pyweek.challenge.rating_stats import CATEGORIES, challenge_stats
+
+
+class Command(BaseCommand):
+    help = (
+        'Work out rating statistics for challenges: score distributions, '
+        'judge offsets and per-entry confidence intervals.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'challenges',
+            nargs='*',
+            type=int,
+            help='The challenges to analyse (default all).'
+        )
+        parser.add_argument(
+            '--format',
+            choices=['json', 'csv'],
+            default='json',
+        )
+        parser.add_argument(
+            '--table',
+            choices=['entries', 'judges'],
+            default='entries',
+            help='The table to write as CSV.'
+        )
+        parser.add_argument(
+            '--output',
+            help='The file to write to (default standard output).'
+        )
+
+    def handle(self, *args, **options):
+        challenges = Challenge.objects.pyweek_challenges().order_by('number')
+        if options['challenges']:
+            challenges = challenges.filter(number__in=options['challenges'])
+
+        start = time.perf_counter()
+        results = [challenge_stats(c) for c in challenges]
+        elapsed = time.perf_counter() - start
+
+        if options['output']:
+            out = open(options['output'], 'w', newline='')
+        else:
+            out = sys.stdout
+        try:
+            if options['format'] == 'json':
+                json.dump(results, out, indent=2)
+                out.write('\n')
+            elif options['table'] == 'judges':
+                self.write_judges(out, results)
+            else:
+                self.write_entries(out, results)
+        finally:
+            if out is not sys.stdout:
+                out.close()
+
+        num_ratings = sum(r['ratings'] for r in results)
+        print(
+            f"Analysed {num_ratings} ratings in {len(results)} challenges "
+            f"in {elapsed:.2f}s",
+            file=sys.stderr,
+        )
+
+    def write_entries(self, out, results):
+        writer = csv.writer(out)
+        writer.writerow(
+            ['challenge', 'entry', 'ratings', 'nonworking', 'disqualify']
+            + [f'{cat}_{col}' for cat in CATEGORIES
+               for col in ('mean', 'ci', 'normalised')]
+        )
+        for result in results:
+            for entry, stats in result['entries'].items():
+                row = [
+                    result['challenge'], entry, stats['ratings'],
+                    stats['nonworking'], stats['disqualify'],
+                ]
+                for cat in CATEGORIES:
+                    cat_stats = stats[cat] or {}
+                    row += [
+                        cat_stats.get('mean'),
+                        cat_stats.get('ci'),
+                        cat_stats.get('normalised'),
+                    ]
+                writer.writerow(row)
+
+    def write_judges(self, out, results):
+        writer = csv.writer(out)
+        writer.writerow(['challenge', 'judge', 'ratings', *CATEGORIES])
+        for result in results:
+            for judge, offsets in sorted(result['judges'].items()):
+                writer.writerow([
+                    result['challenge'], judge, offsets['n'],
+                    *(offsets[cat] for cat in CATEGORIES),
+                ])
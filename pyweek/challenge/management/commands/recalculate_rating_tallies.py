@@ -21,7 +21,7 @@ class Command(BaseCommand):
         if not all_done:
             raise CommandError('Challenge is not finished!')
 
-        challenge.generate_tallies()
+        challenge.rebuild_tallies()
         print(f"Updated rating tallies for PyWeek {challenge_id}")
         print("Individual winners reset to:")
         for e in challenge.individualWinners():
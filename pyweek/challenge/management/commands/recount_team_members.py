@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from pyweek.challenge.models import Entry
+
+
+class Command(BaseCommand):
+    help = 'Recount the members of every entry.'
+
+    def handle(self, *args, **options):
+        # Team sizes are kept up to date as teams change, but deleting a
+        # user removes them from their teams without telling us.
+        Entry.objects.update_member_counts()
+        print("Updated team sizes for all entries")
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from pyweek.challenge.models import GameListing
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the listing of all games shown at /all_games/.'
+
+    def handle(self, *args, **options):
+        GameListing.objects.refresh()
+        print(f"Listed {GameListing.objects.count()} games")
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from pyweek.challenge.models import DiaryEntry
+
+
+class Command(BaseCommand):
+    help = (
+        'Recalculate the latest comment, activity time and number of '
+        'replies of diaries and discussion threads.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'diaries',
+            nargs='*',
+            type=int,
+            help="Only update these diaries (default all but Pyggy's)."
+        )
+
+    def handle(self, *args, **options):
+        DiaryEntry.objects.update_activity(options['diaries'] or None)
+        print("Updated thread activity")
@@ -0,0 +1,54 @@
+from django.db import migrations, models
+from django.db.models.functions import Coalesce
+
+
+TOTALS = [
+    'num_ratings',
+    'fun_total',
+    'innovation_total',
+    'production_total',
+    'nonworking_count',
+    'disqualify_count',
+]
+
+
+def totals_migrate(apps, schema_editor):
+    """Fill in the running totals of existing tallies from their ratings."""
+    Rating = apps.get_model('challenge', 'Rating')
+    RatingTally = apps.get_model('challenge', 'RatingTally')
+    db_alias = schema_editor.connection.alias
+
+    working = models.Q(nonworking=False)
+    totals = Rating.objects.using(db_alias).order_by().values('entry').annotate(
+        num_ratings=models.Count('pk'),
+        fun_total=Coalesce(models.Sum('fun', filter=working), 0),
+        innovation_total=Coalesce(models.Sum('innovation', filter=working), 0),
+        production_total=Coalesce(models.Sum('production', filter=working), 0),
+        nonworking_count=models.Count('pk', filter=models.Q(nonworking=True)),
+        disqualify_count=models.Count('pk', filter=models.Q(disqualify=True)),
+    )
+    by_entry = {row.pop('entry'): row for row in totals}
+
+    tallies = list(RatingTally.objects.using(db_alias).all())
+    for tally in tallies:
+        for k, v in by_entry.get(tally.entry_id, {}).items():
+            setattr(tally, k, v)
+    RatingTally.objects.using(db_alias).bulk_update(tallies, TOTALS)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('challenge', '0010_auto_20210809_2253'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ratingtally',
+            name=name,
+            field=models.PositiveIntegerField(default=0),
+        )
+        for name in TOTALS
+    ] + [
+        migrations.RunPython(totals_migrate, migrations.RunPython.noop),
+    ]
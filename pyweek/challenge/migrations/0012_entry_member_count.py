@@ -0,0 +1,33 @@
+from django.db import migrations, models
+from django.db.models.functions import Coalesce
+
+
+def member_count_migrate(apps, schema_editor):
+    """Count the members of existing entries."""
+    Entry = apps.get_model('challenge', 'Entry')
+    db_alias = schema_editor.connection.alias
+
+    members = Entry.users.through.objects.using(db_alias).filter(
+        entry=models.OuterRef('pk'),
+    ).order_by().values('entry').annotate(
+        count=models.Count('pk'),
+    ).values('count')
+    Entry.objects.using(db_alias).update(
+        member_count=Coalesce(models.Subquery(members), 0),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('challenge', '0011_ratingtally_running_totals'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='entry',
+            name='member_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(member_count_migrate, migrations.RunPython.noop),
+    ]
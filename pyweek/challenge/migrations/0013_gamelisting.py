@@ -0,0 +1,28 @@
+# Generated by Django 3.2.25 on 2026-10-18 06:36
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('challenge', '0012_entry_member_count'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GameListing',
+            fields=[
+                ('entry', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to='challenge.entry')),
+                ('challenge_num', models.IntegerField()),
+                ('game_name', models.CharField(max_length=100)),
+                ('winner', models.BooleanField()),
+                ('rating', models.FloatField(null=True)),
+                ('team', models.TextField()),
+            ],
+            options={
+                'ordering': ['-rating'],
+            },
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 3.2.25 on 2026-10-18 06:38
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('challenge', '0013_gamelisting'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChallengeStats',
+            fields=[
+                ('challenge', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to='challenge.challenge')),
+                ('users', models.PositiveIntegerField()),
+                ('entries', models.PositiveIntegerField()),
+                ('finals', models.PositiveIntegerField()),
+                ('created', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'verbose_name_plural': 'ChallengeStats',
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 06:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('challenge', '0015_thumbnailjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='file',
+            name='thumb_variants',
+            field=models.CharField(blank=True, default='', editable=False, max_length=255),
+        ),
+    ]
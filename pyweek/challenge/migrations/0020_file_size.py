@@ -0,0 +1,36 @@
+from django.db import migrations, models
+
+
+def file_size_migrate(apps, schema_editor):
+    """Copy sizes of files already stored as blobs.
+
+    Older uploads are sized by the dedupe_files command, which has to read
+    them.
+
+    """
+    File = apps.get_model('challenge', 'File')
+    Blob = apps.get_model('challenge', 'Blob')
+    db_alias = schema_editor.connection.alias
+
+    sizes = Blob.objects.using(db_alias).filter(
+        pk=models.OuterRef('blob'),
+    ).values('size')
+    File.objects.using(db_alias).filter(blob__isnull=False).update(
+        size=models.Subquery(sizes),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('challenge', '0019_filechecksum'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='file',
+            name='size',
+            field=models.PositiveBigIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.RunPython(file_size_migrate, migrations.RunPython.noop),
+    ]
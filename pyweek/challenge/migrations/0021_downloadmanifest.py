@@ -0,0 +1,24 @@
+# Generated by Django 3.2.25 on 2026-10-18 06:54
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('challenge', '0020_file_size'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DownloadManifest',
+            fields=[
+                ('challenge', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to='challenge.challenge')),
+                ('version', models.PositiveIntegerField(default=0)),
+                ('content', models.TextField(blank=True)),
+                ('etag', models.CharField(blank=True, max_length=64)),
+                ('modified', models.DateTimeField(null=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 3.2.25 on 2026-10-18 06:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('challenge', '0021_downloadmanifest'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='diaryentry',
+            index=models.Index(condition=models.Q(('entry', None), ('is_pyggy', False)), fields=['-sticky', '-activity', '-id'], name='diaryentry_threads'),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 3.2.25 on 2026-10-18 07:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('challenge', '0022_diaryentry_threads'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='challenge',
+            name='rank_normalised',
+            field=models.BooleanField(default=False, help_text="Pick winners by scores with each judge's harshness or generosity taken out, rather than by raw scores."),
+        ),
+        migrations.AddField(
+            model_name='ratingtally',
+            name='fun_normalised',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AddField(
+            model_name='ratingtally',
+            name='innovation_normalised',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AddField(
+            model_name='ratingtally',
+            name='overall_normalised',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AddField(
+            model_name='ratingtally',
+            name='production_normalised',
+            field=models.FloatField(null=True),
+        ),
+    ]
@@ -1,20 +1,35 @@
 import os
+import html
+import json
+import hashlib
+import logging
+import secrets
+import tempfile
 import operator
+import posixpath
+import urllib.parse
 
 from django.conf import settings
 from django.core import validators
-from django.db import models, connection, transaction
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.db import models, transaction
 from django.contrib.auth.models import User
 from django.urls import reverse
-from django.db.models.signals import pre_save
+from django.db.models.functions import Coalesce
+from django.db.models.signals import (
+    pre_save, post_save, post_delete, m2m_changed
+)
 from django.utils.timezone import now
 
-from ..activity.models import EventRelation
+from ..activity.models import EventRelation, log_event
 
 
 from pyweek.bleaching import html2text
 import datetime
 
+logger = logging.getLogger(__name__)
+
 # Maximum number of checksums per entry. Set to None to disable
 MAX_CHECKSUMS = 5
 
@@ -24,6 +39,29 @@ CUTOFF_TIME = 2*60*60
 # Number of days allowed to upload against MD5
 EXTRA_DAYS = 3
 
+# Size of the box that screenshot thumbnails are scaled to fit
+THUMBNAIL_SIZE = (150, 150)
+
+# Sizes of the boxes that the compressed thumbnail variants are scaled to
+# fit, for srcset. The PNG thumbnail above is kept for older browsers.
+THUMBNAIL_VARIANT_SIZES = (600, 300, 150)
+
+# Formats of the thumbnail variants, best compression first. Formats that
+# Pillow can't write are skipped.
+THUMBNAIL_FORMATS = [
+    ('avif', 'image/avif'),
+    ('webp', 'image/webp'),
+]
+
+# Widest thumbnail shown on an entry's page
+HERO_WIDTH = 300
+
+# Hours that a chunked upload may stay unfinished before it is discarded
+UPLOAD_SESSION_HOURS = 48
+
+# Seconds to cache the number of entrants with a final entry
+FINISHERS_CACHE_TIME = 60*60
+
 UTC = datetime.timezone.utc
 
 
@@ -55,47 +93,51 @@ def pretty_time_diff(diff: datetime.timedelta) -> str:
 
 
 def participation():
-    cursor = connection.cursor()
+    """Get participation statistics for the finished Pyweek challenges.
 
+    Statistics are saved as ChallengeStats once final uploads for a
+    challenge have closed, as they can no longer change; more recent
+    challenges are counted live.
+
+    """
     # generate stats on participation
     data = {
         1: {'users': 155, 'entries': 110, 'finals': 26},
     }
-    sql = '''
-    select challenge_id, count(distinct(u.user_id))
-    from challenge_entry,challenge_entry_users u, challenge_challenge c
-    where entry_id=challenge_entry.name
-      and c.number=challenge_id
-      and challenge_id<1000
-      and c.end < now() - interval '1 day'
-    group by challenge_id '''
-    cursor.execute(sql)
-    for row in cursor.fetchall():
-        data[row[0]] = {'users': row[1]}
-
-    sql = '''
-    select challenge_id, count(*)
-      from challenge_entry, challenge_challenge c
-     where challenge_id<1000
-      and c.number=challenge_id
-      and c.end < now() - interval '1 day'
-    group by challenge_id'''
-    cursor.execute(sql)
-    for row in cursor.fetchall():
-        data[row[0]]['entries'] = row[1]
-
-    sql = '''
-    select challenge_id, count(*)
-      from challenge_entry, challenge_challenge c
-     where challenge_id<1000
-       and has_final=true
-       and c.number=challenge_id
-       and c.end < now() - interval '1 day'
-    group by challenge_id'''
-    cursor.execute(sql)
-    for row in cursor.fetchall():
-        data[row[0]]['finals'] = row[1]
+    saved = ChallengeStats.objects.all()
+    for stats in saved:
+        data[stats.challenge_id] = stats.as_dict()
+
+    yesterday = datetime.datetime.utcnow() - datetime.timedelta(days=1)
+    live = Challenge.objects.pyweek_challenges().filter(
+        end__lt=yesterday,
+    ).exclude(
+        number__in=[stats.challenge_id for stats in saved],
+    ).annotate(
+        num_users=models.Count('entries__users', distinct=True),
+        num_entries=models.Count('entries', distinct=True),
+        num_finals=models.Count(
+            'entries',
+            filter=models.Q(entries__has_final=True),
+            distinct=True,
+        ),
+    )
+    settled = []
+    for challenge in live:
+        if not challenge.num_entries:
+            continue
+        stats = ChallengeStats(
+            challenge=challenge,
+            users=challenge.num_users,
+            entries=challenge.num_entries,
+            finals=challenge.num_finals,
+        )
+        if not challenge.isFinalUploadOpen():
+            settled.append(stats)
+        data[challenge.number] = stats.as_dict()
 
+    # Another request may be saving the same stats at the same time
+    ChallengeStats.objects.bulk_create(settled, ignore_conflicts=True)
     return data
 
 
@@ -150,6 +192,11 @@ class Challenge(models.Model):
     )
     theme = models.CharField(max_length=100, null=True, blank=True, default='')
     torrent_url = models.CharField(max_length=255, null=True, blank=True, default='')
+    rank_normalised = models.BooleanField(
+        default=False,
+        help_text="Pick winners by scores with each judge's harshness or "
+                  "generosity taken out, rather than by raw scores.",
+    )
 
     objects = ChallengeManager()
 
@@ -330,6 +377,29 @@ class Challenge(models.Model):
         now = datetime.datetime.utcnow()
         return sd <= now <= ed
 
+    def upload_deadline(self):
+        '''The end of the 24 hours after the end date, when uploads close.
+        '''
+        return self.end_utc() + datetime.timedelta(1)
+
+    def isChecksumTime(self):
+        '''In the last CUTOFF_TIME seconds before uploads close, entrants
+        may register the checksum of their final entry and upload it later.
+        '''
+        ed = self.upload_deadline()
+        sd = ed - datetime.timedelta(seconds=CUTOFF_TIME)
+        now = datetime.datetime.utcnow()
+        return sd <= now <= ed
+
+    def isChecksumUploadTime(self):
+        '''Files matching registered checksums may be uploaded for
+        EXTRA_DAYS days after uploads close.
+        '''
+        sd = self.upload_deadline()
+        ed = sd + datetime.timedelta(EXTRA_DAYS)
+        now = datetime.datetime.utcnow()
+        return sd < now <= ed
+
     def isRatingOpen(self):
         ed = self.end_utc() + datetime.timedelta(1)
         now = datetime.datetime.utcnow()
@@ -381,37 +451,107 @@ class Challenge(models.Model):
         """
         return self.entries
 
+    @staticmethod
+    def finishers_cache_key(number) -> str:
+        return f'challenge-{number}-finishers'
+
+    def finisher_count(self) -> int:
+        """Count the entrants of this challenge who have a final entry.
+
+        Members of several final entries are counted once per entry. The
+        count is cached, and invalidated when entries or teams change.
+
+        """
+        key = self.finishers_cache_key(self.number)
+        count = cache.get(key)
+        if count is None:
+            count = Entry.users.through.objects.filter(
+                entry__challenge=self,
+                entry__has_final=True,
+            ).count()
+            cache.set(key, count, FINISHERS_CACHE_TIME)
+        return count
+
+    @transaction.atomic
+    def rebuild_tallies(self):
+        """Recalculate the running rating totals for this challenge.
+
+        Tallies are normally kept up to date as ratings are saved; this
+        rebuilds them from scratch from the ratings themselves.
+
+        """
+        RatingTally.objects.filter(entry__challenge=self).delete()
+        totals = Rating.objects.filter(
+            entry__challenge=self,
+            entry__has_final=True,
+        ).order_by().values('entry').annotate(**rating_totals())
+
+        new_tallies = []
+        for row in totals:
+            tally = RatingTally.empty(Entry(pk=row.pop('entry'), challenge=self))
+            for k, v in row.items():
+                setattr(tally, k, v)
+            new_tallies.append(tally)
+        RatingTally.objects.bulk_create(new_tallies)
+        self.generate_tallies()
+
     @transaction.atomic
     def generate_tallies(self):
-        """Recalculate rating tallies for this challenge."""
+        """Finalise the rating tallies for this challenge and pick winners.
+
+        The running totals in each tally are maintained as ratings are
+        saved, so this only refreshes what depends on the challenge as a
+        whole: the team flag, the disqualification percentage and the
+        normalised scores. If rank_normalised is set, winners are picked by
+        normalised rather than raw scores.
+
+        """
+        from .rating_stats import fit_judge_offsets, load_ratings
+
+        RatingTally.objects.filter(
+            entry__challenge=self,
+            entry__has_final=False,
+        ).delete()
+        tallies = {
+            t.entry_id: t
+            for t in RatingTally.objects.filter(entry__challenge=self)
+        }
+        entries = self.entries.filter(has_final=True)
+        num_finished = self.finisher_count()
+        _, normalised = fit_judge_offsets(load_ratings(self, finals_only=True))
+
         team = []
         individual = []
-        for entry in self.entries.all():
-            entry.ratingtally_set.all().delete()
-            if not entry.has_final:
-                continue
-
-            ratings = entry.tally_ratings()
-            ratingtally = RatingTally(
-                challenge=self,
-                entry=entry,
-                individual=not entry.is_team(),
-                fun=ratings['fun'],
-                innovation=ratings['innovation'],
-                production=ratings['production'],
-                overall=ratings['overall'],
-                nonworking=int(ratings['nonworking'] *100),
-                disqualify=int(ratings['disqualify'] * 100),
-                respondents=ratings['respondents'],
+        new_tallies = []
+        for entry in entries:
+            tally = tallies.get(entry.pk)
+            if tally is None:
+                tally = RatingTally.empty(entry)
+                new_tallies.append(tally)
+            tally.individual = not entry.is_team()
+            tally.update_scores(num_finished)
+            tally.set_normalised(normalised.get(entry.pk))
+
+            overall = (
+                tally.overall_normalised if self.rank_normalised
+                else tally.overall
             )
-            ratingtally.save()
-
-            if entry.is_team():
-                team.append((int(ratings['overall'] * 100), entry))
+            if tally.individual:
+                individual.append((int(overall * 100), entry))
             else:
-                individual.append((int(ratings['overall'] * 100), entry))
+                team.append((int(overall * 100), entry))
+
+        RatingTally.objects.bulk_create(new_tallies)
+        RatingTally.objects.bulk_update(
+            tallies.values(),
+            ['individual', 'fun', 'innovation', 'production', 'overall',
+             'nonworking', 'disqualify', 'fun_normalised',
+             'innovation_normalised', 'production_normalised',
+             'overall_normalised'],
+        )
 
-        # figure the winners
+        # figure the winners, afresh in case the scoring has changed
+        self.entries.filter(winner=self).update(winner=None)
         by_score = operator.itemgetter(0)
         team.sort(key=by_score)
         individual.sort(key=by_score)
@@ -425,11 +565,39 @@ class Challenge(models.Model):
                     e.winner = self
                     e.save()
 
+        GameListing.objects.refresh(self.entries.values('pk'))
+
     def individualWinners(self):
-        return [e for e in Entry.objects.filter(winner=self.number) if not e.is_team()]
+        return list(Entry.objects.filter(winner=self.number, member_count__lte=1))
 
     def teamWinners(self):
-        return [e for e in Entry.objects.filter(winner=self.number) if e.is_team()]
+        return list(Entry.objects.filter(winner=self.number, member_count__gt=1))
+
+
+class ChallengeStats(models.Model):
+    """Participation statistics for a challenge that has been settled."""
+    challenge = models.OneToOneField(
+        Challenge,
+        primary_key=True,
+        on_delete=models.CASCADE,  # stats describe the challenge
+    )
+    users = models.PositiveIntegerField()
+    entries = models.PositiveIntegerField()
+    finals = models.PositiveIntegerField()
+    created = models.DateTimeField(default=now)
+
+    class Meta:
+        verbose_name_plural = "ChallengeStats"
+
+    def __repr__(self):
+        return f'<Stats for {self.challenge_id!r}>'
+
+    def as_dict(self):
+        return {
+            'users': self.users,
+            'entries': self.entries,
+            'finals': self.finals,
+        }
 
 
 def challenge_save(sender, instance, **kwargs):
@@ -448,6 +616,85 @@ def challenge_save(sender, instance, **kwargs):
 pre_save.connect(challenge_save, sender=Challenge)
 
 
+class EntryManager(models.Manager):
+    def for_entry_list(self, challenge):
+        """Get the entries of a challenge ready for listing.
+
+        Members, owner and non-screenshot files (as ``downloads``) are
+        prefetched, and entries are annotated with ``num_ratings`` (from
+        their rating tallies) and the ``thumb_id`` of their latest
+        screenshot, so that the listing costs the same number of queries
+        however many entries there are.
+
+        """
+        latest_screenshot = File.objects.filter(
+            entry=models.OuterRef('pk'),
+            is_screenshot=True,
+            thumb_width__gt=0,
+        ).order_by('-created').values('pk')[:1]
+        num_ratings = RatingTally.objects.filter(
+            entry=models.OuterRef('pk'),
+        ).values('num_ratings')[:1]
+        return self.filter(challenge=challenge).select_related(
+            'user', 'challenge'
+        ).prefetch_related(
+            'users',
+            models.Prefetch(
+                'file_set',
+                queryset=File.objects.filter(is_screenshot=False),
+                to_attr='downloads',
+            ),
+        ).annotate(
+            num_ratings=Coalesce(models.Subquery(num_ratings), 0),
+            thumb_id=models.Subquery(latest_screenshot),
+        )
+
+    def for_rating_dashboard(self, challenge, user):
+        """Get the final entries of a challenge for a judge's dashboard.
+
+        Entries are annotated with ``num_ratings`` and ``num_nonworking``
+        from their rating tallies, and ``is_yours`` if the user is in the
+        team. The user's awards are prefetched as ``user_awards``.
+
+        """
+        tallies = RatingTally.objects.filter(entry=models.OuterRef('pk'))
+        return self.filter(
+            challenge=challenge,
+            has_final=True,
+        ).annotate(
+            num_ratings=Coalesce(
+                models.Subquery(tallies.values('num_ratings')[:1]), 0
+            ),
+            num_nonworking=Coalesce(
+                models.Subquery(tallies.values('nonworking_count')[:1]), 0
+            ),
+            is_yours=models.Exists(
+                Entry.users.through.objects.filter(
+                    entry=models.OuterRef('pk'),
+                    user=user,
+                )
+            ),
+        ).select_related('user').prefetch_related(
+            models.Prefetch(
+                'entryaward_set',
+                queryset=user.entryaward_set.select_related('award'),
+                to_attr='user_awards',
+            )
+        )
+
+    def update_member_counts(self, pks=None):
+        """Recount the members of the given entries (default all)."""
+        entries = self.all() if pks is None else self.filter(pk__in=pks)
+        members = Entry.users.through.objects.filter(
+            entry=models.OuterRef('pk'),
+        ).order_by().values('entry').annotate(
+            count=models.Count('pk'),
+        ).values('count')
+        entries.update(
+            member_count=Coalesce(models.Subquery(members), 0),
+        )
+
+
 class Entry(models.Model):
     SHORT_TITLE_LEN = 14
 
@@ -506,6 +753,8 @@ class Entry(models.Model):
                                     # user must not delete the entry
     )
     users = models.ManyToManyField(User)
+    # Number of users, kept in step with users by entry_users_changed()
+    member_count = models.PositiveIntegerField(default=0, editable=False)
     is_upload_open = models.BooleanField(default=False)
     has_final = models.BooleanField(default=False)
 
@@ -514,6 +763,7 @@ class Entry(models.Model):
         related_name='join_request_entries'
     )
 
+    objects = EntryManager()
 
     class Meta:
         ordering = ['-challenge', 'name']
@@ -541,7 +791,7 @@ class Entry(models.Model):
         return f"{self.title[:Entry.SHORT_TITLE_LEN]}..."
 
     def is_team(self) -> bool:
-        return len(self.users.all()) > 1
+        return self.member_count > 1
 
     def diary_entries(self):
         """Get a QuerySet of all diary entries.
@@ -559,6 +809,13 @@ class Entry(models.Model):
         challenge = self.challenge
         return challenge.isUploadOpen()
 
+    def isChecksumUploadOpen(self) -> bool:
+        """Whether files matching registered checksums may be uploaded."""
+        return (
+            self.challenge.isChecksumUploadTime()
+            and self.filechecksum_set.filter(file__isnull=True).exists()
+        )
+
     #def has_final(self):
         #return len(self.file_set.filter(is_final__exact=True,
             #is_screenshot__exact=False))
@@ -589,39 +846,88 @@ class Entry(models.Model):
         return len(self.rating_set.filter(user__username__exact=user.username)) > 0
 
     def tally_ratings(self):
-        ratings = self.rating_set.all()
-        info = {}
-        for rating in 'fun innovation production disqualify nonworking overall'.split():
-            info[rating] = 0
-        n = 0
-        for rating in ratings:
-            info['disqualify'] += rating.disqualify
-            info['nonworking'] += rating.nonworking
-            if rating.nonworking:
-                continue
-            n += 1
-            info['fun'] += rating.fun
-            info['innovation'] += rating.innovation
-            info['production'] += rating.production
-        m = float(len(ratings))
-        num_finished = sum(len(e.users.all())
-                for e in Entry.objects.filter(challenge=self.challenge)
-                    if e.has_final)
+        totals = self.rating_set.aggregate(**rating_totals())
+        info = {
+            'fun': totals['fun_total'],
+            'innovation': totals['innovation_total'],
+            'production': totals['production_total'],
+            'disqualify': totals['disqualify_count'],
+            'nonworking': totals['nonworking_count'],
+            'overall': 0,
+        }
+        n = totals['respondents']
+        m = float(totals['num_ratings'])
         if n:
+            num_finished = self.challenge.finisher_count()
             for rating in 'fun innovation production'.split():
                 info[rating] /= float(n)
             info['disqualify'] /= float(num_finished)
-            info['nonworking'] /= float(len(ratings))
-            info['participants'] = len(ratings)/float(num_finished)
+            info['nonworking'] /= m
+            info['participants'] = m / float(num_finished)
             info['overall'] = (info['fun'] + info['innovation'] +
                 info['production'])/3
         info['respondents'] = n
         return info
 
+
+def entry_changed(sender, instance, **kwargs):
+    """Forget the cached finisher count when an entry changes."""
+    cache.delete(Challenge.finishers_cache_key(instance.challenge_id))
+
+
+def entry_users_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """Update team sizes and forget cached finisher counts on team changes.
+
+    Teams can be changed from either side of the relation; when changed
+    from a user, pk_set holds entry keys rather than user keys.
+
+    """
+    if reverse and action == 'pre_clear':
+        instance._cleared_entries = set(
+            instance.entry_set.values_list('pk', flat=True)
+        )
+        return
+    if not action.startswith('post_'):
+        return
+
+    if not reverse:
+        pk_set = {instance.pk}
+    elif action == 'post_clear':
+        pk_set = instance.__dict__.pop('_cleared_entries', set())
+
+    Entry.objects.update_member_counts(pk_set)
+    if not reverse:
+        instance.refresh_from_db(fields=['member_count'])
+    GameListing.objects.refresh(pk_set)
+
+    numbers = set(
+        Entry.objects.filter(pk__in=pk_set)
+        .order_by().values_list('challenge_id', flat=True).distinct()
+    )
+    cache.delete_many([Challenge.finishers_cache_key(n) for n in numbers])
+
+post_save.connect(entry_changed, sender=Entry)
+post_delete.connect(entry_changed, sender=Entry)
+m2m_changed.connect(entry_users_changed, sender=Entry.users.through)
+
 RATING_CHOICES = ((1, 'Not at all'), (2,'Below average'),
     (3,'About average'), (4,'Above average'), (5,'Exceptional'))
 
 
+def rating_totals():
+    """Aggregates giving the running totals stored in a RatingTally."""
+    working = models.Q(nonworking=False)
+    return {
+        'num_ratings': models.Count('pk'),
+        'respondents': models.Count('pk', filter=working),
+        'fun_total': Coalesce(models.Sum('fun', filter=working), 0),
+        'innovation_total': Coalesce(models.Sum('innovation', filter=working), 0),
+        'production_total': Coalesce(models.Sum('production', filter=working), 0),
+        'nonworking_count': models.Count('pk', filter=models.Q(nonworking=True)),
+        'disqualify_count': models.Count('pk', filter=models.Q(disqualify=True)),
+    }
+
+
 class Rating(models.Model):
     entry = models.ForeignKey(
         Entry,
@@ -654,6 +960,31 @@ class Rating(models.Model):
         return f'{self.user} rating {self.entry}'
 
 
+class RatingTallyManager(models.Manager):
+    @transaction.atomic
+    def add_rating(self, rating, sign=1):
+        """Add a rating to the tally for its entry.
+
+        Pass sign=-1 to remove a rating that was previously added.
+
+        """
+        # Lock the entry so that concurrent ratings update one tally in turn
+        entry = Entry.objects.select_for_update().filter(
+            pk=rating.entry_id
+        ).first()
+        if entry is None:
+            return
+        tally = self.filter(entry=entry).first()
+        if tally is None:
+            if sign < 0:
+                return
+            tally = self.model.empty(entry)
+            tally.individual = not entry.is_team()
+        tally.add_rating(rating, sign)
+        tally.update_scores(entry.challenge.finisher_count())
+        tally.save()
+
+
 class RatingTally(models.Model):
     challenge = models.ForeignKey(
         Challenge,
@@ -672,6 +1003,22 @@ class RatingTally(models.Model):
     disqualify = models.PositiveIntegerField()
     respondents = models.PositiveIntegerField()
 
+    # Scores with judges' offsets taken out, set by generate_tallies()
+    fun_normalised = models.FloatField(null=True)
+    innovation_normalised = models.FloatField(null=True)
+    production_normalised = models.FloatField(null=True)
+    overall_normalised = models.FloatField(null=True)
+
+    # Running totals, updated as ratings are saved and deleted
+    num_ratings = models.PositiveIntegerField(default=0)
+    fun_total = models.PositiveIntegerField(default=0)
+    innovation_total = models.PositiveIntegerField(default=0)
+    production_total = models.PositiveIntegerField(default=0)
+    nonworking_count = models.PositiveIntegerField(default=0)
+    disqualify_count = models.PositiveIntegerField(default=0)
+
+    objects = RatingTallyManager()
+
     class Meta:
         ordering = ['challenge', 'individual', '-overall']
         verbose_name_plural = "RatingTallies"
@@ -681,6 +1028,180 @@ class RatingTally(models.Model):
     def __str__(self):
         return f'{self.entry} rating tally'
 
+    @classmethod
+    def empty(cls, entry):
+        """Create an unsaved tally, with no ratings, for the given entry."""
+        return cls(
+            challenge_id=entry.challenge_id,
+            entry=entry,
+            individual=True,
+            fun=0, innovation=0, production=0, overall=0,
+            nonworking=0, disqualify=0, respondents=0,
+        )
+
+    def add_rating(self, rating, sign=1):
+        """Add (or with sign=-1, remove) a rating to the running totals."""
+        self.num_ratings += sign
+        self.nonworking_count += sign * rating.nonworking
+        self.disqualify_count += sign * rating.disqualify
+        if rating.nonworking:
+            return
+        self.respondents += sign
+        self.fun_total += sign * rating.fun
+        self.innovation_total += sign * rating.innovation
+        self.production_total += sign * rating.production
+
+    def set_normalised(self, scores):
+        """Set the normalised scores, from fit_judge_offsets().
+
+        Entries without working ratings score 0, as with raw scores.
+
+        """
+        scores = scores or dict.fromkeys(
+            ('fun', 'innovation', 'production'), 0
+        )
+        self.fun_normalised = scores['fun']
+        self.innovation_normalised = scores['innovation']
+        self.production_normalised = scores['production']
+        self.overall_normalised = (
+            self.fun_normalised + self.innovation_normalised
+            + self.production_normalised
+        ) / 3
+
+    def update_scores(self, num_finished):
+        """Recalculate the scores from the running totals.
+
+        num_finished is the number of entrants with a final entry in the
+        challenge, as returned by Challenge.finisher_count().
+
+        """
+        n = self.respondents
+        if n:
+            self.fun = self.fun_total / float(n)
+            self.innovation = self.innovation_total / float(n)
+            self.production = self.production_total / float(n)
+        else:
+            self.fun = self.innovation = self.production = 0
+        self.overall = (self.fun + self.innovation + self.production) / 3
+        if self.num_ratings:
+            self.nonworking = int(
+                self.nonworking_count / float(self.num_ratings) * 100
+            )
+        else:
+            self.nonworking = 0
+        if num_finished:
+            self.disqualify = int(
+                self.disqualify_count / float(num_finished) * 100
+            )
+        else:
+            self.disqualify = 0
+
+
+def rating_pre_save(sender, instance, raw=False, **kwargs):
+    """Remember the stored version of a rating before it is changed."""
+    instance._stored_rating = None
+    if instance.pk is not None and not raw:
+        instance._stored_rating = sender.objects.filter(pk=instance.pk).first()
+
+
+@transaction.atomic
+def rating_post_save(sender, instance, raw=False, **kwargs):
+    """Update the rating tally of the entry when a rating is saved."""
+    if raw:
+        return
+    stored = getattr(instance, '_stored_rating', None)
+    if stored is not None:
+        RatingTally.objects.add_rating(stored, -1)
+    RatingTally.objects.add_rating(instance)
+
+
+def rating_post_delete(sender, instance, **kwargs):
+    """Remove a deleted rating from the rating tally of the entry."""
+    RatingTally.objects.add_rating(instance, -1)
+
+pre_save.connect(rating_pre_save, sender=Rating)
+post_save.connect(rating_post_save, sender=Rating)
+post_delete.connect(rating_post_delete, sender=Rating)
+
+
+class GameListingManager(models.Manager):
+    @transaction.atomic
+    def refresh(self, pks=None):
+        """Rebuild the listing rows of the given entries (default all)."""
+        entries = Entry.objects.all()
+        rows = self.all()
+        if pks is not None:
+            entries = entries.filter(pk__in=pks)
+            rows = rows.filter(entry__in=pks)
+        rows.delete()
+
+        tallies = RatingTally.objects.filter(entry=models.OuterRef('pk'))
+        entries = entries.filter(
+            has_final=True,
+            challenge__number__lt=1000,
+        ).select_related('challenge').prefetch_related(
+            models.Prefetch('users', queryset=User.objects.only('username')),
+        ).annotate(
+            overall=models.Subquery(tallies.values('overall')[:1]),
+        )
+
+        u = urllib.parse.quote
+        e = html.escape
+        listings = []
+        for entry in entries:
+            team = ',\n'.join([
+                f'<a class="small" href="/u/{u(user.username)}">{e(user.username)}</a>'
+                for user in entry.users.all()
+            ])
+            listings.append(GameListing(
+                entry=entry,
+                challenge_num=entry.challenge_id,
+                game_name=entry.display_title,
+                winner=entry.winner_id is not None,
+                # Tallies are kept up to date during judging; don't reveal
+                # them early
+                rating=entry.overall if entry.challenge.isAllDone() else None,
+                team=team,
+            ))
+        self.bulk_create(listings, ignore_conflicts=True)
+
+
+class GameListing(models.Model):
+    """A row of the all games list, materialised from the entry.
+
+    Rows are refreshed when their entry or its team changes and when
+    tallies are generated; the refresh_all_games command rebuilds them all.
+
+    """
+    entry = models.OneToOneField(
+        Entry,
+        primary_key=True,
+        on_delete=models.CASCADE,  # listings are derived from their entry
+    )
+    challenge_num = models.IntegerField()
+    game_name = models.CharField(max_length=100)
+    winner = models.BooleanField()
+    rating = models.FloatField(null=True)
+    team = models.TextField()
+
+    objects = GameListingManager()
+
+    class Meta:
+        ordering = ['-rating']
+
+    def __repr__(self):
+        return f'{self.entry_id!r} game listing'
+    def __str__(self):
+        return f'{self.entry_id} game listing'
+
+
+def entry_saved(sender, instance, raw=False, **kwargs):
+    """Refresh the entry's row in the all games listing."""
+    if not raw:
+        GameListing.objects.refresh([instance.pk])
+
+post_save.connect(entry_saved, sender=Entry)
+
 
 class DiaryEntryManager(models.Manager):
     def for_challenge(self, challenge):
@@ -693,6 +1214,51 @@ class DiaryEntryManager(models.Manager):
             num_comments=models.Count('diarycomment')
         )
 
+    def update_activity(self, pks=None):
+        """Recalculate the latest comments on the given diaries.
+
+        Each diary's last comment, the user who made it, the time of its
+        latest activity and its number of replies are set in one query.
+        Diaries without comments show their author and creation time. By
+        default all diaries except Pyggy's are updated.
+
+        """
+        if pks is None:
+            diaries = self.filter(is_pyggy=False)
+        else:
+            diaries = self.filter(pk__in=pks)
+        latest = DiaryComment.objects.filter(
+            diary_entry=models.OuterRef('pk'),
+        ).order_by('-created', '-pk')
+        replies = DiaryComment.objects.filter(
+            diary_entry=models.OuterRef('pk'),
+        ).order_by().values('diary_entry').annotate(
+            count=models.Count('pk'),
+        ).values('count')
+        diaries.update(
+            last_comment=models.Subquery(latest.values('pk')[:1]),
+            actor=Coalesce(
+                models.Subquery(latest.values('user')[:1]),
+                models.F('user'),
+            ),
+            activity=Coalesce(
+                models.Subquery(latest.values('created')[:1]),
+                models.F('created'),
+            ),
+            reply_count=Coalesce(models.Subquery(replies), 0),
+        )
+
+    def threads(self):
+        """Get the discussion board threads, sticky and most active first.
+
+        The id breaks ties, so that the order can be paged through by key.
+
+        """
+        return self.filter(
+            is_pyggy=False,
+            entry=None,
+        ).order_by('-sticky', '-activity', '-id')
+
 
 class DiaryEntry(models.Model):
     challenge = models.ForeignKey(
@@ -740,6 +1306,13 @@ class DiaryEntry(models.Model):
         get_latest_by = 'activity'
         ordering = ['-created', 'title']
         verbose_name_plural = "DiaryEntries"
+        indexes = [
+            models.Index(
+                fields=['-sticky', '-activity', '-id'],
+                condition=models.Q(is_pyggy=False, entry=None),
+                name='diaryentry_threads',
+            ),
+        ]
 
     def __repr__(self):
         return f'{self.title!r} by {self.user!r}'
@@ -789,6 +1362,38 @@ def file_upload_location(instance, filename):
     return os.path.join(str(instance.challenge.number), str(instance.entry.name), filename)
 
 
+class BlobManager(models.Manager):
+    def store(self, content):
+        """Store uploaded content, unless identical content is stored.
+
+        Return the Blob.
+
+        """
+        sha256, size = default_storage.save_blob(content)
+        blob, created = self.get_or_create(
+            sha256=sha256,
+            defaults={'size': size},
+        )
+        return blob
+
+
+class Blob(models.Model):
+    """Uploaded content, stored once however many files have it.
+
+    The content is named by its hash in storage; see
+    pyweek.challenge.storage.
+
+    """
+    sha256 = models.CharField(max_length=64, primary_key=True)
+    size = models.PositiveBigIntegerField()
+    created = models.DateTimeField(default=now)
+
+    objects = BlobManager()
+
+    def __str__(self):
+        return self.sha256
+
+
 class File(models.Model):
     challenge = models.ForeignKey(
         Challenge,
@@ -812,6 +1417,26 @@ class File(models.Model):
     description = models.CharField(max_length=255)
     is_final = models.BooleanField(default=False)
     is_screenshot = models.BooleanField(default=False)
+    # Space-separated thumbnail variants made, as "<width>.<format>"
+    thumb_variants = models.CharField(
+        max_length=255,
+        blank=True,
+        default='',
+        editable=False,
+    )
+    blob = models.ForeignKey(
+        Blob,
+        null=True,
+        blank=True,
+        editable=False,
+        on_delete=models.PROTECT,  # Blobs are deleted with their last File
+    )
+    # Size in bytes, so listing files doesn't need to stat them
+    size = models.PositiveBigIntegerField(
+        null=True,
+        blank=True,
+        editable=False,
+    )
 
     activity_log_events = EventRelation()
 
@@ -829,20 +1454,116 @@ class File(models.Model):
         """
         from PIL import Image
         try:
-            im = Image.open(self.content)
-            width, height = im.size
-            try:
-                im.seek(1)
-            except EOFError:
-                pass
-            else:
-                return 'animation'
+            with self.content.open('rb') as f:
+                im = Image.open(f)
+                width, height = im.size
+                try:
+                    im.seek(1)
+                except EOFError:
+                    pass
+                else:
+                    return 'animation'
             return 'screenshot' if width * height > 3e5 else 'graphic'
         except Exception:
             import traceback
             traceback.print_exc()
             return 'screenshot'
 
+    def store(self, content, filename):
+        """Store uploaded content as this file's content.
+
+        Identical content uploaded before is shared rather than stored
+        again. The file still needs saving.
+
+        """
+        self.blob = Blob.objects.store(content)
+        self.size = self.blob.size
+        name = default_storage.generate_filename(
+            file_upload_location(self, filename)
+        )
+        self.content.name = default_storage.link(self.blob.sha256, name)
+
+    def make_thumbnail(self):
+        """Write thumbnails of this screenshot, next to it in storage.
+
+        This makes the PNG thumbnail and a variant for each size in
+        THUMBNAIL_VARIANT_SIZES and each format in THUMBNAIL_FORMATS. Raise
+        IOError if the file is not an image.
+
+        """
+        from PIL import Image
+        Image.init()
+        formats = [
+            fmt for fmt, mime in THUMBNAIL_FORMATS
+            if fmt.upper() in Image.SAVE
+        ]
+        with self.content.open('rb') as f:
+            image = Image.open(f)
+            image.load()
+
+        storage = self.content.storage
+        with storage.open(self.content.name + '-thumb.png', 'wb') as f:
+            png = image.copy()
+            png.thumbnail(THUMBNAIL_SIZE)
+            png.save(f, "PNG")
+
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'transparency' in image.info
+                                  or image.mode in ('LA', 'PA') else 'RGB')
+        variants = []
+        # Largest first, so that each size is scaled from the last
+        for size in sorted(THUMBNAIL_VARIANT_SIZES, reverse=True):
+            image.thumbnail((size, size))
+            width = image.size[0]
+            for fmt in formats:
+                variant = f'{width}.{fmt}'
+                if variant in variants:
+                    continue
+                name = self.thumb_variant_name(width, fmt)
+                with storage.open(name, 'wb') as f:
+                    image.save(f, fmt.upper(), quality=80)
+                variants.append(variant)
+
+        self.thumb_width = png.size[0]
+        self.thumb_variants = ' '.join(variants)
+        self.save(update_fields=['thumb_width', 'thumb_variants'])
+
+    def thumb_variant_name(self, width, fmt):
+        return f'{self.content.name}-thumb-{width}.{fmt}'
+
+    def _thumb_variants(self):
+        for variant in self.thumb_variants.split():
+            width, fmt = variant.split('.')
+            yield int(width), fmt
+
+    def thumb_srcsets(self):
+        """Get (MIME type, srcset) pairs for the thumbnail variants."""
+        url = self.content.url
+        variants = sorted(self._thumb_variants())
+        srcsets = []
+        for fmt, mime in THUMBNAIL_FORMATS:
+            srcset = ', '.join(
+                f'{url}-thumb-{width}.{f} {width}w'
+                for width, f in variants if f == fmt
+            )
+            if srcset:
+                srcsets.append((mime, srcset))
+        return srcsets
+
+    def hero_width(self):
+        """Get the width to show this screenshot at on the entry page."""
+        return max(
+            (w for w, fmt in self._thumb_variants() if w <= HERO_WIDTH),
+            default=self.thumb_width
+        )
+
+    def delete_thumbnails(self):
+        """Delete the PNG thumbnail and all variants from storage."""
+        storage = self.content.storage
+        storage.delete(self.content.name + '-thumb.png')
+        for width, fmt in self._thumb_variants():
+            storage.delete(self.thumb_variant_name(width, fmt))
+
     def __repr__(self):
        return f'file for {self.entry!r} ({self.description!r})'
     def __str__(self):
@@ -851,8 +1572,19 @@ class File(models.Model):
     def filename(self):
         return os.path.basename(self.content.name)
 
+    @property
+    def sha256(self):
+        """The SHA-256 of the content, if it has been stored as a blob."""
+        return self.blob_id
+
+    def get_size(self):
+        """Get the size in bytes, only asking storage for old uploads."""
+        if self.size is None:
+            return self.content.size
+        return self.size
+
     def pretty_size(self):
-        size = self.content.size
+        size = self.get_size()
         unitSize= {'': 1, 'K': 1024.0, 'M': 1048576.0, 'G': 1073741824.0}
         if size < 1024:
             unit = ''
@@ -866,6 +1598,324 @@ class File(models.Model):
         return f'{sizeInUnit:0.2f} {unit}bytes'
 
 
+def file_deleted(sender, instance, **kwargs):
+    """Delete the file's blob if no other file has the same content."""
+    if instance.blob_id is None:
+        return
+    if not File.objects.filter(blob_id=instance.blob_id).exists():
+        Blob.objects.filter(pk=instance.blob_id).delete()
+        default_storage.delete_blob(instance.blob_id)
+
+post_delete.connect(file_deleted, sender=File)
+
+
+class DownloadManifestManager(models.Manager):
+    def invalidate(self, numbers):
+        """Mark the manifests of the given challenges as out of date."""
+        self.filter(pk__in=numbers).update(
+            version=models.F('version') + 1,
+            content='',
+            etag='',
+        )
+
+    def for_challenge(self, challenge):
+        """Get the challenge's manifest, rebuilding it if it is out of date.
+
+        A rebuilt manifest is only saved if it wasn't invalidated while it
+        was being built.
+
+        """
+        manifest, _ = self.get_or_create(challenge=challenge)
+        if manifest.content:
+            return manifest
+
+        version = manifest.version
+        manifest.content = json.dumps(build_manifest(challenge))
+        manifest.etag = hashlib.sha256(manifest.content.encode()).hexdigest()
+        manifest.modified = now()
+        self.filter(pk=manifest.pk, version=version).update(
+            content=manifest.content,
+            etag=manifest.etag,
+            modified=manifest.modified,
+        )
+        return manifest
+
+
+def build_manifest(challenge):
+    """List the final downloads of each entry in a challenge."""
+    entries = Entry.objects.filter(
+        challenge=challenge,
+        has_final=True,
+    ).prefetch_related(
+        models.Prefetch(
+            'file_set',
+            queryset=File.objects.filter(
+                is_final=True,
+                is_screenshot=False,
+            ).order_by('pk'),
+        )
+    ).order_by('name')
+    return {
+        e.game or e.title: [
+            {
+                'name': posixpath.basename(f.content.name),
+                'url': f.content.url,
+                'size': f.get_size(),
+                'sha256': f.sha256,
+            }
+            for f in e.file_set.all()
+        ]
+        for e in entries
+    }
+
+
+class DownloadManifest(models.Model):
+    """The list of final downloads for a challenge, as served to the CLI.
+
+    The manifest is invalidated whenever an entry or its files change, and
+    rebuilt when it is next requested. Each invalidation bumps the version.
+
+    """
+    challenge = models.OneToOneField(
+        Challenge,
+        primary_key=True,
+        on_delete=models.CASCADE,  # manifests describe the challenge
+    )
+    version = models.PositiveIntegerField(default=0)
+    content = models.TextField(blank=True)
+    etag = models.CharField(max_length=64, blank=True)
+    modified = models.DateTimeField(null=True)
+
+    objects = DownloadManifestManager()
+
+    def __repr__(self):
+        return f'<Download manifest for {self.challenge_id!r}>'
+
+
+def downloads_changed(sender, instance, raw=False, **kwargs):
+    """Invalidate the download manifest when an entry or download changes."""
+    if raw or getattr(instance, 'is_screenshot', False):
+        return
+    DownloadManifest.objects.invalidate([instance.challenge_id])
+
+post_save.connect(downloads_changed, sender=Entry)
+post_delete.connect(downloads_changed, sender=Entry)
+post_save.connect(downloads_changed, sender=File)
+post_delete.connect(downloads_changed, sender=File)
+
+
+class ThumbnailJobManager(models.Manager):
+    def process(self, limit=None):
+        """Make thumbnails for queued screenshots, oldest first.
+
+        Jobs are locked while they run, so several workers can process the
+        queue at once. Return the number of jobs processed.
+
+        """
+        done = 0
+        while limit is None or done < limit:
+            with transaction.atomic():
+                job = self.select_for_update(skip_locked=True).order_by(
+                    'created'
+                ).first()
+                if job is None:
+                    break
+                job.run()
+                job.delete()
+            done += 1
+        return done
+
+
+class ThumbnailJob(models.Model):
+    """A screenshot waiting for its thumbnail to be made.
+
+    Uploads queue these rather than decoding images during the request;
+    the make_thumbnails command processes the queue.
+
+    """
+    file = models.OneToOneField(
+        File,
+        primary_key=True,
+        on_delete=models.CASCADE,
+    )
+    created = models.DateTimeField(default=now)
+
+    objects = ThumbnailJobManager()
+
+    def __str__(self):
+        return f'thumbnail for {self.file}'
+
+    def run(self):
+        """Make the thumbnail and announce the new screenshot.
+
+        Any error making the thumbnail is logged rather than raised, so
+        that the job is still dropped and can't hold up the queue.
+
+        """
+        file = self.file
+        try:
+            with transaction.atomic():
+                file.make_thumbnail()
+        except Exception:
+            logger.exception(
+                "Can't make a thumbnail for %s", file.content.name
+            )
+            return
+
+        entry = file.entry
+        log_event(
+            type='new-screenshot',
+            user=file.user,
+            target=file,
+            challenge=file.challenge_id,
+            game=entry.display_title,
+            name=entry.name,
+            description=file.description,
+            role=file.get_image_role(),
+        )
+
+
+class FileChecksumManager(models.Manager):
+    def match(self, entry, content):
+        """Find the entry's outstanding checksum that matches content.
+
+        The content is hashed reading it in chunks. Return None if there's
+        no match.
+
+        """
+        md5 = hashlib.md5()
+        for chunk in content.chunks():
+            md5.update(chunk)
+        return self.filter(
+            entry=entry,
+            md5=md5.hexdigest(),
+            file__isnull=True,
+        ).first()
+
+
+class FileChecksum(models.Model):
+    """The MD5 of a final entry registered just before the deadline.
+
+    Rather than everyone uploading at the last minute, teams may register
+    the checksum of their final entry in the last hours (see
+    Challenge.isChecksumTime) and upload the file in the following days.
+
+    """
+    entry = models.ForeignKey(Entry, on_delete=models.CASCADE)
+    user = models.ForeignKey(
+        User,
+        null=True,
+        on_delete=models.SET_NULL,  # The checksum is the whole team's
+    )
+    md5 = models.CharField(
+        max_length=32,
+        validators=[validators.RegexValidator(r'^[0-9a-f]{32}$')],
+    )
+    description = models.CharField(max_length=255)
+    created = models.DateTimeField(default=now)
+    # The uploaded file, once it has arrived
+    file = models.OneToOneField(
+        File,
+        null=True,
+        blank=True,
+        on_delete=models.SET_NULL,
+    )
+
+    objects = FileChecksumManager()
+
+    class Meta:
+        ordering = ['created']
+
+    def __str__(self):
+        return f'{self.md5} for {self.entry}'
+
+
+def make_upload_token():
+    return secrets.token_urlsafe(32)
+
+
+class UploadSessionManager(models.Manager):
+    def expired(self):
+        """Get sessions that have been left unfinished for too long."""
+        cutoff = now() - datetime.timedelta(hours=UPLOAD_SESSION_HOURS)
+        return self.filter(created__lt=cutoff)
+
+
+class UploadSession(models.Model):
+    """A file being uploaded in chunks.
+
+    Chunks are appended to a partial file outside MEDIA_ROOT as they
+    arrive, so a client that loses its connection can find out how much
+    was received and carry on from there. The File is created when the
+    upload is finished and its checksum verified.
+
+    """
+    token = models.CharField(
+        max_length=64,
+        primary_key=True,
+        default=make_upload_token,
+        editable=False,
+    )
+    entry = models.ForeignKey(Entry, on_delete=models.CASCADE)
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    filename = models.CharField(max_length=255)
+    description = models.CharField(max_length=255)
+    is_final = models.BooleanField(default=False)
+    is_screenshot = models.BooleanField(default=False)
+    size = models.PositiveBigIntegerField()
+    received = models.PositiveBigIntegerField(default=0)
+    created = models.DateTimeField(default=now)
+
+    objects = UploadSessionManager()
+
+    def __str__(self):
+        return f'upload of {self.filename} to {self.entry}'
+
+    @property
+    def path(self):
+        """The path of the partial file."""
+        directory = os.path.join(
+            settings.FILE_UPLOAD_TEMP_DIR or tempfile.gettempdir(),
+            'pyweek-uploads',
+        )
+        return os.path.join(directory, self.token)
+
+    def append(self, chunk_iter):
+        """Append chunks of bytes to the partial file.
+
+        The caller must hold a lock on this session's row. Return the number
+        of bytes received in total.
+
+        """
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, 'ab') as f:
+            # Discard anything written by an earlier, interrupted request
+            f.truncate(self.received)
+            for chunk in chunk_iter:
+                if self.received + len(chunk) > self.size:
+                    raise ValueError("Upload is larger than declared")
+                f.write(chunk)
+                self.received += len(chunk)
+        self.save(update_fields=['received'])
+        return self.received
+
+    def checksum(self):
+        """Get the SHA-256 of the partial file, reading it in blocks."""
+        digest = hashlib.sha256()
+        with open(self.path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 16), b''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def discard(self):
+        """Delete the session and its partial file."""
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+        self.delete()
+
+
 def award_upload_location(instance, filename):
     return os.path.join('awards', str(instance.creator.id), filename)
 
@@ -0,0 +1,270 @@
+"""Statistics over the ratings of a challenge, for analysis after judging.
+
+load_ratings() reads all the ratings of a challenge in one query into
+columns, and challenge_stats() works out from them:
+
+* the distribution of scores in each category,
+* each judge's offset: how far above or below the entry's mean their
+  scores were, on average,
+* each entry's mean scores with a 95% confidence interval, and its
+  normalised scores.
+
+Normalised scores come from fit_judge_offsets(), which fits the judges'
+offsets and the entries' scores together; they are the same scores that
+generate_tallies() stores in each entry's RatingTally.
+
+Non-working ratings have no scores and are left out of all but the counts.
+Ratings by deleted users have no judge, so count as having no offset.
+"""
+import math
+import statistics
+from collections import defaultdict
+
+from .models import Rating
+
+
+CATEGORIES = ('fun', 'innovation', 'production')
+
+# Normal critical value for a two-sided 95% confidence interval
+Z_95 = 1.96
+
+# Limits on fitting judge offsets by least squares
+FIT_ITERATIONS = 50
+FIT_TOLERANCE = 1e-6
+
+# Number of ratings at the entries' scores that each judge is assumed to
+# have made, to shrink the fitted offsets of judges with few ratings
+OFFSET_PRIOR = 3
+
+
+class RatingColumns:
+    """The ratings of a challenge, one list per field."""
+
+    def __init__(self, rows):
+        (self.entries, self.judges, fun, innovation, production,
+         self.nonworking, self.disqualify) = (
+            map(list, zip(*rows)) if rows else ([] for _ in range(7))
+        )
+        self.scores = dict(zip(CATEGORIES, (fun, innovation, production)))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def working(self):
+        """Get the indexes of the ratings that have scores."""
+        return [i for i, nw in enumerate(self.nonworking) if not nw]
+
+
+def load_ratings(challenge, finals_only=False):
+    """Load the ratings of a challenge as RatingColumns.
+
+    Pass finals_only=True for only the ratings of entries with a final
+    upload, as are tallied.
+
+    """
+    ratings = Rating.objects.filter(entry__challenge=challenge)
+    if finals_only:
+        ratings = ratings.filter(entry__has_final=True)
+    rows = ratings.order_by('entry', 'pk').values_list(
+        'entry', 'user__username', *CATEGORIES, 'nonworking', 'disqualify',
+    )
+    return RatingColumns(list(rows))
+
+
+def distributions(cols):
+    """Count the working ratings giving each score, in each category."""
+    working = cols.working()
+    dists = {}
+    for cat in CATEGORIES:
+        counts = [0] * 5
+        for i in working:
+            counts[cols.scores[cat][i] - 1] += 1
+        dists[cat] = counts
+    return dists
+
+
+def entry_means(cols, offsets=None):
+    """Get each entry's mean score in each category.
+
+    If judge offsets are given, they are taken off each score first.
+
+    """
+    totals = defaultdict(lambda: dict.fromkeys(CATEGORIES, 0.0))
+    counts = defaultdict(int)
+    for i in cols.working():
+        entry = cols.entries[i]
+        offset = offsets.get(cols.judges[i], {}) if offsets else {}
+        for cat in CATEGORIES:
+            totals[entry][cat] += cols.scores[cat][i] - offset.get(cat, 0.0)
+        counts[entry] += 1
+    return {
+        entry: {cat: t / counts[entry] for cat, t in cat_totals.items()}
+        for entry, cat_totals in totals.items()
+    }
+
+
+def judge_offsets(cols, means=None):
+    """Get how far each judge scored above the entries' means, on average.
+
+    Return a dict of {judge: {category: offset}}, with the number of
+    working ratings the judge made as 'n'.
+
+    """
+    if means is None:
+        means = entry_means(cols)
+    totals = defaultdict(lambda: dict.fromkeys(CATEGORIES, 0.0))
+    counts = defaultdict(int)
+    for i in cols.working():
+        judge = cols.judges[i]
+        if judge is None:
+            continue
+        mean = means[cols.entries[i]]
+        for cat in CATEGORIES:
+            totals[judge][cat] += cols.scores[cat][i] - mean[cat]
+        counts[judge] += 1
+    return {
+        judge: {
+            **{cat: t / counts[judge] for cat, t in cat_totals.items()},
+            'n': counts[judge],
+        }
+        for judge, cat_totals in totals.items()
+    }
+
+
+def fit_judge_offsets(cols, iterations=FIT_ITERATIONS,
+                      tolerance=FIT_TOLERANCE):
+    """Fit each score as the entry's true score plus the judge's offset.
+
+    This is a least squares fit, solved by alternately taking the entry
+    scores as the mean of their ratings less the judges' offsets, and the
+    offsets as the mean of the judges' ratings less the entry scores.
+    Offsets are shrunk towards zero as if each judge had made OFFSET_PRIOR
+    more ratings at the entries' scores, so that judges who rated only a
+    few entries aren't taken to be harsh or generous, and they are
+    centred so that on average they add nothing.
+
+    Return (offsets, scores) as dicts of {judge: {category: offset}} and
+    {entry: {category: score}}.
+
+    """
+    working = [
+        (cols.entries[i], cols.judges[i],
+         [cols.scores[cat][i] for cat in CATEGORIES])
+        for i in cols.working()
+    ]
+    rated = [(j, s) for _, j, s in working if j is not None]
+    offsets = {j: [0.0] * len(CATEGORIES) for j, _ in rated}
+    counts = defaultdict(int)
+    for j, _ in rated:
+        counts[j] += 1
+
+    def entry_scores(offsets):
+        totals = defaultdict(lambda: [0.0] * len(CATEGORIES))
+        n = defaultdict(int)
+        for e, j, s in working:
+            off = offsets.get(j)
+            t = totals[e]
+            for k, v in enumerate(s):
+                t[k] += v - (off[k] if off else 0.0)
+            n[e] += 1
+        return {e: [v / n[e] for v in t] for e, t in totals.items()}
+
+    for _ in range(iterations):
+        scores = entry_scores(offsets)
+
+        residuals = {j: [0.0] * len(CATEGORIES) for j in offsets}
+        for e, j, s in working:
+            if j is None:
+                continue
+            r = residuals[j]
+            for k, v in enumerate(s):
+                r[k] += v - scores[e][k]
+        new = {
+            j: [v / (counts[j] + OFFSET_PRIOR) for v in r]
+            for j, r in residuals.items()
+        }
+        total = sum(counts.values())
+        for k in range(len(CATEGORIES) if total else 0):
+            mean = sum(new[j][k] * counts[j] for j in new) / total
+            for off in new.values():
+                off[k] -= mean
+
+        change = max(
+            (abs(a - b) for j in new for a, b in zip(new[j], offsets[j])),
+            default=0,
+        )
+        offsets = new
+        if change < tolerance:
+            break
+
+    # Score the entries with the offsets returned, even if they didn't settle
+    scores = entry_scores(offsets)
+    return (
+        {j: dict(zip(CATEGORIES, off)) for j, off in offsets.items()},
+        {e: dict(zip(CATEGORIES, sc)) for e, sc in scores.items()},
+    )
+
+
+def confidence_interval(values):
+    """Get the mean of some scores and the half-width of its 95% interval.
+
+    The half-width is None for fewer than two scores.
+
+    """
+    mean = statistics.fmean(values)
+    if len(values) < 2:
+        return mean, None
+    return mean, Z_95 * statistics.stdev(values) / math.sqrt(len(values))
+
+
+def challenge_stats(challenge, cols=None):
+    """Work out the rating statistics of a challenge.
+
+    By default only the ratings that are tallied, of entries with a final
+    upload, are included.
+
+    """
+    if cols is None:
+        cols = load_ratings(challenge, finals_only=True)
+    means = entry_means(cols)
+    offsets = judge_offsets(cols, means)
+    _, normalised = fit_judge_offsets(cols)
+
+    scores = defaultdict(lambda: {cat: [] for cat in CATEGORIES})
+    for i in cols.working():
+        for cat in CATEGORIES:
+            scores[cols.entries[i]][cat].append(cols.scores[cat][i])
+    num_ratings = defaultdict(int)
+    num_nonworking = defaultdict(int)
+    num_disqualify = defaultdict(int)
+    for entry, nw, dq in zip(cols.entries, cols.nonworking, cols.disqualify):
+        num_ratings[entry] += 1
+        num_nonworking[entry] += nw
+        num_disqualify[entry] += dq
+
+    entries = {}
+    for entry in sorted(num_ratings):
+        stats = {
+            'ratings': num_ratings[entry],
+            'nonworking': num_nonworking[entry],
+            'disqualify': num_disqualify[entry],
+        }
+        for cat in CATEGORIES:
+            if entry in means:
+                mean, ci = confidence_interval(scores[entry][cat])
+                stats[cat] = {
+                    'mean': mean,
+                    'ci': ci,
+                    'normalised': normalised[entry][cat],
+                }
+            else:
+                stats[cat] = None
+        entries[entry] = stats
+
+    return {
+        'challenge': challenge.number,
+        'ratings': len(cols),
+        'distributions': distributions(cols),
+        'judges': offsets,
+        'entries': entries,
+    }
@@ -0,0 +1,49 @@
+"""Stable per-user orderings of a challenge's entries.
+
+Judges see the entries in a different order from each other, so that the
+entries listed first don't get all the ratings, but each judge sees the
+same order every time. The order is a sort by a hash of the judge and the
+entry, keyed with the site's secret so that entrants can't work out where
+their entry appears for a given judge.
+
+During judging, entries with the fewest ratings are listed first, so that
+ratings are spread evenly; judges see the entries that are equally short
+of ratings in their own order. The counts come from the running totals
+kept in each entry's rating tally as ratings arrive.
+
+Sort keys are a pure function of the user and entry, so they are the same
+in every worker and thread and need no state or cache.
+"""
+import hashlib
+import hmac
+
+from django.conf import settings
+
+
+def order_key(user, name):
+    """Get the sort key of the entry with the given name for the user.
+
+    Anonymous users all share one ordering.
+
+    """
+    msg = f'{user.username}\0{name}'.encode()
+    return hmac.new(
+        settings.SECRET_KEY.encode(), msg, hashlib.sha256
+    ).digest()[:8]
+
+
+def shuffled(items, user, name=lambda item: item.name):
+    """Get a list of entries (or details of them) in the user's order."""
+    return sorted(items, key=lambda item: order_key(user, name(item)))
+
+
+def by_fewest_ratings(items, user, num_ratings, name=lambda item: item.name):
+    """Get a list of entries in the order they most need rating.
+
+    Entries with equal numbers of ratings are in the user's order.
+
+    """
+    return sorted(
+        items,
+        key=lambda item: (num_ratings(item), order_key(user, name(item)))
+    )
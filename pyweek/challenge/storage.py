@@ -0,0 +1,110 @@
+"""File storage that keeps identical uploads once.
+
+Uploaded content is stored as a blob named by its SHA-256 under BLOB_DIR,
+and each file's usual name (such as "<challenge>/<entry>/<filename>") is a
+hard link to its blob. URLs are unchanged, but re-uploads of the same
+archive or screenshot take no more disk space.
+"""
+import hashlib
+import os
+import tempfile
+
+from django.conf import settings
+from django.core.files.storage import FileSystemStorage
+
+
+# Directory under MEDIA_ROOT that holds the blobs
+BLOB_DIR = 'blobs'
+
+BLOCK_SIZE = 1 << 16
+
+
+def blob_name(sha256):
+    """Get the storage name of the blob with the given hash."""
+    return os.path.join(BLOB_DIR, sha256[:2], sha256[2:4], sha256)
+
+
+class BlobStorage(FileSystemStorage):
+    """Filesystem storage with content-addressed blobs."""
+
+    def save_blob(self, content):
+        """Store content as a blob, unless it is stored already.
+
+        The content is hashed as it is written, reading it in chunks.
+        Return its SHA-256 and size.
+
+        """
+        directory = self.path(BLOB_DIR)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=directory)
+        try:
+            digest = hashlib.sha256()
+            size = 0
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in content.chunks():
+                    digest.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+            sha256 = digest.hexdigest()
+            path = self.path(blob_name(sha256))
+            if os.path.exists(path):
+                os.remove(tmp)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(tmp, path)
+                if settings.FILE_UPLOAD_PERMISSIONS is not None:
+                    os.chmod(path, settings.FILE_UPLOAD_PERMISSIONS)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        return sha256, size
+
+    def link(self, sha256, name):
+        """Give the blob with the given hash another name.
+
+        As with save(), the name is altered if it is taken. Return the name
+        used.
+
+        """
+        source = self.path(blob_name(sha256))
+        name = self.get_available_name(name)
+        while True:
+            path = self.path(name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            try:
+                os.link(source, path)
+            except FileExistsError:
+                # Taken since we checked
+                name = self.get_available_name(name)
+            else:
+                return name
+
+    def adopt(self, name):
+        """Make an existing file share a blob with identical content.
+
+        If there is no such blob yet, the file becomes one. Return the
+        file's SHA-256 and size.
+
+        """
+        path = self.path(name)
+        digest = hashlib.sha256()
+        size = 0
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(BLOCK_SIZE), b''):
+                digest.update(block)
+                size += len(block)
+        sha256 = digest.hexdigest()
+
+        blob = self.path(blob_name(sha256))
+        if not os.path.exists(blob):
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            os.link(path, blob)
+        elif not os.path.samefile(blob, path):
+            tmp = path + '.dedupe'
+            os.link(blob, tmp)
+            os.replace(tmp, path)
+        return sha256, size
+
+    def delete_blob(self, sha256):
+        self.delete(blob_name(sha256))
@@ -2,16 +2,25 @@
 
 from __future__ import annotations
 
+import hashlib
 import io
 import os
+import tarfile
 import tempfile
+from datetime import date, timedelta
+from unittest import mock
 from PIL import Image
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
 from django.core.files.uploadedfile import SimpleUploadedFile
-from django.db import connection
+from django.core.management import call_command
 from django.test import TestCase, override_settings
 
-from pyweek.challenge.models import Award, DiaryEntry, EntryAward, File
+from pyweek.activity.models import Event
+from pyweek.challenge import archive, models
+from pyweek.challenge.models import Award, Blob, Challenge, DiaryEntry, Entry, EntryAward, File, FileChecksum, ThumbnailJob, UploadSession
+from pyweek.challenge.storage import blob_name
 
 
 class ChallengeSmokeTests(TestCase):
@@ -71,9 +80,7 @@ class ChallengeSmokeTests(TestCase):
         self._assert_status("/stats/")
 
     def test_stats_json_renders(self) -> None:
-        """Stats JSON endpoint responds with success on PostgreSQL."""
-        if connection.vendor != "postgresql":
-            self.skipTest("stats.json uses PostgreSQL-specific SQL")
+        """Stats JSON endpoint responds with success."""
         self._assert_status("/stats.json")
 
     def test_all_games_page_renders(self) -> None:
@@ -188,10 +195,394 @@ class ChallengeSmokeTests(TestCase):
         self.assertEqual(response.status_code, 302)
         uploaded_file = File.objects.get(entry_id="smoke-entry", description="Gameplay screenshot")
         self.assertTrue(uploaded_file.is_screenshot)
+        self.assertEqual(uploaded_file.thumb_width, 0)
+
+        self.assertEqual(ThumbnailJob.objects.process(), 1)
+        uploaded_file.refresh_from_db()
         self.assertGreater(uploaded_file.thumb_width, 0)
+        event = Event.objects.get(type="new-screenshot", target_id=uploaded_file.id)
+        self.assertEqual(event.params["role"], "screenshot")
         thumb_path = os.path.join(self._temp_media.name, f"{uploaded_file.content.name}-thumb.png")
         self.assertTrue(os.path.exists(thumb_path))
 
+    def test_screenshot_image_role(self) -> None:
+        """Small still screenshots are announced as graphics."""
+        self._login("smoke_owner")
+        self.client.post(
+            "/e/smoke-entry/upload/",
+            {
+                "content": self._make_png_upload("logo.png", (200, 150)),
+                "description": "Logo",
+                "is_screenshot": "on",
+            },
+        )
+        ThumbnailJob.objects.process()
+        uploaded_file = File.objects.get(description="Logo")
+        event = Event.objects.get(type="new-screenshot", target_id=uploaded_file.id)
+        self.assertEqual(event.params["role"], "graphic")
+
+    def test_failed_thumbnail_doesnt_block_queue(self) -> None:
+        """A screenshot whose thumbnail can't be made is dropped from the queue."""
+        self._login("smoke_owner")
+        for description in ("Bomb", "Fine"):
+            self.client.post(
+                "/e/smoke-entry/upload/",
+                {
+                    "content": self._make_png_upload(f"{description}.png", (200, 150)),
+                    "description": description,
+                    "is_screenshot": "on",
+                },
+            )
+        make_thumbnail = File.make_thumbnail
+
+        def fail_on_bomb(file):
+            if file.description == "Bomb":
+                raise Image.DecompressionBombError("too big")
+            make_thumbnail(file)
+
+        with mock.patch.object(File, "make_thumbnail", autospec=True, side_effect=fail_on_bomb):
+            with self.assertLogs("pyweek.challenge.models", "ERROR") as logs:
+                self.assertEqual(ThumbnailJob.objects.process(), 2)
+        self.assertIn("Bomb.png", logs.output[0])
+        self.assertFalse(ThumbnailJob.objects.exists())
+        self.assertEqual(File.objects.get(description="Bomb").thumb_width, 0)
+        self.assertGreater(File.objects.get(description="Fine").thumb_width, 0)
+
+    def test_backfill_survives_bad_screenshot(self) -> None:
+        """Backfilling carries on past a screenshot PIL can't handle."""
+        self._login("smoke_owner")
+        for description in ("Bomb", "Fine"):
+            self.client.post(
+                "/e/smoke-entry/upload/",
+                {
+                    "content": self._make_png_upload(f"{description}.png", (200, 150)),
+                    "description": description,
+                    "is_screenshot": "on",
+                },
+            )
+        ThumbnailJob.objects.process()
+        File.objects.update(thumb_variants="")
+        make_thumbnail = File.make_thumbnail
+
+        def fail_on_bomb(file):
+            if file.description == "Bomb":
+                raise Image.DecompressionBombError("too big")
+            make_thumbnail(file)
+
+        with mock.patch.object(File, "make_thumbnail", autospec=True, side_effect=fail_on_bomb):
+            with mock.patch("sys.stdout", io.StringIO()) as out:
+                call_command("make_thumbnails", backfill=True)
+        self.assertIn("for 1 screenshots", out.getvalue())
+        self.assertNotEqual(File.objects.get(description="Fine").thumb_variants, "")
+
+    def test_screenshot_thumbnail_variants(self) -> None:
+        """Screenshots get compressed thumbnails in several sizes."""
+        self._login("smoke_owner")
+        self.client.post(
+            "/e/smoke-entry/upload/",
+            {
+                "content": self._make_png_upload("wide.png", (800, 600)),
+                "description": "Wide screenshot",
+                "is_screenshot": "on",
+            },
+        )
+        ThumbnailJob.objects.process()
+        uploaded_file = File.objects.get(description="Wide screenshot")
+        self.assertEqual(uploaded_file.thumb_variants, "600.webp 300.webp 150.webp")
+        for width in (150, 300, 600):
+            path = os.path.join(self._temp_media.name, uploaded_file.thumb_variant_name(width, "webp"))
+            with Image.open(path) as image:
+                self.assertEqual(image.format, "WEBP")
+                self.assertEqual(image.size[0], width)
+        self.assertEqual(uploaded_file.hero_width(), 300)
+
+        response = self.client.get("/e/smoke-entry/")
+        self.assertContains(response, 'type="image/webp"')
+        self.assertContains(response, f"{uploaded_file.content.url}-thumb-600.webp 600w")
+
+        self.client.post(f"/e/smoke-entry/delete/{uploaded_file.content.name}", {"confirm": "yes"})
+        self.assertFalse(os.path.exists(path))
+
+    def test_screenshot_must_be_an_image(self) -> None:
+        """Screenshots that aren't images are rejected during the upload."""
+        self._login("smoke_owner")
+        self.client.post(
+            "/e/smoke-entry/upload/",
+            {
+                "content": SimpleUploadedFile("notes.png", b"not an image", content_type="image/png"),
+                "description": "Not a screenshot",
+                "is_screenshot": "on",
+            },
+        )
+        self.assertFalse(File.objects.filter(description="Not a screenshot").exists())
+        self.assertFalse(ThumbnailJob.objects.exists())
+
+    def test_oneshot_screenshot_must_be_an_image(self) -> None:
+        """The upload script's screenshots must be images too."""
+        response = self.client.post(
+            "/e/smoke-entry/oup/",
+            {
+                "version": "2",
+                "user": "smoke_owner",
+                "password": "password",
+                "content_file": SimpleUploadedFile("notes.png", b"not an image", content_type="image/png"),
+                "description": "Not a screenshot",
+                "is_screenshot": "yes",
+            },
+        )
+        self.assertEqual(response.content, b"File is not an image")
+        self.assertFalse(File.objects.filter(description="Not a screenshot").exists())
+        self.assertFalse(ThumbnailJob.objects.exists())
+
+    def _put_chunk(self, url: str, data: bytes, start: int, total: int):
+        """PUT one chunk of a chunked upload."""
+        return self.client.put(
+            url,
+            data,
+            content_type="application/octet-stream",
+            HTTP_CONTENT_RANGE=f"bytes {start}-{start + len(data) - 1}/{total}",
+        )
+
+    def test_chunked_upload(self) -> None:
+        """Large files can be uploaded in chunks and resumed."""
+        self._login("smoke_owner")
+        content = os.urandom(3000)
+        with override_settings(FILE_UPLOAD_TEMP_DIR=self._temp_media.name):
+            response = self.client.post(
+                "/e/smoke-entry/uploads/",
+                {"filename": "game.zip", "size": len(content), "description": "Chunked", "is_final": "on"},
+            )
+            self.assertEqual(response.status_code, 201)
+            url = response.json()["url"]
+
+            self.assertEqual(self._put_chunk(url, content[:1000], 0, 3000).json()["received"], 1000)
+            # A chunk that doesn't follow on from what we have is refused
+            response = self._put_chunk(url, content[2000:], 2000, 3000)
+            self.assertEqual(response.status_code, 409)
+            self.assertEqual(self.client.get(url).json()["received"], 1000)
+            self._put_chunk(url, content[1000:], 1000, 3000)
+
+            response = self.client.post(url + "finish", {"sha256": hashlib.sha256(content).hexdigest()})
+            self.assertEqual(response.status_code, 201)
+
+        uploaded_file = File.objects.get(entry_id="smoke-entry", description="Chunked")
+        self.assertTrue(uploaded_file.is_final)
+        with uploaded_file.content.open("rb") as f:
+            self.assertEqual(f.read(), content)
+        self.assertFalse(UploadSession.objects.exists())
+
+    def test_chunked_upload_bad_checksum(self) -> None:
+        """Chunked uploads are discarded if the checksum doesn't match."""
+        self._login("smoke_owner")
+        with override_settings(FILE_UPLOAD_TEMP_DIR=self._temp_media.name):
+            response = self.client.post(
+                "/e/smoke-entry/uploads/",
+                {"filename": "game.zip", "size": 4, "description": "Corrupt"},
+            )
+            url = response.json()["url"]
+            self._put_chunk(url, b"data", 0, 4)
+            response = self.client.post(url + "finish", {"sha256": hashlib.sha256(b"date").hexdigest()})
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(File.objects.filter(description="Corrupt").exists())
+        self.assertFalse(UploadSession.objects.exists())
+
+    def _upload(self, name: str, content: bytes, description: str):
+        """Upload a file to the smoke entry."""
+        return self.client.post(
+            "/e/smoke-entry/upload/",
+            {
+                "content": SimpleUploadedFile(name, content, content_type="application/zip"),
+                "description": description,
+            },
+        )
+
+    def test_identical_uploads_stored_once(self) -> None:
+        """Uploads with the same content share a blob until both are deleted."""
+        self._login("smoke_owner")
+        self._upload("v1.zip", b"same bytes", "First")
+        self._upload("v2.zip", b"same bytes", "Second")
+        first = File.objects.get(description="First")
+        second = File.objects.get(description="Second")
+        self.assertEqual(first.blob_id, hashlib.sha256(b"same bytes").hexdigest())
+        self.assertEqual(first.blob_id, second.blob_id)
+        self.assertEqual(first.blob.size, 10)
+        self.assertTrue(os.path.samefile(first.content.path, second.content.path))
+        with second.content.open("rb") as f:
+            self.assertEqual(f.read(), b"same bytes")
+
+        blob_path = os.path.join(self._temp_media.name, blob_name(first.blob_id))
+        self.client.post(f"/e/smoke-entry/delete/{first.content.name}", {"confirm": "yes"})
+        self.assertTrue(os.path.exists(blob_path))
+        self.client.post(f"/e/smoke-entry/delete/{second.content.name}", {"confirm": "yes"})
+        self.assertFalse(os.path.exists(blob_path))
+        self.assertFalse(Blob.objects.exists())
+
+    def test_downloads_use_stored_size(self) -> None:
+        """Sizes and hashes are recorded at upload, so listing doesn't stat files."""
+        self._login("smoke_owner")
+        self.client.post(
+            "/e/smoke-entry/upload/",
+            {
+                "content": SimpleUploadedFile("final.zip", b"final bytes", content_type="application/zip"),
+                "description": "Final",
+                "is_final": "on",
+            },
+        )
+        uploaded_file = File.objects.get(description="Final")
+        self.assertEqual(uploaded_file.size, 11)
+        self.assertEqual(uploaded_file.sha256, hashlib.sha256(b"final bytes").hexdigest())
+
+        os.remove(uploaded_file.content.path)
+        downloads = self.client.get("/99/downloads.json").json()
+        self.assertEqual(downloads["Smoke Game"], [{
+            "name": "final.zip",
+            "url": uploaded_file.content.url,
+            "size": 11,
+            "sha256": uploaded_file.sha256,
+        }])
+
+    def _upload_final(self, name: str, content: bytes) -> File:
+        """Upload a final file to the smoke entry."""
+        self.client.post(
+            "/e/smoke-entry/upload/",
+            {
+                "content": SimpleUploadedFile(name, content, content_type="application/zip"),
+                "description": name,
+                "is_final": "on",
+            },
+        )
+        return File.objects.get(description=name)
+
+    def test_archive_streams_final_files(self) -> None:
+        """The challenge archive is a tar of the final downloads."""
+        self._login("smoke_owner")
+        self._upload_final("game.zip", b"game" * 1000)
+        self._upload_final("source.zip", b"source")
+        self._upload("notes.txt", b"not final", "Notes")
+
+        response = self.client.get("/99/archive.tar")
+        body = b"".join(response.streaming_content)
+        self.assertEqual(int(response["Content-Length"]), len(body))
+        with tarfile.open(fileobj=io.BytesIO(body)) as tar:
+            self.assertEqual(
+                tar.getnames(),
+                ["pyweek99/smoke-entry/game.zip", "pyweek99/smoke-entry/source.zip"],
+            )
+            self.assertEqual(tar.extractfile("pyweek99/smoke-entry/source.zip").read(), b"source")
+
+        response = self.client.get("/99/archive.tar", HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, 304)
+
+    def test_archive_missing_file(self) -> None:
+        """Files missing from storage don't truncate the archive."""
+        self._login("smoke_owner")
+        missing = self._upload_final("game.zip", b"game")
+        self._upload_final("source.zip", b"source")
+        os.remove(os.path.join(self._temp_media.name, missing.content.name))
+
+        response = self.client.get("/99/archive.tar")
+        body = b"".join(response.streaming_content)
+        self.assertEqual(int(response["Content-Length"]), len(body))
+        with tarfile.open(fileobj=io.BytesIO(body)) as tar:
+            self.assertEqual(tar.getnames(), ["pyweek99/smoke-entry/source.zip"])
+
+        # A file going missing while the archive is sent is zero-filled
+        members = archive.archive_members(Challenge.objects.get(number=99))
+        source = members[0][1]
+        os.remove(os.path.join(self._temp_media.name, source.content.name))
+        body = b"".join(archive.stream_tar(members))
+        self.assertEqual(archive.archive_length(members), len(body))
+        with tarfile.open(fileobj=io.BytesIO(body)) as tar:
+            self.assertEqual(tar.extractfile("pyweek99/smoke-entry/source.zip").read(), b"\0" * 6)
+
+    def test_build_archives(self) -> None:
+        """Stored archives are served from storage and seeded by a torrent."""
+        self._login("smoke_owner")
+        self._upload_final("game.zip", b"game")
+        call_command("build_archives", "99", stdout=io.StringIO())
+
+        challenge = Challenge.objects.get(number=99)
+        self.assertTrue(challenge.torrent_url.endswith(".torrent"))
+        response = self.client.get("/99/archive.tar")
+        self.assertEqual(response.status_code, 302)
+        name = response.url[len(settings.MEDIA_URL):]
+        with open(os.path.join(self._temp_media.name, name), "rb") as f:
+            tar = f.read()
+        torrent_name = challenge.torrent_url[len(settings.MEDIA_URL):]
+        with open(os.path.join(self._temp_media.name, torrent_name), "rb") as f:
+            torrent = f.read()
+        self.assertIn(b"6:lengthi%de" % len(tar), torrent)
+        self.assertIn(hashlib.sha1(tar).digest(), torrent)
+
+        # A new upload makes a new archive, replacing the old one
+        self._upload_final("game-1.1.zip", b"better game")
+        call_command("build_archives", "99", stdout=io.StringIO())
+        self.assertFalse(os.path.exists(os.path.join(self._temp_media.name, name)))
+        self.assertNotEqual(self.client.get("/99/archive.tar").url, response.url)
+
+    def test_duplicate_filename_refused(self) -> None:
+        """A second upload with the same filename is refused."""
+        self._login("smoke_owner")
+        self._upload("game.zip", b"one", "One")
+        response = self._upload("game.zip", b"two", "Two")
+        self.assertContains(response, "File with that filename already exists.")
+        self.assertFalse(File.objects.filter(description="Two").exists())
+
+    def test_dedupe_existing_files(self) -> None:
+        """Files stored before blobs can be moved into them."""
+        entry = Entry.objects.get(name="smoke-entry")
+        files = []
+        for name in ("old1.zip", "old2.zip"):
+            file = File(entry=entry, challenge=entry.challenge, description=name)
+            file.content.save(name, ContentFile(b"old bytes"))
+            files.append(file)
+        self.assertIsNone(files[0].blob)
+
+        call_command("dedupe_files", stdout=io.StringIO())
+        for file in files:
+            file.refresh_from_db()
+        self.assertEqual(files[0].blob_id, hashlib.sha256(b"old bytes").hexdigest())
+        self.assertTrue(os.path.samefile(files[0].content.path, files[1].content.path))
+
+    def _set_challenge_end(self, end: date) -> None:
+        """Move the smoke challenge so that it ends on the given date."""
+        Challenge.objects.filter(number=99).update(start=end - timedelta(days=7), end=end)
+
+    def test_register_checksum(self) -> None:
+        """Entrants may register checksums in the last hours before the deadline."""
+        self._set_challenge_end(date.today())
+        self._login("smoke_owner")
+        response = self.client.post("/e/smoke-entry/checksum/", {"md5": "0" * 32, "description": "Final"})
+        self.assertRedirects(response, "/e/smoke-entry/", fetch_redirect_response=False)
+        self.assertFalse(FileChecksum.objects.exists())
+
+        with mock.patch.object(models, "CUTOFF_TIME", 2 * 24 * 60 * 60):
+            response = self.client.post("/e/smoke-entry/checksum/", {"md5": "0" * 32, "description": "Final"})
+            self.assertRedirects(response, "/e/smoke-entry/checksum/", fetch_redirect_response=False)
+            with mock.patch.object(models, "MAX_CHECKSUMS", 1):
+                self.client.post("/e/smoke-entry/checksum/", {"md5": "1" * 32, "description": "Another"})
+        self.assertEqual(list(FileChecksum.objects.values_list("md5", flat=True)), ["0" * 32])
+
+    def test_upload_against_checksum(self) -> None:
+        """After the deadline, only files matching registered checksums are accepted."""
+        self._set_challenge_end(date.today() - timedelta(days=2))
+        Entry.objects.filter(name="smoke-entry").update(is_upload_open=False)
+        entry = Entry.objects.get(name="smoke-entry")
+        FileChecksum.objects.create(entry=entry, md5=hashlib.md5(b"final game").hexdigest(), description="Final")
+        self._login("smoke_owner")
+
+        self._upload("other.zip", b"something else", "Other")
+        self.assertFalse(File.objects.filter(description="Other").exists())
+
+        self._upload("game.zip", b"final game", "Final")
+        uploaded_file = File.objects.get(description="Final")
+        self.assertTrue(uploaded_file.is_final)
+        self.assertEqual(FileChecksum.objects.get().file, uploaded_file)
+
+        # Once every checksum has its file, uploads are closed
+        self._upload("again.zip", b"final game", "Again")
+        self.assertFalse(File.objects.filter(description="Again").exists())
+
     def test_owner_upload_persists_expected_filename(self) -> None:
         """Uploaded files keep expected challenge/entry path prefixes."""
         self._login("smoke_owner")
@@ -1,9 +1,56 @@
+import io
+import operator
+import random
+from unittest.mock import patch
+
 from django.core import mail
+from django.core.management import call_command
 from datetime import date, datetime, timedelta
-from django.test import TestCase
+from django.db import connection
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import resolve
 from django.contrib.auth.models import User
+from django.core.cache import cache
+
+from pyweek.cache import LocMemCache
+from pyweek.instrumentation import (
+    QueryBudgetExceeded, RequestTimingMiddleware, query_budget,
+    recent_requests
+)
+
+from . import benchmark, models, rating_stats, shuffle
+from .models import (
+    Challenge, ChallengeStats, DiaryComment, DiaryEntry, Entry, File,
+    GameListing, Rating, RatingTally
+)
+from .views.message import THREAD_COUNT_CACHE_KEY
+
+
+def make_challenge(*entries, title='April 2012', start=date(2012, 4, 1),
+                   end=date(2012, 4, 8)):
+    """Make a challenge (by default, one long settled) with entries.
+
+    Each entry is given as a dict of Entry fields, with the team as
+    'users': users, or the usernames of users to create. The title
+    defaults to the name. Return the challenge and a list of its entries.
 
-from .models import Challenge
+    """
+    challenge = Challenge.objects.create(title=title, start=start, end=end)
+    made = []
+    for fields in entries:
+        fields = dict(fields)
+        users = fields.pop('users', [])
+        fields.setdefault('title', fields['name'])
+        entry = Entry.objects.create(challenge=challenge, **fields)
+        if users:
+            entry.users.set([
+                User.objects.create_user(u) if isinstance(u, str) else u
+                for u in users
+            ])
+        made.append(entry)
+    return challenge, made
 
 
 class ChallengeTest(TestCase):
@@ -187,15 +234,1029 @@ class LogoutTest(TestCase):
         self.assertContains(resp, 'Not logged in')
 
 
+class EntryListTest(TestCase):
+    """The entry list costs a fixed number of queries."""
+
+    def setUp(self):
+        today = date.today()
+        # Challenge ended a few days ago, so we are in the rating period
+        self.challenge = Challenge.objects.create(
+            title='April 2012',
+            start=today - timedelta(days=10),
+            end=today - timedelta(days=3),
+        )
+        self.judge = User.objects.create_user('judge')
+        self.add_entries(1, prefix='judge', users=[self.judge])
+
+    def add_entries(self, num, prefix='entry', users=None):
+        """Add num entries with final files, screenshots and ratings."""
+        for i in range(num):
+            name = f'{prefix}-{i}'
+            members = users or [
+                User.objects.create_user(f'{name}-{j}') for j in range(2)
+            ]
+            entry = Entry.objects.create(
+                name=name,
+                title=name,
+                challenge=self.challenge,
+                user=members[0],
+                has_final=True,
+            )
+            entry.users.set(members)
+            for is_screenshot in (False, True):
+                File.objects.create(
+                    challenge=self.challenge,
+                    entry=entry,
+                    user=members[0],
+                    content=f'{self.challenge.number}/{name}/{is_screenshot}',
+                    is_final=not is_screenshot,
+                    is_screenshot=is_screenshot,
+                )
+            if entry.users.filter(pk=self.judge.pk).exists():
+                continue
+            Rating.objects.create(
+                entry=entry,
+                user=self.judge,
+                nonworking=False,
+                disqualify=False,
+            )
+
+    def count_queries(self):
+        with CaptureQueriesContext(connection) as ctx:
+            resp = self.client.get(f'/{self.challenge.number}/entries/')
+        self.assertEqual(resp.status_code, 200)
+        return len(ctx.captured_queries), resp
+
+    def test_constant_queries(self):
+        """The number of queries doesn't grow with the number of entries."""
+        self.client.force_login(self.judge)
+        self.add_entries(2)
+        few, resp = self.count_queries()
+        self.assertContains(resp, 'entry-1-1')
+        self.assertContains(resp, '>rated<')
+
+        self.add_entries(8, prefix='more')
+        many, resp = self.count_queries()
+        self.assertContains(resp, 'more-7-1')
+        self.assertEqual(few, many)
+
+    def test_shuffle(self):
+        """Each user sees entries in their own order, every time."""
+        self.add_entries(10)
+        other = User.objects.create_user('other')
+
+        def order(user):
+            self.client.force_login(user)
+            resp = self.client.get(f'/{self.challenge.number}/entries/')
+            return [e['name'] for e in resp.context['entries']]
+
+        # The order doesn't depend on (or disturb) the random module
+        random.seed(0)
+        first = order(self.judge)
+        expected = random.random()
+        random.seed(0)
+        self.assertEqual(order(self.judge), first)
+        self.assertEqual(random.random(), expected)
+
+        self.assertNotEqual(order(other), first)
+
+    def test_rate_first(self):
+        """Judges see the entries they may rate, least rated, first."""
+        self.add_entries(10)
+        unrated = {'entry-2', 'entry-5', 'entry-7'}
+        Rating.objects.filter(user=self.judge, entry__in=unrated).delete()
+
+        self.client.force_login(self.judge)
+        resp = self.client.get(f'/{self.challenge.number}/entries/')
+        names = [e['name'] for e in resp.context['entries']]
+        fewest = [e.name for e in shuffle.by_fewest_ratings(
+            Entry.objects.for_entry_list(self.challenge),
+            self.judge,
+            num_ratings=operator.attrgetter('num_ratings'),
+        )]
+        self.assertEqual(
+            names,
+            [n for n in fewest if n in unrated]
+            + [n for n in fewest if n not in unrated and n != 'judge-0']
+            + ['judge-0']
+        )
+
+
+class RatingTallyTest(TestCase):
+    """Rating tallies are kept up to date as ratings change."""
+
+    def setUp(self):
+        self.challenge, self.entries = make_challenge(*(
+            {
+                'name': name,
+                'has_final': True,
+                'users': [
+                    f'{name}-{i}' for i in range(1 if name == 'solo' else 3)
+                ],
+            }
+            for name in ('solo', 'team', 'judges')
+        ))
+        self.solo, self.team, self.judges = self.entries
+
+    def rate(self, entry, user, fun=3, nonworking=False, disqualify=False):
+        return Rating.objects.create(
+            entry=entry,
+            user=user,
+            fun=fun,
+            innovation=4,
+            production=2,
+            nonworking=nonworking,
+            disqualify=disqualify,
+        )
+
+    def assertTallyCurrent(self, entry):
+        """The running tally for entry matches tally_ratings()."""
+        tally = RatingTally.objects.get(entry=entry)
+        expected = entry.tally_ratings()
+        for field in ('fun', 'innovation', 'production', 'overall'):
+            self.assertAlmostEqual(getattr(tally, field), expected[field])
+        self.assertEqual(tally.respondents, expected['respondents'])
+        self.assertEqual(tally.nonworking, int(expected['nonworking'] * 100))
+        self.assertEqual(tally.disqualify, int(expected['disqualify'] * 100))
+
+    def test_create_edit_delete(self):
+        """Tallies follow ratings as they are created, edited and deleted."""
+        judges = list(self.judges.users.all())
+        ratings = [
+            self.rate(self.solo, judges[0], fun=5),
+            self.rate(self.solo, judges[1], fun=2, disqualify=True),
+            self.rate(self.solo, judges[2], nonworking=True),
+        ]
+        self.assertTallyCurrent(self.solo)
+
+        ratings[1].fun = 1
+        ratings[1].nonworking = True
+        ratings[1].save()
+        self.assertTallyCurrent(self.solo)
+
+        ratings[0].delete()
+        tally = RatingTally.objects.get(entry=self.solo)
+        self.assertEqual(tally.respondents, 0)
+        self.assertEqual(tally.overall, 0)
+        self.assertEqual(tally.nonworking, 100)
+        self.assertEqual(tally.disqualify, 14)
+
+    def test_generate_tallies(self):
+        """generate_tallies() picks winners from the running tallies."""
+        judges = list(self.judges.users.all())
+        solo_user = self.solo.users.get()
+        self.rate(self.solo, judges[0], fun=5)
+        self.rate(self.team, judges[0], fun=1)
+        self.rate(self.team, solo_user, fun=4)
+        self.rate(self.judges, solo_user, fun=2)
+
+        self.challenge.generate_tallies()
+        for entry in self.entries:
+            self.assertTallyCurrent(entry)
+        self.assertFalse(RatingTally.objects.get(entry=self.team).individual)
+        self.assertEqual(self.challenge.individualWinners(), [self.solo])
+        self.assertEqual(self.challenge.teamWinners(), [self.team])
+
+    def test_rebuild_tallies(self):
+        """Tallies can be rebuilt from scratch."""
+        judges = list(self.judges.users.all())
+        self.rate(self.solo, judges[0], fun=5)
+        self.rate(self.solo, judges[1], nonworking=True)
+        RatingTally.objects.update(fun_total=0, num_ratings=0)
+
+        self.challenge.rebuild_tallies()
+        self.assertTallyCurrent(self.solo)
+        self.assertEqual(RatingTally.objects.count(), 3)
+
+
+def legacy_tally_ratings(entry):
+    """The original, row-by-row implementation of Entry.tally_ratings()."""
+    ratings = entry.rating_set.all()
+    info = {}
+    for rating in 'fun innovation production disqualify nonworking overall'.split():
+        info[rating] = 0
+    n = 0
+    for rating in ratings:
+        info['disqualify'] += rating.disqualify
+        info['nonworking'] += rating.nonworking
+        if rating.nonworking:
+            continue
+        n += 1
+        info['fun'] += rating.fun
+        info['innovation'] += rating.innovation
+        info['production'] += rating.production
+    m = float(len(ratings))
+    num_finished = sum(len(e.users.all())
+            for e in Entry.objects.filter(challenge=entry.challenge)
+                if e.has_final)
+    if n:
+        for rating in 'fun innovation production'.split():
+            info[rating] /= float(n)
+        info['disqualify'] /= float(num_finished)
+        info['nonworking'] /= float(len(ratings))
+        info['participants'] = len(ratings)/float(num_finished)
+        info['overall'] = (info['fun'] + info['innovation'] +
+            info['production'])/3
+    info['respondents'] = n
+    return info
+
+
+class TallyRatingsTest(TestCase):
+    """Entry.tally_ratings() gives the same results as it always did."""
+
+    def setUp(self):
+        rng = random.Random(1234)
+        User.objects.bulk_create(
+            User(username=f'judge-{i}') for i in range(120)
+        )
+        judges = list(User.objects.order_by('pk'))
+        self.challenge, self.entries = make_challenge(*(
+            {
+                'name': f'entry-{i}',
+                'has_final': i % 10 != 9,
+                'users': judges[i * 4:i * 4 + 1 + i % 3],
+            }
+            for i in range(30)
+        ))
+        ratings = []
+        for i, entry in enumerate(self.entries):
+            if i == 0:
+                # An entry nobody has rated
+                continue
+            for judge in rng.sample(judges, 100):
+                ratings.append(Rating(
+                    entry=entry,
+                    user=judge,
+                    fun=rng.randint(1, 5),
+                    innovation=rng.randint(1, 5),
+                    production=rng.randint(1, 5),
+                    # Entry 1 doesn't work for anyone
+                    nonworking=i == 1 or rng.random() < 0.1,
+                    disqualify=rng.random() < 0.05,
+                ))
+        Rating.objects.bulk_create(ratings)
+
+    def test_same_results(self):
+        """Aggregated tallies match the original implementation."""
+        for entry in self.entries:
+            expected = legacy_tally_ratings(entry)
+            actual = entry.tally_ratings()
+            self.assertEqual(actual.keys(), expected.keys())
+            for k, v in expected.items():
+                self.assertAlmostEqual(actual[k], v, msg=f'{entry} {k}')
+
+    def test_finisher_count_invalidated(self):
+        """The cached finisher count follows changes to entries and teams."""
+        entry = self.entries[0]
+        before = self.challenge.finisher_count()
+        entry.users.add(User.objects.create_user('newcomer'))
+        self.assertEqual(self.challenge.finisher_count(), before + 1)
+        entry.has_final = False
+        entry.save()
+        self.assertEqual(
+            self.challenge.finisher_count(),
+            before + 1 - entry.users.count()
+        )
+
+
+class MemberCountTest(TestCase):
+    """Entry team sizes follow changes to the team from either side."""
+
+    def setUp(self):
+        self.challenge, (self.entry,) = make_challenge({'name': 'entry'})
+        self.users = [User.objects.create_user(f'user-{i}') for i in range(3)]
+
+    def assertMembers(self, n):
+        self.assertEqual(self.entry.member_count, n)
+        self.assertEqual(Entry.objects.get(pk='entry').member_count, n)
+
+    def test_entry_side(self):
+        self.entry.users.set(self.users[:1])
+        self.assertMembers(1)
+        self.assertFalse(self.entry.is_team())
+        self.entry.users.add(*self.users[1:])
+        self.assertMembers(3)
+        self.assertTrue(self.entry.is_team())
+        self.entry.users.remove(self.users[0])
+        self.assertMembers(2)
+        self.entry.users.clear()
+        self.assertMembers(0)
+
+    def test_user_side(self):
+        for user in self.users:
+            user.entry_set.add(self.entry)
+        self.assertEqual(Entry.objects.get(pk='entry').member_count, 3)
+        self.users[0].entry_set.remove(self.entry)
+        self.assertEqual(Entry.objects.get(pk='entry').member_count, 2)
+        self.users[1].entry_set.clear()
+        self.assertEqual(Entry.objects.get(pk='entry').member_count, 1)
+
+    def test_update_member_counts(self):
+        self.entry.users.set(self.users)
+        Entry.objects.update(member_count=0)
+        Entry.objects.update_member_counts()
+        self.assertEqual(Entry.objects.get(pk='entry').member_count, 3)
+
+
+class AllGamesTest(TestCase):
+    """The all games list is served from a materialised listing."""
+
+    def setUp(self):
+        self.challenge, (self.entry,) = make_challenge({
+            'name': 'entry',
+            'title': 'Team Entry',
+            'game': 'Entry Game',
+            'users': ['entrant'],
+        })
+
+    def test_final_entries_listed(self):
+        """Entries appear once they have a final, with their team."""
+        self.assertFalse(GameListing.objects.exists())
+        self.entry.has_final = True
+        self.entry.save()
+        resp = self.client.get('/all_games/')
+        self.assertContains(resp, 'Entry Game')
+        self.assertContains(resp, '<a class="small" href="/u/entrant">entrant</a>')
+
+        self.entry.users.add(User.objects.create_user('teammate'))
+        resp = self.client.get('/all_games/')
+        self.assertContains(resp, 'teammate')
+
+    def test_tallies_listed(self):
+        """Ratings and winners appear when tallies are generated."""
+        self.entry.has_final = True
+        self.entry.save()
+        Rating.objects.create(
+            entry=self.entry,
+            user=User.objects.create_user('judge'),
+            fun=5,
+            innovation=5,
+            production=5,
+            nonworking=False,
+            disqualify=False,
+        )
+        self.challenge.generate_tallies()
+        listing = GameListing.objects.get()
+        self.assertEqual(listing.rating, 5)
+        self.assertTrue(listing.winner)
+
+    def test_rebuild(self):
+        """The listing is rebuilt by a command, not by viewing it."""
+        Entry.objects.filter(pk='entry').update(has_final=True)
+        resp = self.client.get('/all_games/')
+        self.assertNotContains(resp, 'Entry Game')
+        self.assertFalse(GameListing.objects.exists())
+
+        with patch('sys.stdout', io.StringIO()):
+            call_command('refresh_all_games')
+        resp = self.client.get('/all_games/')
+        self.assertContains(resp, 'Entry Game')
+
+
+class StatsTest(TestCase):
+    """Participation stats are saved once challenges are settled."""
+
+    def setUp(self):
+        def entries(prefix):
+            return (
+                {
+                    'name': f'{prefix}-{i}',
+                    'has_final': i > 0,
+                    'users': [f'{prefix}-{i}-{j}' for j in range(i + 1)],
+                }
+                for i in range(3)
+            )
+
+        today = date.today()
+        self.settled, _ = make_challenge(*entries('settled'))
+        self.judging, _ = make_challenge(
+            *entries('judging'),
+            title='Last week',
+            start=today - timedelta(days=10),
+            end=today - timedelta(days=3),
+        )
+
+    def test_stats(self):
+        """Only settled challenges have their stats saved."""
+        resp = self.client.get('/stats.json')
+        expected = {'users': 6, 'entries': 3, 'finals': 2}
+        stats = resp.json()['stats']
+        self.assertEqual(stats[str(self.settled.number)], expected)
+        self.assertEqual(stats[str(self.judging.number)], expected)
+        self.assertEqual(
+            list(ChallengeStats.objects.values_list('challenge', flat=True)),
+            [self.settled.number]
+        )
+        # The stats for the live challenge might change
+        self.assertNotIn('Last-Modified', resp)
+
+    def test_saved_meanwhile(self):
+        """Stats saved by another request in the meantime are kept."""
+        ChallengeStats.objects.create(
+            challenge=self.settled, users=1, entries=1, finals=1,
+        )
+        # As if the other request saved them after we read the saved stats
+        with patch.object(ChallengeStats.objects, 'all', return_value=[]):
+            stats = models.participation()
+        self.assertEqual(stats[self.settled.number]['users'], 6)
+        self.assertEqual(ChallengeStats.objects.get().users, 1)
+
+    def test_revalidate(self):
+        """Clients can revalidate the stats with their ETag."""
+        resp = self.client.get('/stats.json')
+        resp = self.client.get('/stats.json', HTTP_IF_NONE_MATCH=resp['ETag'])
+        self.assertEqual(resp.status_code, 304)
+
+        Entry.objects.filter(challenge=self.judging).update(has_final=True)
+        resp = self.client.get('/stats.json', HTTP_IF_NONE_MATCH=resp['ETag'])
+        self.assertEqual(resp.status_code, 200)
+
+    def test_last_modified(self):
+        """Stats have a modification time once all of them are saved."""
+        Entry.objects.filter(challenge=self.judging).delete()
+        resp = self.client.get('/stats.json')
+        resp = self.client.get(
+            '/stats.json',
+            HTTP_IF_MODIFIED_SINCE=resp['Last-Modified'],
+        )
+        self.assertEqual(resp.status_code, 304)
+
+
+class DownloadsTest(TestCase):
+    """The downloads manifest is rebuilt when final files change."""
+
+    def setUp(self):
+        self.challenge, (self.entry,) = make_challenge({
+            'name': 'entry',
+            'title': 'Team',
+            'game': 'Game',
+            'has_final': True,
+        })
+        self.url = f'/{self.challenge.number}/downloads.json'
+
+    def add_final(self, name):
+        return File.objects.create(
+            challenge=self.challenge,
+            entry=self.entry,
+            content=f'{self.challenge.number}/entry/{name}',
+            description='Final',
+            is_final=True,
+            size=100,
+        )
+
+    def test_revalidate(self):
+        """Clients can poll for new downloads with the manifest's ETag."""
+        self.add_final('game-1.0.zip')
+        resp = self.client.get(self.url)
+        self.assertEqual(
+            [f['name'] for f in resp.json()['Game']],
+            ['game-1.0.zip']
+        )
+        with self.assertNumQueries(2):
+            resp = self.client.get(self.url, HTTP_IF_NONE_MATCH=resp['ETag'])
+        self.assertEqual(resp.status_code, 304)
+
+        new = self.add_final('game-1.1.zip')
+        resp = self.client.get(self.url, HTTP_IF_NONE_MATCH=resp['ETag'])
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(
+            [f['name'] for f in resp.json()['Game']],
+            ['game-1.0.zip', 'game-1.1.zip']
+        )
+
+        new.delete()
+        resp = self.client.get(self.url, HTTP_IF_NONE_MATCH=resp['ETag'])
+        self.assertEqual(len(resp.json()['Game']), 1)
+
+    def test_entry_renamed(self):
+        """Renaming a game invalidates the manifest."""
+        self.add_final('game.zip')
+        self.client.get(self.url)
+        self.entry.game = 'Better Game'
+        self.entry.save()
+        self.assertEqual(list(self.client.get(self.url).json()), ['Better Game'])
+
+    def test_invalidated_while_building(self):
+        """A manifest that went out of date while being built isn't kept."""
+        self.add_final('game.zip')
+        build = models.build_manifest
+
+        def build_and_upload(challenge):
+            manifest = build(challenge)
+            self.add_final('late.zip')
+            return manifest
+
+        with patch.object(models, 'build_manifest', build_and_upload):
+            resp = self.client.get(self.url)
+        self.assertEqual(len(resp.json()['Game']), 1)
+        self.assertEqual(len(self.client.get(self.url).json()['Game']), 2)
+
+
+class CacheStatsTest(TestCase):
+    def make_cache(self, flush_every=100):
+        return LocMemCache('cache-stats-test', {
+            'OPTIONS': {'STATS_FLUSH_EVERY': flush_every},
+        })
+
+    def test_counts_hits_and_misses(self):
+        """Hits and misses are counted once flushed to the totals."""
+        c = self.make_cache()
+        c.clear()
+        c.set('present', 1)
+        c.get('present')
+        c.get('present')
+        self.assertIsNone(c.get('absent'))
+        self.assertEqual(c.stats(), {'hits': 0, 'misses': 0})
+        c.flush_stats()
+        self.assertEqual(c.stats(), {'hits': 2, 'misses': 1})
+
+    def test_flushes_periodically(self):
+        """The totals are updated every so many lookups."""
+        c = self.make_cache(flush_every=3)
+        c.clear()
+        c.set('present', None)
+        self.assertIsNone(c.get('present', 'default'))
+        c.get('absent')
+        c.get('absent')
+        self.assertEqual(c.stats(), {'hits': 1, 'misses': 2})
+
+
+class RequestTimingTest(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+
+    def run_view(self, view, num_queries):
+        """Run view through the middleware, making num_queries queries."""
+        def get_response(request):
+            middleware.process_view(request, view, (), {})
+            for _ in range(num_queries):
+                list(User.objects.all())
+            return view(request)
+
+        middleware = RequestTimingMiddleware(get_response)
+        request = self.factory.get('/')
+        request.resolver_match = resolve('/all_games/')
+        return middleware(request)
+
+    def test_records_timings(self):
+        """Requests are recorded with their view and query count."""
+        self.client.get('/all_games/')
+        record = recent_requests()[-1]
+        self.assertEqual(
+            record['view'],
+            'pyweek.challenge.views.challenge.all_games'
+        )
+        self.assertEqual(record['status'], 200)
+        self.assertGreater(record['queries'], 0)
+        self.assertGreater(record['template_time'], 0)
+        self.assertGreaterEqual(record['total_time'], record['db_time'])
+
+    def test_within_budget(self):
+        view = query_budget(2)(lambda request: HttpResponse())
+        resp = self.run_view(view, 2)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(recent_requests()[-1]['queries'], 2)
+
+    def test_over_budget(self):
+        """Going over budget is an error in the tests..."""
+        view = query_budget(2)(lambda request: HttpResponse())
+        with self.assertRaises(QueryBudgetExceeded):
+            self.run_view(view, 3)
+
+    @override_settings(QUERY_BUDGET_STRICT=False)
+    def test_over_budget_warning(self):
+        """...and a warning in production."""
+        view = query_budget(2)(lambda request: HttpResponse())
+        with self.assertLogs('pyweek.requests', 'WARNING'):
+            resp = self.run_view(view, 3)
+        self.assertEqual(resp.status_code, 200)
+
+    def test_summary(self):
+        """Only staff can see the summary of timings."""
+        self.client.get('/all_games/')
+        resp = self.client.get('/timings.json')
+        self.assertEqual(resp.status_code, 404)
+
+        staff = User.objects.create_user('staff', is_staff=True)
+        self.client.force_login(staff)
+        resp = self.client.get('/timings.json')
+        summary = resp.json()['pyweek.challenge.views.challenge.all_games']
+        self.assertGreaterEqual(summary['requests'], 1)
+
+
+class BenchmarkTest(TestCase):
+    def test_benchmark(self):
+        """We can generate a challenge and time the pages against it."""
+        challenge = benchmark.generate(
+            num_entries=10,
+            ratings_per_entry=5,
+            diaries_per_entry=2,
+            comments_per_diary=2,
+        )
+        self.assertEqual(challenge.entries.count(), 10)
+        self.assertTrue(challenge.isRatingOpen())
+
+        results = benchmark.run(challenge, repeat=2)
+        self.assertEqual(
+            [name for name, *_ in results],
+            [name for name, url in benchmark.PAGES]
+        )
+        for name, queries, p50, p95 in results:
+            self.assertGreater(queries, 0)
+            self.assertLessEqual(p50, p95)
+
+    def test_command(self):
+        """The discarded challenge leaves nothing in the cache."""
+        cache.clear()
+        with patch('sys.stdout', io.StringIO()):
+            call_command('benchmark', entries=10, ratings=5, repeat=1)
+        self.assertFalse(Challenge.objects.exists())
+        self.assertIsNone(cache.get(Challenge.finishers_cache_key(1)))
+        self.assertIsNone(cache.get(THREAD_COUNT_CACHE_KEY))
+
+
+class RatingDashboardTest(TestCase):
+    def setUp(self):
+        self.challenge = benchmark.generate(
+            num_entries=20,
+            ratings_per_entry=5,
+            diaries_per_entry=0,
+        )
+        entry = self.challenge.entries.filter(has_final=True).order_by('pk')[0]
+        self.judge = entry.users.all()[0]
+        self.client.force_login(self.judge)
+        self.url = f'/{self.challenge.number}/rating-dashboard'
+
+    def test_query_count(self):
+        """The dashboard takes the same number of queries for any entries."""
+        with self.assertNumQueries(10):
+            resp = self.client.get(self.url)
+        shown = sum(
+            len(resp.context[k])
+            for k in ('rated', 'not_rated', 'not_working', 'yours')
+        )
+        self.assertEqual(
+            shown,
+            self.challenge.entries.filter(has_final=True).count()
+        )
+
+    def test_not_working(self):
+        """Entries show the proportion of ratings that found them broken."""
+        entry = Entry.objects.filter(
+            challenge=self.challenge,
+            has_final=True,
+        ).exclude(users=self.judge).order_by('pk')[0]
+        for i, rating in enumerate(entry.rating_set.order_by('pk')):
+            rating.nonworking = i == 0
+            rating.save()
+        count = Rating.objects.filter(entry=entry).count()
+
+        resp = self.client.get(self.url)
+        info, = [
+            info
+            for k in ('rated', 'not_rated', 'not_working')
+            for info in resp.context[k]
+            if info['name'] == entry.name
+        ]
+        self.assertEqual(info['nw_pct'], 100.0 / count)
+
+    def test_rate_next(self):
+        """Judges are asked to rate the entries with fewest ratings first."""
+        resp = self.client.get(self.url)
+        not_rated = resp.context['not_rated']
+        rate_next = resp.context['rate_next']
+        self.assertEqual(len(rate_next), min(len(not_rated), 5))
+        fewest = sorted(e['num_ratings'] for e in not_rated)[:len(rate_next)]
+        self.assertEqual([e['num_ratings'] for e in rate_next], fewest)
+
+        # Rating an entry moves it off the list
+        entry = Entry.objects.get(name=rate_next[0]['name'])
+        Rating.objects.create(
+            entry=entry,
+            user=self.judge,
+            fun=3, innovation=3, production=3,
+            nonworking=False,
+            disqualify=False,
+        )
+        resp = self.client.get(self.url)
+        self.assertNotIn(
+            entry.name,
+            [e['name'] for e in resp.context['rate_next']]
+        )
+
+    def test_stable_order(self):
+        """Each judge sees entries in their own order, every time."""
+        first = self.client.get(self.url).context['not_rated']
+        again = self.client.get(self.url).context['not_rated']
+        self.assertEqual(
+            [e['name'] for e in first],
+            [e['name'] for e in again]
+        )
+        self.assertNotEqual(
+            [e['name'] for e in first],
+            sorted(e['name'] for e in first)
+        )
+
+
+class RatingStatsTest(TestCase):
+    """Rating statistics take out each judge's leniency."""
+
+    def setUp(self):
+        self.challenge, entries = make_challenge(*(
+            {'name': f'entry-{i}', 'has_final': True} for i in range(3)
+        ))
+        self.harsh = User.objects.create_user('harsh')
+        self.kind = User.objects.create_user('kind')
+        broken = User.objects.create_user('broken')
+        for entry, score in zip(entries, [2, 3, 4]):
+            for user, offset in ((self.harsh, -1), (self.kind, 1)):
+                Rating.objects.create(
+                    entry=entry,
+                    user=user,
+                    fun=score + offset,
+                    innovation=score,
+                    production=score,
+                    nonworking=False,
+                    disqualify=False,
+                )
+            Rating.objects.create(
+                entry=entry,
+                user=broken,
+                nonworking=True,
+                disqualify=False,
+            )
+
+    def test_stats(self):
+        with self.assertNumQueries(1):
+            stats = rating_stats.challenge_stats(self.challenge)
+        self.assertEqual(stats['ratings'], 9)
+        self.assertEqual(stats['distributions']['fun'], [1, 1, 2, 1, 1])
+        self.assertEqual(stats['distributions']['production'], [0, 2, 2, 2, 0])
+        self.assertEqual(stats['judges']['harsh']['fun'], -1)
+        self.assertEqual(stats['judges']['kind']['fun'], 1)
+        self.assertEqual(stats['judges']['kind']['innovation'], 0)
+        self.assertNotIn('broken', stats['judges'])
+
+        entry = stats['entries']['entry-1']
+        self.assertEqual(entry['ratings'], 3)
+        self.assertEqual(entry['nonworking'], 1)
+        self.assertEqual(entry['fun']['mean'], 3)
+        self.assertAlmostEqual(entry['fun']['ci'], 1.96)
+        self.assertEqual(entry['fun']['normalised'], 3)
+        self.assertEqual(entry['innovation']['ci'], 0)
+
+    def test_stats_match_tallies(self):
+        """The normalised scores reported are the ones tallied."""
+        Rating.objects.filter(user=self.kind, entry='entry-0').delete()
+        self.challenge.generate_tallies()
+        stats = rating_stats.challenge_stats(self.challenge)
+        for tally in RatingTally.objects.filter(challenge=self.challenge):
+            self.assertAlmostEqual(
+                stats['entries'][tally.entry_id]['fun']['normalised'],
+                tally.fun_normalised,
+            )
+
+    def test_fit_judge_offsets(self):
+        """Fitted offsets take out each judge's leniency, shrunk a little."""
+        cols = rating_stats.load_ratings(self.challenge)
+        offsets, scores = rating_stats.fit_judge_offsets(cols)
+        self.assertAlmostEqual(offsets['harsh']['fun'], -0.5)
+        self.assertAlmostEqual(offsets['kind']['fun'], 0.5)
+        self.assertAlmostEqual(offsets['kind']['production'], 0)
+        self.assertAlmostEqual(scores['entry-2']['fun'], 4)
+
+    def test_fit_unsettled(self):
+        """Fitted scores match the offsets even if the fit doesn't settle."""
+        Rating.objects.filter(user=self.kind, entry='entry-0').delete()
+        cols = rating_stats.load_ratings(self.challenge)
+        offsets, scores = rating_stats.fit_judge_offsets(cols, iterations=1)
+        means = rating_stats.entry_means(cols, offsets)
+        for entry, score in scores.items():
+            for cat in rating_stats.CATEGORIES:
+                self.assertAlmostEqual(score[cat], means[entry][cat])
+
+    def test_rank_normalised(self):
+        """Winners can be picked by scores normalised for each judge."""
+        Entry.objects.all().delete()
+
+        def add_entry(name, ratings):
+            entry = Entry.objects.create(
+                name=name,
+                title=name,
+                challenge=self.challenge,
+                has_final=True,
+            )
+            entry.users.set([User.objects.create_user(name)])
+            for user, score in ratings:
+                Rating.objects.create(
+                    entry=entry,
+                    user=user,
+                    fun=score, innovation=score, production=score,
+                    nonworking=False,
+                    disqualify=False,
+                )
+            return entry
+
+        for i in range(6):
+            add_entry(f'common-{i}', [(self.harsh, 1), (self.kind, 3)])
+        harshly_judged = add_entry('harshly', [(self.harsh, 3)])
+        kindly_judged = add_entry('kindly', [(self.kind, 4)])
+
+        self.challenge.generate_tallies()
+        self.assertEqual(self.challenge.individualWinners(), [kindly_judged])
+        tally = RatingTally.objects.get(entry=harshly_judged)
+        self.assertEqual(tally.overall, 3)
+        self.assertGreater(tally.overall_normalised, 3.5)
+        resp = self.client.get(f'/{self.challenge.number}/ratings/')
+        score, top = resp.context['individual_overall'][0]
+        self.assertEqual((score, top.entry), (4, kindly_judged))
+        self.assertNotContains(resp, '<th>Raw</th>')
+
+        self.challenge.rank_normalised = True
+        self.challenge.save()
+        self.challenge.generate_tallies()
+        self.assertEqual(self.challenge.individualWinners(), [harshly_judged])
+
+        # The published results agree with the winners
+        resp = self.client.get(f'/{self.challenge.number}/ratings/')
+        score, top = resp.context['individual_overall'][0]
+        self.assertEqual(top.entry, harshly_judged)
+        self.assertEqual(score, top.overall_normalised)
+        self.assertContains(resp, '<th>Raw</th>')
+
+        # Switching back to raw scores unmarks the normalised winner
+        self.challenge.rank_normalised = False
+        self.challenge.save()
+        with patch('sys.stdout', io.StringIO()):
+            call_command('recalculate_rating_tallies', str(self.challenge.number))
+        self.assertEqual(self.challenge.individualWinners(), [kindly_judged])
+
+    def test_command(self):
+        """Statistics can be written as CSV."""
+        out = io.StringIO()
+        with patch('sys.stdout', out), patch('sys.stderr', io.StringIO()):
+            call_command('rating_stats', str(self.challenge.number),
+                         format='csv', table='judges')
+        self.assertEqual(out.getvalue().splitlines(), [
+            'challenge,judge,ratings,fun,innovation,production',
+            f'{self.challenge.number},harsh,3,-1.0,0.0,0.0',
+            f'{self.challenge.number},kind,3,1.0,0.0,0.0',
+        ])
+
+
+class ThreadActivityTest(TestCase):
+    """The latest comments on threads are recalculated in bulk."""
+
+    def setUp(self):
+        self.author = User.objects.create_user('author')
+        self.friend = User.objects.create_user('friend')
+        self.spammer = User.objects.create_user('spammer')
+        start = datetime(2020, 1, 1)
+        self.threads = []
+        for i, commenters in enumerate([
+            [self.friend, self.spammer],
+            [self.spammer, self.spammer],
+            [],
+        ]):
+            thread = DiaryEntry.objects.create(
+                user=self.author,
+                title=f'Thread {i}',
+                content='Hello',
+                created=start,
+            )
+            for j, user in enumerate(commenters):
+                DiaryComment.objects.create(
+                    diary_entry=thread,
+                    user=user,
+                    content='Hi',
+                    created=start + timedelta(hours=j + 1),
+                )
+            self.threads.append(thread)
+
+    def activity(self):
+        return [
+            (d.actor.username, d.last_comment and d.last_comment.user.username,
+             d.activity.hour, d.reply_count)
+            for d in DiaryEntry.objects.filter(is_pyggy=False).order_by('title')
+        ]
+
+    def test_update_activity(self):
+        """Threads show their latest comment."""
+        pyggy = DiaryEntry.objects.create(
+            user=self.author,
+            title='Pyggy',
+            content='Oink',
+            created=datetime(2020, 1, 1),
+            reply_count=5,
+            is_pyggy=True,
+        )
+        with self.assertNumQueries(1):
+            DiaryEntry.objects.update_activity()
+        self.assertEqual(self.activity(), [
+            ('spammer', 'spammer', 2, 2),
+            ('spammer', 'spammer', 2, 2),
+            ('author', None, 0, 0),
+        ])
+        # Pyggy's diaries are left alone
+        pyggy.refresh_from_db()
+        self.assertEqual(pyggy.reply_count, 5)
+
+    def test_delete_spammer(self):
+        """Threads are rolled back to before a spammer's comments."""
+        DiaryEntry.objects.update_activity()
+        staff = User.objects.create_user('staff', password='password')
+        staff.is_staff = True
+        staff.save()
+        self.client.login(username='staff', password='password')
+        self.client.post('/u/spammer/delete_spam', {'confirm': 'yes'})
+        self.assertEqual(self.activity(), [
+            ('friend', 'friend', 1, 1),
+            ('author', None, 0, 0),
+            ('author', None, 0, 0),
+        ])
+        self.assertFalse(DiaryComment.objects.filter(user=self.spammer))
+
+
 class DiscussionTest(TestCase):
     def test_new_thread(self):
         """Users can start a new thread."""
 
     def test_thread_list(self):
         """New threads appear in the list"""
+        users = [User.objects.create_user(f'poster{i}') for i in range(10)]
+        for i, user in enumerate(users):
+            diary = DiaryEntry.objects.create(
+                user=user,
+                title=f'Thread {i}',
+                content='Hello',
+            )
+            if i % 2:
+                comment = DiaryComment.objects.create(
+                    diary_entry=diary,
+                    user=users[0],
+                    content='Hi',
+                )
+                diary.last_comment = comment
+                diary.actor = users[0]
+                diary.reply_count = 1
+                diary.save()
+        cache.delete(THREAD_COUNT_CACHE_KEY)
+
+        # Counting the threads, listing them with their users, and finding
+        # the current challenge for the menu
+        with self.assertNumQueries(3):
+            resp = self.client.get('/messages/')
+        self.assertEqual(len(resp.context['diary_entries']), 10)
+        self.assertContains(resp, '>Thread 9</a>')
+        self.assertContains(resp, 'updated by <a href="/u/poster0">poster0</a>')
+        self.assertContains(resp, '<a href="/u/poster8/">poster8</a>')
 
     def test_thread_pagination(self):
         """Threads are displated in pages."""
+        user = User.objects.create_user('poster')
+        start = datetime(2020, 1, 1)
+        DiaryEntry.objects.bulk_create(
+            DiaryEntry(
+                user=user,
+                title=f'Thread {i}',
+                content='Hello',
+                # Pairs of threads are active at the same time
+                activity=start + timedelta(hours=i // 2),
+                sticky=i == 3,
+            )
+            for i in range(65)
+        )
+        expected = list(
+            DiaryEntry.objects.threads().values_list('title', flat=True)
+        )
+        self.assertEqual(expected[0], 'Thread 3')
+        cache.delete(THREAD_COUNT_CACHE_KEY)
+
+        def titles(resp):
+            return [d['title'] for d in resp.context['diary_entries']]
+
+        seen = []
+        resp = self.client.get('/messages/')
+        while True:
+            seen.append(titles(resp))
+            next = resp.context['next']
+            if not next:
+                break
+            resp = self.client.get(
+                '/messages/',
+                {'after': next, 'page': resp.context['page'] + 1},
+            )
+        self.assertEqual([len(page) for page in seen], [30, 30, 5])
+        self.assertEqual(sum(seen, []), expected)
+        self.assertEqual(resp.context['page'], 3)
+        self.assertEqual(resp.context['num_pages'], 3)
+
+        resp = self.client.get('/messages/', {'before': resp.context['prev']})
+        self.assertEqual(titles(resp), seen[1])
+        resp = self.client.get('/messages/', {'last': ''})
+        self.assertEqual(titles(resp), expected[-30:])
+        resp = self.client.get('/messages/', {'after': 'bogus'})
+        self.assertEqual(titles(resp), seen[0])
 
     def test_comment(self):
         """Users can post comments on existing threads."""
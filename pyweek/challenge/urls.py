@@ -19,6 +19,7 @@ urlpatterns = [
     url(r'^(\d+)/ratings/$', challenge.challenge_ratings),
 
     url(r'^(\d+)/downloads\.json$', api.challenge_downloads),
+    url(r'^(\d+)/archive\.tar$', api.challenge_archive),
 
     # Message views
     url(r'^messages/$', message.list_messages),
@@ -48,6 +49,10 @@ urlpatterns = [
     url(r'^e/([\w-]+)/upload/$', files.entry_upload),
     url(r'^e/([\w-]+)/oup/$', files.oneshot_upload),
     url(r'^e/([\w-]+)/delete/(.+)$', files.file_delete),
+    url(r'^e/([\w-]+)/checksum/$', files.entry_checksum),
+    url(r'^e/([\w-]+)/uploads/$', files.upload_start),
+    url(r'^uploads/([\w-]+)/$', files.upload_chunk),
+    url(r'^uploads/([\w-]+)/finish$', files.upload_finish),
 
     # Poll views
     url(r'^p/(\d+)/$', poll.poll_display),
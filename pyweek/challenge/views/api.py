@@ -1,46 +1,65 @@
 """REST API views, primarily for the 'pyweek' CLI tool."""
-import posixpath
-from urllib.parse import urljoin
+from django.core.files.storage import default_storage
+from django.shortcuts import get_object_or_404, redirect
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
 
-from django.db import models as md
-from django.shortcuts import get_object_or_404, render
-from django.http import JsonResponse
-from django.views.decorators.cache import cache_page
+from .. import archive, models
 
-from .. import models
 
-
-@cache_page(24 * 60 * 60)
 def challenge_downloads(request, challenge_id):
-    """Get a view of all downloads for the challenge."""
+    """Get a view of all downloads for the challenge.
+
+    The manifest is kept up to date as files are uploaded, so clients can
+    poll for changes by revalidating with its ETag.
+
+    """
     challenge = get_object_or_404(models.Challenge, pk=challenge_id)
-    all_done = challenge.isAllDone()
-    if not all_done:
-        resp = {}
-    entries = (
-        models.Entry.objects.filter(
-            challenge__number=challenge_id,
-            has_final=True,
-        )
-        .prefetch_related(
-            md.Prefetch(
-                'file_set',
-                queryset=models.File.objects.filter(
-                    is_final=True,
-                    is_screenshot=False,
-                )
-            )
+    manifest = models.DownloadManifest.objects.for_challenge(challenge)
+
+    etag = quote_etag(manifest.etag)
+    last_modified = int(manifest.modified.timestamp())
+    response = get_conditional_response(
+        request,
+        etag=etag,
+        last_modified=last_modified,
+    )
+    if response is None:
+        response = HttpResponse(
+            manifest.content,
+            content_type='application/json',
         )
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    return response
+
+
+def challenge_archive(request, challenge_id):
+    """Download a tar of all the final downloads for the challenge.
+
+    Once the archive has been stored by the build_archives command it is
+    served from storage; until then it is streamed.
+
+    """
+    challenge = get_object_or_404(models.Challenge, pk=challenge_id)
+    manifest = models.DownloadManifest.objects.for_challenge(challenge)
+    name = archive.archive_name(challenge, manifest) + '.tar'
+    if default_storage.exists(name):
+        return redirect(default_storage.url(name))
+
+    etag = quote_etag(manifest.etag)
+    response = get_conditional_response(request, etag=etag)
+    if response is not None:
+        return response
+    members = archive.archive_members(challenge)
+    response = StreamingHttpResponse(
+        archive.stream_tar(members),
+        content_type='application/x-tar',
+    )
+    response['Content-Length'] = archive.archive_length(members)
+    response['Content-Disposition'] = (
+        f'attachment; filename="pyweek{challenge.number}.tar"'
     )
-    resp = {
-        e.game or e.title: [
-            {
-                'name': posixpath.basename(f.content.name),
-                'url': f.content.url,
-                'size': f.content.size,
-            }
-            for f in e.file_set.all()
-        ]
-        for e in entries
-    }
-    return JsonResponse(resp)
+    response['ETag'] = etag
+    return response
@@ -4,6 +4,7 @@ import urllib.request
 import urllib.parse
 import urllib.error
 import json
+import hashlib
 import posixpath
 import datetime
 import xml.sax.saxutils
@@ -25,11 +26,14 @@ from django.contrib import auth
 from django.core import validators
 from django.db import connection
 from django.db import models as md
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
 
 from pyweek.challenge import models
 from django.conf import settings
 
 from pyweek.bleaching import html2safehtml
+from pyweek.instrumentation import query_budget
 
 from .entry import user_may_rate
 
@@ -58,53 +62,35 @@ def stats(request: HttpRequest) -> HttpResponse:
 def stats_json(request: HttpRequest) -> HttpResponse:
     stats = models.participation()
     js = json.dumps({'stats': stats})
-    return HttpResponse(js, content_type='application/json')
 
+    # Let clients revalidate rather than download the stats again. The
+    # stats can only be said to have a modification time if every
+    # challenge in them has been saved.
+    etag = quote_etag(hashlib.md5(js.encode()).hexdigest())
+    saved = dict(
+        models.ChallengeStats.objects.values_list('challenge_id', 'created')
+    )
+    last_modified = None
+    if saved and set(stats) - {1} <= saved.keys():
+        last_modified = int(max(saved.values()).timestamp())
+
+    response = get_conditional_response(
+        request,
+        etag=etag,
+        last_modified=last_modified,
+    )
+    if response is None:
+        response = HttpResponse(js, content_type='application/json')
+    response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified)
+    return response
 
+
+@query_budget(10)
 def all_games(request: HttpRequest) -> HttpResponse:
-    cursor = connection.cursor()
-    cursor.execute('''
-    SELECT
-         auth_user.username as name,
-         challenge_entry.name as entry_id
-    FROM
-         auth_user, challenge_entry, challenge_entry_users
-    WHERE
-         auth_user.id = challenge_entry_users.user_id AND
-         challenge_entry_users.entry_id = challenge_entry.name AND
-         challenge_entry.has_final = true AND
-         challenge_entry.challenge_id < 1000
-    ''')
-    users: dict[str, list[str]] = {}
-    for name, entry_id in cursor.fetchall():
-       users.setdefault(entry_id, []).append(name)
-    cursor.execute('''
-    SELECT
-         challenge_entry.name as entry_id,
-         challenge_entry.title as title,
-         challenge_entry.game as game,
-         challenge_entry.winner_id as winner,
-         challenge_entry.challenge_id as challenge_num,
-         challenge_ratingtally.overall as rating
-    FROM
-         challenge_entry
-    LEFT OUTER JOIN challenge_ratingtally ON
-         (challenge_entry.name = challenge_ratingtally.entry_id)
-    WHERE
-         challenge_entry.has_final = true AND
-         challenge_entry.challenge_id < 1000
-    ORDER BY
-         rating DESC
-    ''')
-    all_entries: list[dict[str, Any]] = []
-    u = urllib.parse.quote
-    e = html.escape
-    for entry_id, title, game, winner, challenge_num, rating in cursor.fetchall():
-        team = ',\n'.join([f'<a class="small" href="/u/{u(n)}">{e(n)}</a>'
-            for n in users[entry_id]])
-        all_entries.append(dict(entry_id=entry_id, game_name=game or title,
-            challenge_num=challenge_num, winner=winner, rating=rating,
-            team=team))
+    # Until the refresh_all_games command has first been run, this is empty
+    all_entries = list(models.GameListing.objects.all())
     return render(
         request,
         'challenge/all_games.html',
@@ -203,14 +189,28 @@ def challenge_ratings(request, challenge_id):
         messages.error(request, 'Cannot view the ratings until the judging period is over!')
         return HttpResponseRedirect(f"/{challenge_id}/")
 
+    # Rank by the scores the winners were picked by
+    categories = ('overall', 'fun', 'innovation', 'production')
+    if challenge.rank_normalised:
+        fields = [f'{cat}_normalised' for cat in categories]
+    else:
+        fields = list(categories)
+
     individual = []
     team = []
-    for rating in models.RatingTally.objects.filter(challenge=challenge).order_by('-overall'):
+    for rating in models.RatingTally.objects.filter(
+            challenge=challenge).order_by('-' + fields[0]):
+        rating.scores = [getattr(rating, field) for field in fields]
         if rating.individual:
             individual.append(rating)
         else:
             team.append(rating)
 
+    def top(ratings, i):
+        """Get the top three (score, rating) pairs by the ith score."""
+        ratings = sorted(ratings, key=lambda r: r.scores[i], reverse=True)
+        return [(rating.scores[i], rating) for rating in ratings[:3]]
+
     return render(
         request,
         'challenge/ratings.html',
@@ -219,15 +219,15 @@ def challenge_ratings(request, challenge_id):
             'polls': challenge.poll_set.filter(is_hidden__exact=False),
             'all_done': all_done,
             'individual_ratings': individual,
-            'individual_overall': individual[:3],
-            'individual_fun': sorted(individual, key=lambda x: x.fun, reverse=True)[:3],
-            'individual_inno': sorted(individual, key=lambda x: x.innovation, reverse=True)[:3],
-            'individual_prod': sorted(individual, key=lambda x: x.production, reverse=True)[:3],
+            'individual_overall': top(individual, 0),
+            'individual_fun': top(individual, 1),
+            'individual_inno': top(individual, 2),
+            'individual_prod': top(individual, 3),
             'team_ratings': team,
-            'team_overall': team[:3],
-            'team_fun': sorted(team, key=lambda x: x.fun, reverse=True)[:3],
-            'team_inno': sorted(team, key=lambda x: x.innovation, reverse=True)[:3],
-            'team_prod': sorted(team, key=lambda x: x.production, reverse=True)[:3],
+            'team_overall': top(team, 0),
+            'team_fun': top(team, 1),
+            'team_inno': top(team, 2),
+            'team_prod': top(team, 3),
         }
     )
 
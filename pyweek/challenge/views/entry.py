@@ -1,8 +1,6 @@
 import urllib.request
 import urllib.parse
 import urllib.error
-import random
-import hashlib
 import operator
 
 from django import forms
@@ -13,12 +11,13 @@ from django.template import RequestContext
 from django.http import (
     HttpResponse, HttpResponseRedirect, HttpResponseForbidden
 )
-from pyweek.challenge import models
+from pyweek.challenge import models, shuffle
 from pyweek import settings
 from django.core import validators
 from django.contrib.auth.decorators import login_required
 
 from pyweek.bleaching import html2text, html2safehtml
+from pyweek.instrumentation import query_budget
 from pyweek.activity.models import log_event
 from pyweek.activity.summary import summarise
 from pyweek.mail import sending
@@ -137,6 +136,7 @@ class AddEntryForm(BaseEntryForm):
         ]
 
 
+@query_budget(15)
 def entry_list(request, challenge_id):
     challenge = get_object_or_404(models.Challenge, pk=challenge_id)
 
@@ -145,40 +145,32 @@ def entry_list(request, challenge_id):
     all_done = challenge.isAllDone()
 
     may_rate = user_may_rate(challenge, request.user)
-    # may rate at all
-    may_rate = False
-    if not all_done and not request.user.is_anonymous and challenge.isRatingOpen():
-        username = request.user.username
-        for e in models.Entry.objects.filter(challenge=challenge_id, users__username__exact=username):
-            if e.has_final:
-                may_rate = True
-                break
-
-    # random sorting per-user
-    r = random.random()
-    s = int(hashlib.md5(request.user.username.encode()).hexdigest()[:8], 16)
-    random.seed(s)
-
-    for entry in models.Entry.objects.filter(challenge=challenge_id):
+    rated = set()
+    if may_rate:
+        rated = set(request.user.rating_set.filter(
+            entry__challenge=challenge,
+        ).values_list('entry_id', flat=True))
+
+    challenge_entries = list(models.Entry.objects.for_entry_list(challenge))
+    thumbs = models.File.objects.in_bulk(
+        [e.thumb_id for e in challenge_entries if e.thumb_id is not None]
+    )
+
+    for entry in challenge_entries:
         if all_done:
             files = []
             found_final = False
-            for file in entry.file_set.filter(is_screenshot__exact=False):
+            for file in entry.downloads:
                 if file.is_final: found_final = True
                 elif found_final: break
                 files.append(file)
             if not found_final and finished:
                 continue
         else:
-            files = entry.file_set.filter(is_final__exact=True,
-                is_screenshot__exact=False)
+            files = [f for f in entry.downloads if f.is_final]
             if not files and finished:
                 continue
 
-        shots = entry.file_set.filter(is_screenshot__exact=True).order_by("-created")[:1]
-        thumb = None
-        if shots: thumb = shots[0]
-
         info = {
             'entry': entry,
             'name': entry.name,
@@ -186,21 +178,28 @@ def entry_list(request, challenge_id):
             'title': entry.title,
             # 'description': description,
             'files': files,
-            'sortname': random.random(),
+            'sortname': shuffle.order_key(request.user, entry.name),
             'may_rate': False,
-            'thumb': thumb,
-            'num_ratings': len(entry.rating_set.all()),
+            'thumb': thumbs.get(entry.thumb_id),
+            'num_ratings': entry.num_ratings,
         }
         if may_rate and finished:
-            info['has_rated'] = entry.has_rated(request.user)
+            info['has_rated'] = entry.pk in rated
         if may_rate and request.user not in entry.users.all():
             info['may_rate'] = True
         entries.append(info)
 
-    # reset random generator
-    random.seed(r)
-
-    entries.sort(key=operator.itemgetter('sortname', 'num_ratings'))
+    if may_rate and finished:
+        # List the entries the judge may still rate first, least rated
+        # first, to spread ratings evenly
+        entries.sort(key=lambda info: (
+            not info['may_rate'],
+            info.get('has_rated', False),
+            info['num_ratings'],
+            info['sortname'],
+        ))
+    else:
+        entries.sort(key=operator.itemgetter('sortname'))
 
     return render(request, 'challenge/entries.html', {
             'challenge': challenge,
@@ -238,88 +237,89 @@ def user_may_rate(challenge, user):
     return user_has_final
 
 
-def rating_dashboard(request, challenge_id):
-    """A view of entries organised by which have been rated."""
-    challenge = get_object_or_404(models.Challenge, pk=challenge_id)
+# Number of entries suggested to rate next
+RATE_NEXT = 5
 
-    if not user_may_rate(challenge, request.user):
-        return HttpResponseForbidden()
 
-    final_entries = models.Entry.objects.filter(
-        challenge=challenge_id,
-        has_final=True,
-    ).annotate(
-        author_count=md.Count('users', distinct=True),
-        ratings_count=md.Count('rating'),
-        ratings_nw=md.Count('rating', nonworking=True),
-    ).select_related('user').prefetch_related(
-        md.Prefetch(
-            'entryaward_set',
-            queryset=request.user.entryaward_set.all()
-        )
-    )
-    user_ratings = models.Rating.objects.filter(
-        user__username__exact=request.user.username,
-        entry__challenge=challenge_id,
-    )
-    ratings_by_entry = {r.entry.pk: r for r in user_ratings}
+def load_rating_dashboard(challenge, user):
+    """Get the entries of a challenge sorted by the user's progress rating.
 
-    your_entries = set(models.Entry.objects.filter(
-        challenge=challenge_id,
-        users__username__exact=request.user.username,
-    ).values_list('pk', flat=True))
+    Return a dict of lists of entry details, under 'rated', 'not_rated',
+    'not_working' and 'yours'. The lists are shuffled the same way each
+    time for the user. Under 'rate_next' are the unrated entries that
+    have the fewest ratings from anyone. This takes three queries however
+    many entries there are.
 
-    rated = []
-    not_rated = []
-    not_working = []
-    yours = []
+    """
+    final_entries = models.Entry.objects.for_rating_dashboard(challenge, user)
+    ratings_by_entry = {
+        r.entry_id: r
+        for r in models.Rating.objects.filter(
+            user=user,
+            entry__challenge=challenge,
+        )
+    }
+
+    dashboard = {
+        'rated': [],
+        'not_rated': [],
+        'not_working': [],
+        'yours': [],
+    }
     for entry in final_entries:
         r = ratings_by_entry.get(entry.pk)
-        if r:
-            fun = r.fun
-            prod = r.production
-            inno = r.innovation
-            nw = r.nonworking
-            dq = r.disqualify
-        else:
-            fun = prod = inno = None
-            dq = nw = False
-        is_team = entry.author_count > 1
+        is_team = entry.is_team()
         info = {
             'name': entry.name,
             'game': entry.game,
             'title': entry.title,
             'owner': entry.title if is_team else entry.user.username,
             'is_team': is_team,
-            'sortname': hash((request.user.username, entry.pk)),
-            'fun': fun,
-            'prod': prod,
-            'inno': inno,
-            'awards': entry.entryaward_set.filter(creator=request.user),
-            'dq': dq,
+            'fun': r and r.fun,
+            'prod': r and r.production,
+            'inno': r and r.innovation,
+            'awards': entry.user_awards,
+            'dq': bool(r and r.disqualify),
+            'num_ratings': entry.num_ratings,
             'nw_pct': (
-                (entry.ratings_nw * 100.0 / entry.ratings_count)
-                if entry.ratings_count != 0 else 0
+                (entry.num_nonworking * 100.0 / entry.num_ratings)
+                if entry.num_ratings != 0 else 0
             ),
         }
-        if entry.pk in your_entries:
-            yours.append(info)
-        elif nw:
-            not_working.append(info)
+        if entry.is_yours:
+            dashboard['yours'].append(info)
+        elif r and r.nonworking:
+            dashboard['not_working'].append(info)
         elif r:
-            rated.append(info)
+            dashboard['rated'].append(info)
         else:
-            not_rated.append(info)
+            dashboard['not_rated'].append(info)
+
+    name = operator.itemgetter('name')
+    dashboard = {
+        k: shuffle.shuffled(es, user, name=name)
+        for k, es in dashboard.items()
+    }
+    dashboard['rate_next'] = shuffle.by_fewest_ratings(
+        dashboard['not_rated'],
+        user,
+        num_ratings=operator.itemgetter('num_ratings'),
+        name=name,
+    )[:RATE_NEXT]
+    return dashboard
+
+
+@query_budget(12)
+def rating_dashboard(request, challenge_id):
+    """A view of entries organised by which have been rated."""
+    challenge = get_object_or_404(models.Challenge, pk=challenge_id)
 
-    for es in (rated, not_rated, yours):
-        es.sort(key=lambda e: hash((request.user.username, e['name'])))
+    if not user_may_rate(challenge, request.user):
+        return HttpResponseForbidden()
 
     return render(request, 'challenge/rating-dash.html', {
             'challenge': challenge,
-            'rated': rated,
-            'not_rated': not_rated,
-            'not_working': not_working,
-            'yours': yours,
+            **load_rating_dashboard(challenge, request.user),
         }
     )
 
@@ -391,7 +391,10 @@ def entry_display(request, entry_id):
     challenge = entry.challenge
     user_list = entry.users.all()
     is_member = request.user in list(user_list)
-    files = entry.file_set.filter(is_screenshot__exact=True).order_by("-created")[:1]
+    files = entry.file_set.filter(
+        is_screenshot__exact=True,
+        thumb_width__gt=0,
+    ).order_by("-created")[:1]
     thumb = None
     if files: thumb = files[0]
 
@@ -1,21 +1,51 @@
 import os
+import re
 import datetime
 
 from PIL import Image
 
 from django import forms
 from django.contrib import messages
+from django.core.files import File as DjangoFile
+from django.core.files.storage import default_storage
+from django.db import transaction
 from django.shortcuts import render, get_object_or_404
 from django.template import RequestContext
-from django.http import HttpResponse, HttpResponseRedirect
+from django.http import (
+    HttpResponse, HttpResponseRedirect, HttpResponseNotAllowed, JsonResponse
+)
 from pyweek.challenge import models
 from pyweek import settings
-from pyweek.settings import MEDIA_ROOT
-from pyweek.activity.models import log_event
 
 from pyweek.bleaching import html2text
 
 
+def _file_exists(entry, filename):
+    """Check whether the entry already has a file with this filename."""
+    name = default_storage.generate_filename(
+        models.file_upload_location(
+            models.File(challenge=entry.challenge, entry=entry),
+            filename,
+        )
+    )
+    return entry.file_set.filter(content=name).exists()
+
+
+def _is_image(content):
+    """Check whether an upload starts with an image header we can read.
+
+    Only the header is read; the thumbnail is made in the background.
+
+    """
+    try:
+        Image.open(content)
+    except (IOError, Image.DecompressionBombError):
+        return False
+    finally:
+        content.seek(0)
+    return True
+
+
 class FileForm(forms.Form):
     content = forms.FileField()
     description = forms.CharField(max_length=255)
@@ -29,7 +59,11 @@ def entry_upload(request, entry_id):
     challenge = entry.challenge
 
     is_member = request.user in entry.users.all()
-    if not is_member or not entry.isUploadOpen():
+    # After the deadline, files matching registered checksums are accepted
+    against_checksum = (
+        not entry.isUploadOpen() and entry.isChecksumUploadOpen()
+    )
+    if not is_member or not (entry.isUploadOpen() or against_checksum):
         messages.error(request, "You're not allowed to upload files!")
         return HttpResponseRedirect(f'/e/{entry_id}/')
 
@@ -45,6 +79,7 @@ def entry_upload(request, entry_id):
         'is_member': True,
         'is_owner': entry.user == request.user,
         'form': f,
+        'against_checksum': against_checksum,
     }
 
     # just display the form?
@@ -57,48 +92,52 @@ def entry_upload(request, entry_id):
         return render(request, 'challenge/entry_file.html', info)
 
     # avoid dupes
-    if os.path.exists(os.path.join(MEDIA_ROOT, str(challenge.number), entry.name,
-            request.FILES['content'].name)):
+    if _file_exists(entry, request.FILES['content'].name):
         f._errors['content'] = f.error_class(["File with that filename already exists."])
         return render(request, 'challenge/entry_file.html', info)
 
+    checksum = None
+    if against_checksum:
+        checksum = models.FileChecksum.objects.match(
+            entry, request.FILES['content']
+        )
+        if checksum is None:
+            f._errors['content'] = f.error_class([
+                "This file doesn't match a checksum registered for the entry."
+            ])
+            return render(request, 'challenge/entry_file.html', info)
+
+    content = request.FILES['content']
+    if f.cleaned_data['is_screenshot'] and not _is_image(content):
+        messages.error(request, 'File is not an image')
+        return render(request, 'challenge/entry_file.html', info)
+
     file = models.File(
         challenge=challenge,
         entry=entry,
         user=request.user,
         created=datetime.datetime.utcnow(),
-        content=request.FILES['content'],
         description=html2text(f.cleaned_data['description']),
-        is_final=f.cleaned_data['is_final'],
+        is_final=f.cleaned_data['is_final'] or checksum is not None,
         is_screenshot=f.cleaned_data['is_screenshot'],
         thumb_width=0,
     )
+    file.store(request.FILES['content'], request.FILES['content'].name)
     file.save()
+    if checksum:
+        checksum.file = file
+        checksum.save()
     if file.is_final:
         entry.has_final = True
         entry.save()
 
     if file.is_screenshot:
-        try:
-            _make_thumbnail(file)
-        except IOError as e:
-            # XXX need feedback with custom error "file is not an image"
-            msg = e.args[0]
-            if not msg.startswith('cannot identify image file'):
-                raise
-            messages.error(request, 'File is not an image')
-            return render(request, 'challenge/entry_file.html', info)
-
-        log_event(
-            type='new-screenshot',
-            user=request.user,
-            target=file,
-            challenge=challenge.number,
-            game=entry.display_title,
-            name=entry.name,
-            description=file.description,
-            role=file.get_image_role(),
+        models.ThumbnailJob.objects.create(file=file)
+        messages.success(
+            request,
+            'Screenshot added! Its thumbnail will appear shortly.'
         )
+        return HttpResponseRedirect(f'/e/{entry_id}/')
 
     messages.success(request, 'File added!')
     return HttpResponseRedirect(f'/e/{entry_id}/')
@@ -127,7 +166,11 @@ def oneshot_upload(request, entry_id):
         return HttpResponse('Invalid login')
 
     # check authorisation
-    if not user in entry.users.all() or not entry.isUploadOpen():
+    against_checksum = (
+        not entry.isUploadOpen() and entry.isChecksumUploadOpen()
+    )
+    if not user in entry.users.all() or not (
+            entry.isUploadOpen() or against_checksum):
         return HttpResponse("You're not allowed to upload files!")
 
     # make sure user isn't sneeeky
@@ -136,52 +179,326 @@ def oneshot_upload(request, entry_id):
         return HttpResponse('Final uploads are not allowed now')
 
     # avoid dupes
-    if os.path.exists(os.path.join(MEDIA_ROOT, str(challenge.number), entry.name,
-            request.FILES['content_file'].name)):
+    if _file_exists(entry, request.FILES['content_file'].name):
         return HttpResponse('File with that filename already exists.')
 
     upload_file = request.FILES['content_file']
+    checksum = None
+    if against_checksum:
+        checksum = models.FileChecksum.objects.match(entry, upload_file)
+        if checksum is None:
+            return HttpResponse(
+                "This file doesn't match a checksum registered for the entry."
+            )
+
+    is_screenshot = bool(data.get('is_screenshot', False))
+    if is_screenshot and not _is_image(upload_file):
+        return HttpResponse('File is not an image')
+
     file = models.File(
         challenge=challenge,
         entry=entry,
         user=user,
         created=datetime.datetime.now(models.UTC),
-        content=upload_file,
         description=html2text(data.get('description', '')),
-        is_final=bool(data.get('is_final', False)),
-        is_screenshot=bool(data.get('is_screenshot', False)),
+        is_final=bool(data.get('is_final', False)) or checksum is not None,
+        is_screenshot=is_screenshot,
         thumb_width=0,
     )
+    file.store(upload_file, upload_file.name)
     file.save()
+    if checksum:
+        checksum.file = file
+        checksum.save()
     if file.is_final:
         entry.has_final = True
         entry.save()
 
-    if data['is_screenshot']:
-        try:
-            _make_thumbnail(upload_file)
-        except IOError as e:
-            return HttpResponse(
-                f'Error uploading screenshot: {e}'
-            )
+    if file.is_screenshot:
+        models.ThumbnailJob.objects.create(file=file)
     return HttpResponse('File added!')
 
 
-import io
-import posixpath
-from django.core.files.storage import get_storage_class
+class ChecksumForm(forms.Form):
+    md5 = forms.RegexField(
+        regex=r'^[0-9a-fA-F]{32}$',
+        label='MD5',
+        error_messages={'invalid': 'Enter the 32 hex digits of the MD5.'},
+    )
+    description = forms.CharField(max_length=255)
 
 
-def _make_thumbnail(file):
-    image = Image.open(io.BytesIO(file.content.read()))
-    image.thumbnail((150, 150))
-    target = file.content.name + '-thumb.png'
+def entry_checksum(request, entry_id):
+    """Register the checksum of a final entry, to upload it later.
+
+    Like oneshot_upload, this also accepts a POST with the user's
+    credentials from the upload script, and then responds in plain text.
+
+    """
+    entry = get_object_or_404(models.Entry, pk=entry_id)
+    challenge = entry.challenge
+    from_script = request.user.is_anonymous
+    user = _upload_user(request)
+    if user is None:
+        if from_script and request.method != 'POST':
+            return HttpResponseRedirect('/login/')
+        return HttpResponse('Invalid login')
+
+    def refuse(msg):
+        if from_script:
+            return HttpResponse(msg)
+        messages.error(request, msg)
+        return HttpResponseRedirect(f'/e/{entry_id}/')
+
+    if user not in entry.users.all():
+        return refuse("You're not allowed to register checksums!")
+    if not challenge.isChecksumTime():
+        return refuse("Checksums may only be registered just before the "
+                      "upload deadline.")
+
+    checksums = entry.filechecksum_set.all()
+    if request.method == 'POST':
+        f = ChecksumForm(request.POST)
+    else:
+        f = ChecksumForm()
+
+    if f.is_valid():
+        if (models.MAX_CHECKSUMS is not None
+                and len(checksums) >= models.MAX_CHECKSUMS):
+            return refuse(f"You may only register {models.MAX_CHECKSUMS} "
+                          f"checksums.")
+        models.FileChecksum.objects.create(
+            entry=entry,
+            user=user,
+            md5=f.cleaned_data['md5'].lower(),
+            description=html2text(f.cleaned_data['description']),
+        )
+        deadline = challenge.upload_deadline() + datetime.timedelta(
+            models.EXTRA_DAYS
+        )
+        msg = (f"Checksum registered! Upload the file by "
+               f"{deadline:%Y-%m-%d %H:%M} UTC.")
+        if from_script:
+            return HttpResponse(msg)
+        messages.success(request, msg)
+        return HttpResponseRedirect(f'/e/{entry_id}/checksum/')
+    elif from_script:
+        return HttpResponse(f'Invalid checksum: {f.errors.as_text()}')
+
+    return render(request, 'challenge/entry_checksum.html', {
+        'challenge': challenge,
+        'entry': entry,
+        'checksums': checksums,
+        'is_member': True,
+        'is_owner': entry.user == user,
+        'form': f,
+        'max_checksums': models.MAX_CHECKSUMS,
+        'extra_days': models.EXTRA_DAYS,
+    })
+
+
+# Largest chunk accepted by a single PUT to a chunked upload
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+
+CONTENT_RANGE_RE = re.compile(r'^bytes (\d+)-(\d+)/(\d+)$')
+
+
+class UploadSessionForm(forms.Form):
+    filename = forms.CharField(max_length=255)
+    size = forms.IntegerField(min_value=1)
+    description = forms.CharField(max_length=255)
+    is_final = forms.BooleanField(required=False)
+    is_screenshot = forms.BooleanField(required=False)
+
+
+def _upload_user(request):
+    """Get the user making an upload API request, or None.
+
+    Like oneshot_upload, the CLI may send its credentials with the request.
+
+    """
+    if request.user.is_authenticated:
+        return request.user
+    user = models.User.objects.filter(
+        username__exact=request.POST.get('user', '')
+    ).first()
+    if user and user.check_password(request.POST.get('password', '')):
+        return user
+    return None
+
+
+def _upload_refusal(entry, user, is_final):
+    """Get the reason the user may not upload to the entry now, if any.
+
+    After the deadline, final files may still be uploaded if the entry has
+    registered checksums; the file must be checked against them.
+
+    """
+    if user not in entry.users.all():
+        return "You're not allowed to upload files!"
+    if not entry.isUploadOpen() and not (
+            is_final and entry.isChecksumUploadOpen()):
+        return "You're not allowed to upload files!"
+    if is_final and not entry.challenge.isFinalUploadOpen():
+        return 'Final uploads are not allowed now'
+    return None
 
-    storage = get_storage_class()
-    with storage().open(target, 'wb') as f:
-        image.save(f, "PNG")
-    file.thumb_width = image.size[0]
-    file.save()
+
+def _session_status(session):
+    return {
+        'url': f'/uploads/{session.token}/',
+        'size': session.size,
+        'received': session.received,
+        'chunk_size': UPLOAD_CHUNK_SIZE,
+    }
+
+
+def upload_start(request, entry_id):
+    """Start a chunked upload of a file to an entry.
+
+    The file is then sent in order with PUT requests to the session URL,
+    each with a Content-Range header, and the upload finished with a POST
+    of its SHA-256 to the session's finish URL. A GET of the session URL
+    says how much has been received, so that an interrupted upload can be
+    resumed.
+
+    """
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    entry = get_object_or_404(models.Entry, pk=entry_id)
+    user = _upload_user(request)
+    if user is None:
+        return JsonResponse({'error': 'Invalid login'}, status=403)
+
+    form = UploadSessionForm(request.POST)
+    if not form.is_valid():
+        return JsonResponse({'error': form.errors}, status=400)
+    data = form.cleaned_data
+
+    refusal = _upload_refusal(entry, user, data['is_final'])
+    if refusal:
+        return JsonResponse({'error': refusal}, status=403)
+
+    filename = os.path.basename(data['filename'])
+    if _file_exists(entry, filename):
+        return JsonResponse(
+            {'error': 'File with that filename already exists.'},
+            status=409,
+        )
+
+    session = models.UploadSession.objects.create(
+        entry=entry,
+        user=user,
+        filename=filename,
+        description=html2text(data['description']),
+        is_final=data['is_final'],
+        is_screenshot=data['is_screenshot'],
+        size=data['size'],
+    )
+    return JsonResponse(_session_status(session), status=201)
+
+
+def upload_chunk(request, token):
+    """Get the status of a chunked upload, or PUT the next chunk."""
+    if request.method == 'GET':
+        session = get_object_or_404(models.UploadSession, pk=token)
+        return JsonResponse(_session_status(session))
+    if request.method != 'PUT':
+        return HttpResponseNotAllowed(['GET', 'PUT'])
+
+    length = int(request.META.get('CONTENT_LENGTH') or 0)
+    if length > UPLOAD_CHUNK_SIZE:
+        return JsonResponse(
+            {'error': f'Chunks may be at most {UPLOAD_CHUNK_SIZE} bytes'},
+            status=413,
+        )
+    mo = CONTENT_RANGE_RE.match(request.META.get('HTTP_CONTENT_RANGE', ''))
+    if not mo:
+        return JsonResponse({'error': 'Content-Range is required'}, status=400)
+    start, end, total = map(int, mo.groups())
+
+    with transaction.atomic():
+        session = get_object_or_404(
+            models.UploadSession.objects.select_for_update(),
+            pk=token
+        )
+        if total != session.size or end - start + 1 != length:
+            return JsonResponse({'error': 'Invalid Content-Range'}, status=400)
+        if start != session.received:
+            # The client must resume from where we got to
+            return JsonResponse(_session_status(session), status=409)
+        try:
+            session.append(iter(lambda: request.read(1 << 16), b''))
+        except ValueError as e:
+            return JsonResponse({'error': str(e)}, status=400)
+    return JsonResponse(_session_status(session))
+
+
+def upload_finish(request, token):
+    """Finish a chunked upload, creating the File if its checksum matches."""
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    with transaction.atomic():
+        session = get_object_or_404(
+            models.UploadSession.objects.select_for_update(),
+            pk=token
+        )
+        entry = session.entry
+        refusal = _upload_refusal(entry, session.user, session.is_final)
+        if refusal:
+            return JsonResponse({'error': refusal}, status=403)
+        if session.received != session.size:
+            return JsonResponse(_session_status(session), status=409)
+        if session.checksum() != request.POST.get('sha256', '').lower():
+            session.discard()
+            return JsonResponse(
+                {'error': 'Checksum does not match; please upload again'},
+                status=400,
+            )
+
+        with open(session.path, 'rb') as f:
+            checksum = None
+            if not entry.isUploadOpen():
+                checksum = models.FileChecksum.objects.match(
+                    entry, DjangoFile(f)
+                )
+                if checksum is None:
+                    session.discard()
+                    return JsonResponse(
+                        {'error': "This file doesn't match a checksum "
+                                  "registered for the entry."},
+                        status=403,
+                    )
+                f.seek(0)
+            if session.is_screenshot and not _is_image(f):
+                session.discard()
+                return JsonResponse(
+                    {'error': 'File is not an image'},
+                    status=400,
+                )
+            file = models.File(
+                challenge=entry.challenge,
+                entry=entry,
+                user=session.user,
+                created=datetime.datetime.utcnow(),
+                description=session.description,
+                is_final=session.is_final,
+                is_screenshot=session.is_screenshot,
+                thumb_width=0,
+            )
+            file.store(DjangoFile(f), session.filename)
+            file.save()
+        session.discard()
+        if checksum:
+            checksum.file = file
+            checksum.save()
+
+        if file.is_final:
+            entry.has_final = True
+            entry.save()
+        if file.is_screenshot:
+            models.ThumbnailJob.objects.create(file=file)
+    return JsonResponse({'url': file.content.url}, status=201)
 
 
 def file_delete(request, entry_id, filename):
@@ -202,13 +519,10 @@ def file_delete(request, entry_id, filename):
             except (models.File.DoesNotExist, IndexError):
                 pass
             else:
-                filename = ob.content.name
+                ob.delete_thumbnails()
                 ob.content.delete()
                 ob.delete()
 
-                storage = get_storage_class()()
-                storage.delete(filename + '-thumb.png')
-
                 messages.success(request, 'File deleted')
                 return HttpResponseRedirect(f'/e/{entry_id}/')
         else:
@@ -3,9 +3,11 @@ import datetime
 import xml.sax.saxutils
 
 from django import forms
+from django.db import connection
 from django.db.models import Q
 from django.contrib import messages
 from django.contrib.syndication.views import Feed
+from django.core.cache import cache
 from django.shortcuts import get_object_or_404, render
 from django.template import RequestContext
 from django.http import HttpResponse, HttpResponseRedirect
@@ -16,6 +18,7 @@ from pyweek.users.models import EmailAddress
 from pyweek.mail import sending
 from pyweek.activity.models import log_event
 from pyweek.activity.summary import summarise
+from pyweek.instrumentation import query_budget
 
 from pyweek.bleaching import html2text, html2safehtml, SAFE_TAGS
 
@@ -32,51 +35,27 @@ class SafeHTMLField(forms.CharField):
 
 MESSAGES_PER_PAGE = 30
 
+# Seconds to cache the number of discussion threads, shown as a page count
+THREAD_COUNT_CACHE_TIME = 10*60
+THREAD_COUNT_CACHE_KEY = 'discussion-thread-count'
+
 def update_messages(request):
-    for entry in models.DiaryEntry.objects.filter(is_pyggy=False):
-        try:
-            comment = entry.diarycomment_set.latest()
-        except models.DiaryComment.DoesNotExist:
-            entry.actor = entry.user
-            entry.last_comment = None
-            entry.activity = entry.created
-            entry.reply_count = 0
-        else:
-            entry.actor = comment.user
-            entry.last_comment = comment
-            entry.activity = comment.created
-            entry.reply_count = entry.diarycomment_set.count()
-        entry.save()
+    models.DiaryEntry.objects.update_activity()
     messages.success(request, 'Messages updated')
     return render(request, 'challenge/index.html', {})
 
 
 def extract_entries(entries):
+    """Get the details of threads shown in the discussion board.
+
+    The entries should be selected with their users and actors. Dates are
+    shown relative to now by the page's script, so the details are the same
+    for everyone.
+
+    """
     diary_entries = []
-    now = datetime.datetime.utcnow()
     for diary in entries:
         entry = diary.entry
-        comm = diary.last_comment
-
-        activity = diary.activity
-        delta = now - activity
-        if activity.year != now.year:
-            date = activity.strftime(f'{int(activity.day)} %b %Y')
-        elif delta.days < 1:
-            if delta.seconds < 30:
-                date = 'just now'
-            elif delta.seconds < 120:
-                date = 'a minute ago'
-            elif delta.seconds < 7200:
-                date = f'{int(delta.seconds / 60)} minutes ago'
-            else:
-                date = f'{int(delta.seconds / 3600)} hours ago'
-        elif delta.days == 1:
-            date = activity.strftime('%H:%M yesterday')
-        elif delta.days < 8:
-            date = activity.strftime('%H:%M %A')
-        else:
-            date = activity.strftime('%%a %d %%b'%activity.day)
         d = dict(
             title = diary.title,
             id = diary.id,
@@ -85,61 +64,126 @@ def extract_entries(entries):
             reply_count = diary.reply_count,
             originator=diary.user,
             sticky=diary.sticky,
-            author = comm and diary.actor or diary.user,
-            date = date,
-            commid = comm and comm.id,
+            author = diary.last_comment_id and diary.actor or diary.user,
+            activity = diary.activity,
+            commid = diary.last_comment_id,
         )
         diary_entries.append(d)
     return diary_entries
 
 
+def thread_cursor(diary):
+    """Get the position of a thread in the discussion board, for links."""
+    return f'{diary.sticky:d}_{diary.activity:%Y%m%d%H%M%S%f}_{diary.id}'
+
+
+def parse_thread_cursor(value):
+    """Get (sticky, activity, id) from a thread_cursor().
+
+    Raise ValueError if it isn't one.
+
+    """
+    sticky, activity, pk = value.split('_')
+    return (
+        sticky == '1',
+        datetime.datetime.strptime(activity, '%Y%m%d%H%M%S%f'),
+        int(pk),
+    )
+
+
+def _threads_beyond(threads, op, sticky, activity, pk):
+    # A row value comparison, in the order of the diaryentry_threads index,
+    # so that the database can start reading the index at the position
+    # rather than filtering every row before it
+    qn = connection.ops.quote_name
+    table = qn(models.DiaryEntry._meta.db_table)
+    columns = ', '.join(
+        f'{table}.{qn(column)}' for column in ('sticky', 'activity', 'id')
+    )
+    return threads.extra(
+        where=[f'({columns}) {op} (%s, %s, %s)'],
+        params=[
+            sticky,
+            connection.ops.adapt_datetimefield_value(activity),
+            pk,
+        ],
+    )
+
+
+def threads_after(threads, sticky, activity, pk):
+    """Filter threads to those that come after a position in the board."""
+    return _threads_beyond(threads, '<', sticky, activity, pk)
+
+
+def threads_before(threads, sticky, activity, pk):
+    """Filter threads to those that come before a position in the board."""
+    return _threads_beyond(threads, '>', sticky, activity, pk)
+
+
+def thread_count():
+    """Count the discussion board threads, as of a few minutes ago."""
+    count = cache.get(THREAD_COUNT_CACHE_KEY)
+    if count is None:
+        count = models.DiaryEntry.objects.threads().count()
+        cache.set(THREAD_COUNT_CACHE_KEY, count, THREAD_COUNT_CACHE_TIME)
+    return count
+
+
+@query_budget(8)
 def list_messages(request):
+    """List the discussion threads a page at a time.
+
+    Pages are found by the position of the thread before or after them
+    rather than by an offset, so that later pages are as cheap as the
+    first and don't shift as threads become active.
+
+    """
+    threads = models.DiaryEntry.objects.threads().select_related(
+        'user', 'actor',
+    )
+    num_pages = max((thread_count() - 1) // MESSAGES_PER_PAGE + 1, 1)
     try:
-        start = int(request.GET.get('start', 0))
+        page = max(int(request.GET.get('page', 1)), 1)
+        after = before = None
+        if request.GET.get('after'):
+            after = parse_thread_cursor(request.GET['after'])
+        elif request.GET.get('before'):
+            before = parse_thread_cursor(request.GET['before'])
     except ValueError:
         # XXX haxx0rs trying to inject SQL into my codez
-        start = 0
-
-    # entries to display
-    entries = models.DiaryEntry.objects.filter(
-        is_pyggy=False,
-        entry__isnull=True).order_by('-sticky', '-activity')
-    diary_entries = extract_entries(entries[start:start + MESSAGES_PER_PAGE])
-
-    # pagination
-    n = start // MESSAGES_PER_PAGE
-    num = len(entries)
-    m = (num // MESSAGES_PER_PAGE) + 1
-    if n < 5:
-        s = 0
-        e = n + 10
-        more_start = False
-        more_end = True
-    elif n + 5 > m:
-        s = n - 5
-        e = m
-        more_start = True
-        more_end = False
+        page = 1
+        after = before = None
+
+    if after:
+        rows = list(threads_after(threads, *after)[:MESSAGES_PER_PAGE + 1])
+        has_prev = True
+        has_next = len(rows) > MESSAGES_PER_PAGE
+        rows = rows[:MESSAGES_PER_PAGE]
+    elif before or 'last' in request.GET:
+        # Read the page backwards from its end
+        if before:
+            threads = threads_before(threads, *before)
+            has_next = True
+        else:
+            page = num_pages
+            has_next = False
+        rows = list(threads.reverse()[:MESSAGES_PER_PAGE + 1])
+        has_prev = len(rows) > MESSAGES_PER_PAGE
+        rows = rows[MESSAGES_PER_PAGE - 1::-1]
     else:
-        s = n - 5
-        e = n + 5
-        more_start = True
-        more_end = True
-
-    pages = [
-        dict(num=i+1, start=i*MESSAGES_PER_PAGE,
-            current=start==i*MESSAGES_PER_PAGE)
-                for i in range(s, e)
-    ]
+        rows = list(threads[:MESSAGES_PER_PAGE + 1])
+        has_prev = False
+        has_next = len(rows) > MESSAGES_PER_PAGE
+        rows = rows[:MESSAGES_PER_PAGE]
 
+    if not has_prev:
+        page = 1
     return render(request, 'messages.html', {
-        'diary_entries': diary_entries,
-        'pages': pages,
-        'prev': start and start-MESSAGES_PER_PAGE or None,
-        'last': (m-1) * MESSAGES_PER_PAGE,
-        'more_start': more_start,
-        'more_end': more_end,
-        'next': start+MESSAGES_PER_PAGE < num and start+MESSAGES_PER_PAGE or None,
+        'diary_entries': extract_entries(rows),
+        'page': page,
+        'num_pages': max(num_pages, page),
+        'prev': thread_cursor(rows[0]) if has_prev and rows else None,
+        'next': thread_cursor(rows[-1]) if has_next and rows else None,
     })
 
 
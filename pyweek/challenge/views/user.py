@@ -7,7 +7,6 @@ from django.core.validators import RegexValidator
 from pyweek.challenge import models
 
 from pyweek.bleaching import html2safehtml
-import collections
 from django.core.exceptions import ObjectDoesNotExist
 
 safeTags = '''b a i br blockquote table tr td img pre p dl dd dt
@@ -130,32 +129,14 @@ def delete_spammer(request, user_id):
         return user_display(request, user_id)
 
     user = models.User.objects.get(username__exact=user_id)
-    comments = list(models.DiaryComment.objects.filter(user=user))
-    d = collections.defaultdict(list)
-    for comment in comments:
-        d[comment.diary_entry].append(comment)
+    comments = models.DiaryComment.objects.filter(user=user)
+    threads = set(comments.values_list('diary_entry', flat=True))
 
     user.password = 'X'
     user.save()
 
-    last = None
-    for diary_entry, comments in list(d.items()):
-        for comment in diary_entry.diarycomment_set.all():
-            if comment.user != user:
-                last = comment
-        if last is None:
-            diary_entry.actor = diary_entry.user
-            diary_entry.last_comment = None
-            diary_entry.activity = diary_entry.created
-            diary_entry.reply_count = 0
-        else:
-            diary_entry.last_comment = last
-            diary_entry.activity = last.created
-            diary_entry.actor = last.user
-            diary_entry.reply_count -= len(comments)
-        diary_entry.save()
-        for comment in comments:
-            comment.delete()
+    comments.delete()
+    models.DiaryEntry.objects.update_activity(threads)
 
     messages.success(request, f'Spammer deleted! ({user})')
     return HttpResponseRedirect(f'/u/{user_id}/')
@@ -0,0 +1,188 @@
+"""Per-request timings, keyed by view.
+
+RequestTimingMiddleware records the number of database queries, the time
+spent in the database and in rendering templates, and the total time for
+each request. Recent records are kept in a ring buffer in each process and
+logged to the "pyweek.requests" logger.
+
+Views can declare how many queries they expect to make with the
+query_budget() decorator. A request that goes over budget logs a warning,
+or raises QueryBudgetExceeded if settings.QUERY_BUDGET_STRICT is set, as
+it is for the tests.
+"""
+import collections
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection
+from django.http import Http404, JsonResponse
+from django.template import TemplateDoesNotExist
+from django.template.backends import django as django_backend
+
+
+logger = logging.getLogger('pyweek.requests')
+
+# Number of requests to keep in each process
+RING_SIZE = 1000
+
+_recent = collections.deque(maxlen=RING_SIZE)
+_recent_lock = threading.Lock()
+
+# The timings of the request being handled by the current thread
+_local = threading.local()
+
+
+class QueryBudgetExceeded(Exception):
+    """A view made more queries than its budget allows."""
+
+
+def query_budget(max_queries):
+    """Declare the most queries a view should make in one request.
+
+    The budget covers the whole request, including looking up the session
+    and the logged-in user.
+
+    """
+    def decorator(view):
+        view.query_budget = max_queries
+        return view
+    return decorator
+
+
+class RequestTimingMiddleware:
+    """Record timings for each request and check query budgets."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        timings = _local.timings = {
+            'queries': 0,
+            'db_time': 0.0,
+            'template_time': 0.0,
+        }
+        request.query_budget = None
+        start = time.perf_counter()
+        try:
+            with connection.execute_wrapper(self.time_query):
+                response = self.get_response(request)
+        finally:
+            del _local.timings
+        timings['total_time'] = time.perf_counter() - start
+
+        match = request.resolver_match
+        if match is None:
+            return response
+        record = {
+            'view': match.view_name,
+            'method': request.method,
+            'status': response.status_code,
+            'time': time.time(),
+            **timings,
+        }
+        with _recent_lock:
+            _recent.append(record)
+        logger.info(
+            "%(view)s %(method)s %(status)d queries=%(queries)d "
+            "db=%(db_time).3fs templates=%(template_time).3fs "
+            "total=%(total_time).3fs",
+            record,
+        )
+
+        budget = request.query_budget
+        if budget is not None and timings['queries'] > budget:
+            msg = (
+                f"{match.view_name} made {timings['queries']} queries, "
+                f"over its budget of {budget}"
+            )
+            if getattr(settings, 'QUERY_BUDGET_STRICT', False):
+                raise QueryBudgetExceeded(msg)
+            logger.warning(msg)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request.query_budget = getattr(view_func, 'query_budget', None)
+
+    def time_query(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            timings = getattr(_local, 'timings', None)
+            if timings is not None:
+                timings['queries'] += 1
+                timings['db_time'] += time.perf_counter() - start
+
+
+class Template(django_backend.Template):
+    """A template that adds its render time to the current request."""
+
+    def render(self, context=None, request=None):
+        start = time.perf_counter()
+        try:
+            return super().render(context, request)
+        finally:
+            timings = getattr(_local, 'timings', None)
+            if timings is not None:
+                timings['template_time'] += time.perf_counter() - start
+
+
+class DjangoTemplates(django_backend.DjangoTemplates):
+    """The Django template backend, timing each render."""
+
+    def from_string(self, template_code):
+        return Template(self.engine.from_string(template_code), self)
+
+    def get_template(self, template_name):
+        try:
+            return Template(self.engine.get_template(template_name), self)
+        except TemplateDoesNotExist as exc:
+            django_backend.reraise(exc, self)
+
+
+def recent_requests():
+    """Get the timings of recent requests handled by this process."""
+    with _recent_lock:
+        return list(_recent)
+
+
+def percentile(values, p):
+    """Get the p'th percentile of a list of numbers, by nearest rank."""
+    values = sorted(values)
+    if not values:
+        return None
+    rank = max(int(round(p / 100.0 * len(values))) - 1, 0)
+    return values[rank]
+
+
+def summarise(records):
+    """Summarise request timings by view."""
+    by_view = collections.defaultdict(list)
+    for r in records:
+        by_view[r['view']].append(r)
+
+    summary = {}
+    for view, rs in sorted(by_view.items()):
+        totals = [r['total_time'] for r in rs]
+        queries = [r['queries'] for r in rs]
+        summary[view] = {
+            'requests': len(rs),
+            'p50': percentile(totals, 50),
+            'p95': percentile(totals, 95),
+            'max_queries': max(queries),
+            'mean_queries': sum(queries) / len(queries),
+            'mean_db_time': sum(r['db_time'] for r in rs) / len(rs),
+            'mean_template_time': (
+                sum(r['template_time'] for r in rs) / len(rs)
+            ),
+        }
+    return summary
+
+
+def timings(request):
+    """Show a summary of recent requests handled by this process."""
+    if not request.user.is_staff:
+        raise Http404()
+    return JsonResponse(summarise(recent_requests()))
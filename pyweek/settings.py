@@ -1,4 +1,6 @@
 # Django settings for pyweek project.
+import os
+import tempfile
 
 DEBUG = False
 
@@ -12,6 +14,9 @@ DATABASES: dict[str, dict[str, str]] = {}
 
 ALLOWED_HOSTS = ['.pyweek.org']
 
+# The site's own address, for links made outside of a request
+SITE_URL = 'https://pyweek.org/'
+
 # Absolute path to the directory that holds uploaded files and its URL
 MEDIA_ROOT = ''     # must be set per deployment
 MEDIA_URL = '/media/'
@@ -45,6 +50,7 @@ SITE_ID = 1
 USE_I18N = False
 
 MIDDLEWARE = [
+    'pyweek.instrumentation.RequestTimingMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
@@ -55,12 +61,21 @@ MIDDLEWARE = [
 
 ROOT_URLCONF = 'pyweek.urls'
 
+# Raise an error, rather than log a warning, when a view goes over its
+# query budget. See pyweek.instrumentation.
+QUERY_BUDGET_STRICT = False
+
+# Trackers announced in the torrents of challenge archives. The torrents
+# are web-seeded from the site, so they work without any.
+TORRENT_TRACKERS: list[str] = []
+
 # Use the default AutoField type for backwards-compatibility
 DEFAULT_AUTO_FIELD = 'django.db.models.AutoField'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # Django's backend, timing renders for RequestTimingMiddleware
+        'BACKEND': 'pyweek.instrumentation.DjangoTemplates',
         'DIRS': [],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -117,11 +132,24 @@ INSTALLED_APPS = [
 ]
 
 
-# Cache some things in local memory
+# The revision of the deployed code, written by "fab publish". Cache keys
+# are prefixed with it so that each deploy starts with a fresh cache.
+try:
+    with open(os.path.join(os.path.dirname(__file__), '..', 'REVISION')) as f:
+        DEPLOY_REVISION = f.read().strip()
+except FileNotFoundError:
+    DEPLOY_REVISION = 'dev'
+
+# Cache some things on disk, shared by all worker processes. The backends
+# in pyweek.cache count hits and misses; see the cache_stats command.
 CACHES = {
     'default': {
-        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
-        'LOCATION': 'locmemcache',
+        'BACKEND': 'pyweek.cache.FileBasedCache',
+        'LOCATION': os.path.join(tempfile.gettempdir(), 'pyweek-cache'),
+        'KEY_PREFIX': DEPLOY_REVISION,
+        'OPTIONS': {
+            'MAX_ENTRIES': 10000,
+        },
     }
 }
 
@@ -129,6 +157,9 @@ LOGIN_URL = '/login/'
 DEFAULT_FROM_EMAIL = 'daniel@pyweek.org'
 FILE_UPLOAD_PERMISSIONS = 0o644
 
+# Store identical uploads once; see pyweek.challenge.storage
+DEFAULT_FILE_STORAGE = 'pyweek.challenge.storage.BlobStorage'
+
 
 # Number of days before the competition that registration opens
 REGISTRATION_OPENS = 45  # days
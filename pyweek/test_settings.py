@@ -39,3 +39,12 @@ PASSWORD_HASHERS = [
 ]
 
 EMAIL_BACKEND = "django.core.mail.backends.locmem.EmailBackend"
+
+QUERY_BUDGET_STRICT = True
+
+CACHES = {
+    "default": {
+        "BACKEND": "pyweek.cache.LocMemCache",
+        "LOCATION": "pyweek-tests",
+    }
+}
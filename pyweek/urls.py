@@ -6,12 +6,15 @@ import django.views.static
 from django.contrib.staticfiles.urls import staticfiles_urlpatterns
 from django.views.generic.base import RedirectView
 
+from pyweek import instrumentation
+
 admin.autodiscover()
 
 urlpatterns = [
     url(r'^admin/', admin.site.urls),
     url(r'^emails/', include('pyweek.mail.urls')),
     url(r'^latest/', include('pyweek.activity.urls')),
+    url(r'^timings\.json$', instrumentation.timings),
     url(r'^media/dl/(?P<path>.*)',
         RedirectView.as_view(url=settings.MEDIA_URL + '%(path)s')),
     url(r'', include('pyweek.challenge.urls')),